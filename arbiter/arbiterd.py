@@ -8,17 +8,21 @@ from __future__ import print_function
 import gevent
 import logging
 import os.path
+import signal
 
 from arbiter.backends import load_backends, analysis_backends
 from arbiter.balance import BalanceComponent
 from arbiter.bounties import BountyComponent
+from arbiter.cache import CacheComponent
 from arbiter.events import Events, event_register_instance
 from arbiter.monitor import MonitorComponent
 from arbiter.polyswarm_api import PolySwarmAPI
+from arbiter.rollup import artifact_rates
+from arbiter.store import ArtifactStore
 from arbiter.verdicts import VerdictComponent, reset_pending_jobs
 from arbiter.web_api import APIComponent
 
-from arbiter import ipfs
+from arbiter import ipfs, offload
 
 log = logging.getLogger(__name__)
 
@@ -29,6 +33,7 @@ class Arbiterd(object):
         BalanceComponent,
         Events,
         BountyComponent,
+        CacheComponent,
         VerdictComponent,
         MonitorComponent,
     ]
@@ -57,7 +62,8 @@ class Arbiterd(object):
     def run(self):
         ipfs.ipfs_host = self.config.polyswarmd
         ipfs.ipfs_apikey = self.config.apikey
-        ipfs.cache_path = self.config.artifacts
+        ipfs.configure(self.config.ipfs)
+        offload.configure(self.config.offload_threads)
 
         self.initial_block = self.polyswarm.wait_online()
         self.polyswarm.set_base_nonce()
@@ -65,6 +71,7 @@ class Arbiterd(object):
         if '.stage.' not in self.config.polyswarmd:
             self.polyswarm.check_staking_requirements()
         reset_pending_jobs()
+        artifact_rates.backfill()
 
         load_backends(self.config.analysis_backends)
         log.debug("Analysis backends: %s", ", ".join(analysis_backends.keys()))
@@ -76,6 +83,10 @@ class Arbiterd(object):
             log.info("Creating artifacts directory: %s",
                      self.config.artifacts)
             os.makedirs(self.config.artifacts)
+        ipfs.store = ArtifactStore(
+            self.config.artifacts, self.config.artifacts_max_bytes,
+            compression=self.config.artifacts_compression)
+        ipfs.store.scan()
 
         instances = []
         for c in self.components:
@@ -89,8 +100,15 @@ class Arbiterd(object):
             log.debug("Run instance %r", i)
             tasks.append(gevent.spawn(trap_run, i.run))
 
-        for t in tasks:
-            t.join()
+        # Stop like on ^C, so the finally clause runs
+        gevent.signal_handler(signal.SIGTERM, gevent.kill,
+                              gevent.getcurrent(), SystemExit)
+        try:
+            for t in tasks:
+                t.join()
+        finally:
+            # Counts since the last periodic flush
+            trap_run(artifact_rates.flush)
 
 def trap_run(func):
     try:
@@ -1,29 +1,37 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
-import hashlib
-
-from arbiter.ipfs import ipfs_open
+from arbiter.ipfs import (
+    ipfs_open, ipfs_download, ipfs_cached_length, ipfs_cached_sha256
+)
 
 class Artifact(object):
-    def __init__(self, id, name, hash, url):
+    def __init__(self, id, name, hash, url, sha256=None):
         self.id = id
         self.name = name
         self.hash = hash
         self.url = url
-        self._sha256 = None
+        self._sha256 = sha256
+
+    def download(self):
+        """Make sure the artifact is in the local store"""
+        ipfs_download(self.hash)
 
     def fetch(self):
         return ipfs_open(self.hash)
 
+    def length(self):
+        self.download()
+        return ipfs_cached_length(self.hash)
+
+    def upload(self):
+        """(name, open, length) for PooledSession.post_files; the file is
+        only opened while the request body is sent"""
+        length = self.length()
+        return self.name, self.fetch, length
+
     def sha256(self):
         if not self._sha256:
-            s = hashlib.sha256()
-            with self.fetch() as fp:
-                while True:
-                    tmp = fp.read(4096)
-                    if not tmp:
-                        break
-                    s.update(tmp)
-            self._sha256 = s.hexdigest()
+            self.download()
+            self._sha256 = ipfs_cached_sha256(self.hash)
         return self._sha256
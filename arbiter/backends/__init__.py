@@ -1,56 +1,107 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
+from arbiter.circuit import CircuitBreaker
+from arbiter.events import dispatch_event
+from arbiter.httpclient import PooledSession
+
 # Write-once list of all analysis backends
 analysis_backends = {}
 
 def load_backends(config):
     global analysis_backends
     for name, conf in config.items():
-        plugin = conf.get("plugin", name)
-
-        mod = __import__("arbiter.backends." + plugin)
-        mod = getattr(mod.backends, plugin)
-
-        # TODO:
-        plugin_class = None
-        for obj in dir(mod):
-            if obj == "AnalysisBackend":
-                continue
-            elif obj[0].isalpha() and obj[0].isupper():
-                val = getattr(mod, obj, None)
-                try:
-                    if issubclass(val, AnalysisBackend):
-                        plugin_class = val
-                        break
-                except TypeError:
-                    # Not a class
-                    pass
-        if not plugin_class:
-            raise ValueError("Missing plugin class for %s" % plugin)
-
-        inst = plugin_class(name, conf.get("trusted", False),
-                            conf.get("weight", 1))
-        inst.configure(conf)
+        inst = create_backend(name, conf)
+        if conf.get("fallback"):
+            # A standby for the same logical backend: it shares the name (and
+            # thus the API token and vote weight) of the primary, and only
+            # overrides the given settings (typically the URL).
+            fallback_conf = dict(conf)
+            fallback_conf.pop("fallback")
+            fallback_conf.update(conf["fallback"])
+            inst.fallback = create_backend(name, fallback_conf, True)
         analysis_backends[name] = inst
 
     return analysis_backends
 
+def create_backend(name, conf, is_fallback=False):
+    plugin = conf.get("plugin", name)
+
+    mod = __import__("arbiter.backends." + plugin)
+    mod = getattr(mod.backends, plugin)
+
+    # TODO:
+    plugin_class = None
+    for obj in dir(mod):
+        if obj == "AnalysisBackend":
+            continue
+        elif obj[0].isalpha() and obj[0].isupper():
+            val = getattr(mod, obj, None)
+            try:
+                if issubclass(val, AnalysisBackend):
+                    plugin_class = val
+                    break
+            except TypeError:
+                # Not a class
+                pass
+    if not plugin_class:
+        raise ValueError("Missing plugin class for %s" % plugin)
+
+    inst = plugin_class(name, conf.get("trusted", False),
+                        conf.get("weight", 1), is_fallback)
+    inst.configure_http(conf)
+    inst.configure_breaker(conf)
+    inst.configure(conf)
+    return inst
+
 class AnalysisBackend(object):
     """Defines the API for communication with analysis backends"""
 
-    def __init__(self, name, trusted, weight):
+    def __init__(self, name, trusted, weight, is_fallback=False):
         self.name = name
         self.trusted = trusted
         self.weight = weight
+        self.is_fallback = is_fallback
+        self.fallback = None
         # TODO
         self.api_key = name
+        self.configure_http({})
+        self.configure_breaker({})
+
+    def configure_http(self, conf):
+        """Set up the keep-alive connection pool used to talk to the backend.
+        Submissions may take a while for synchronous backends, hence the
+        longer default read timeout."""
+        self.session = PooledSession.from_config(conf, read_timeout=300)
+
+    def configure_breaker(self, conf):
+        """Stop submitting jobs after `breaker_threshold` consecutive
+        failures, and try again after `breaker_reset` seconds."""
+        label = self.name + (" (fallback)" if self.is_fallback else "")
+        self.breaker = CircuitBreaker(label,
+                                      conf.get("breaker_threshold", 5),
+                                      conf.get("breaker_reset", 60),
+                                      self._circuit_changed)
+
+    def _circuit_changed(self, state):
+        dispatch_event("backend_circuit", self.name, self.is_fallback, state)
+
+    def route(self):
+        """The backend instance new jobs should be submitted to, or None if
+        jobs must be held until a circuit breaker closes again."""
+        if self.breaker.allow():
+            return self
+        if self.fallback and self.fallback.breaker.allow():
+            return self.fallback
+        return None
 
     def configure(self, conf):
         """Set up analysis backend with plugin-specific configuration"""
 
-    def cancel_artifact(self, av_id, artifact):
-        """Job no longer applies (e.g. due to timeout)"""
+    def cancel_artifact(self, av_id, artifact, task=None):
+        """Job no longer applies (e.g. due to timeout, or because a verdict
+        was made without it). The task contains the metadata returned by
+        submit_artifact, if any."""
 
     def submit_artifact(self, av_id, artifact, previous_task=None):
         """Submit an artifact for analysis. If a task is resubmitted (e.g. at
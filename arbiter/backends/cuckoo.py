@@ -1,8 +1,6 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
-import requests
-
 from arbiter.backends import AnalysisBackend
 
 class Cuckoo(AnalysisBackend):
@@ -31,7 +29,7 @@ class Cuckoo(AnalysisBackend):
         if self.options:
             body["options"] = self.options
         body["custom"] = artifact.url
-        files = {"file": (artifact.name, artifact.fetch())}
+        files = {"file": artifact.upload()}
         if self.api_version == "distributed":
             path = "api/task"
         else:
@@ -39,9 +37,9 @@ class Cuckoo(AnalysisBackend):
         headers = {"X-Arbiter": self.name}
         if self.api_token:
             headers["Authorization"] = "Bearer %s" % self.api_token
-        req = requests.post(self.cuckoo_url + path,
-                            headers=headers,
-                            data=body, files=files)
+        req = self.session.post_files(self.cuckoo_url + path,
+                                      headers=headers,
+                                      data=body, files=files)
         req.raise_for_status()
         resp = req.json()
         task_id = None
@@ -61,11 +59,30 @@ class Cuckoo(AnalysisBackend):
         return {"task_id": task_id,
                 "href": self.href_pattern % (self.cuckoo_view_url, task_id)}
 
+    def cancel_artifact(self, av_id, artifact, task=None):
+        if not task or task.get("task_id") is None:
+            return
+        headers = {"X-Arbiter": self.name}
+        if self.api_token:
+            headers["Authorization"] = "Bearer %s" % self.api_token
+        if self.api_version == "distributed":
+            req = self.session.delete(
+                self.cuckoo_url + "api/task/%s" % task["task_id"],
+                headers=headers
+            )
+        else:
+            req = self.session.get(
+                self.cuckoo_url + "tasks/delete/%s" % task["task_id"],
+                headers=headers
+            )
+        req.raise_for_status()
+
     def health_check(self):
         headers = {}
         if self.api_token:
             headers["Authorization"] = "Bearer %s" % self.api_token
-        req = requests.get(self.cuckoo_url + "v1/cuckoo/status", headers=headers)
+        req = self.session.get(self.cuckoo_url + "v1/cuckoo/status",
+                               headers=headers)
         req.raise_for_status()
         data = req.json()
         report = {
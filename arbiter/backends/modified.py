@@ -1,8 +1,6 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
-import requests
-
 from arbiter.backends import AnalysisBackend
 
 class Modified(AnalysisBackend):
@@ -18,10 +16,10 @@ class Modified(AnalysisBackend):
         if self.options:
             body["options"] = self.options
         body["custom"] = artifact.url
-        files = {"file": (artifact.name, artifact.fetch())}
-        req = requests.post(self.cuckoo_url + "v1/tasks/create/file",
-                            headers={"X-Arbiter": self.name},
-                            data=body, files=files)
+        files = {"file": artifact.upload()}
+        req = self.session.post_files(self.cuckoo_url + "v1/tasks/create/file",
+                                      headers={"X-Arbiter": self.name},
+                                      data=body, files=files)
         req.raise_for_status()
         resp = req.json()
         if "task_ids" not in resp:
@@ -29,7 +27,7 @@ class Modified(AnalysisBackend):
         return {"task_ids": resp["task_ids"]}
 
     def health_check(self):
-        req = requests.get(self.cuckoo_url + "v1/cuckoo/status")
+        req = self.session.get(self.cuckoo_url + "v1/cuckoo/status")
         req.raise_for_status()
         data = req.json()
         report = {
@@ -1,20 +1,53 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
-import requests
-
 from arbiter.backends import AnalysisBackend
 
 class Process(AnalysisBackend):
     def configure(self, config):
         self.url = config["url"]
 
+        # Asynchronous mode: abrunner queues the sample and reports back to
+        # the arbiter when the scan is complete
+        self.asynchronous = config.get("async", False)
+        base_url = self.url
+        if not base_url.endswith("/"):
+            base_url += "/"
+        self.tasks_url = base_url + "tasks"
+        self.status_url = base_url + "status"
+
     def submit_artifact(self, av_id, artifact, previous_task=None):
-        files = {"file": (artifact.name, artifact.fetch())}
-        req = requests.post(self.url, files=files,
-                            headers={"X-Arbiter": self.name})
+        files = {"file": artifact.upload()}
+        if self.asynchronous:
+            req = self.session.post_files(self.tasks_url, files=files,
+                                          data={"callback": artifact.url},
+                                          headers={"X-Arbiter": self.name})
+            req.raise_for_status()
+            return {"task_id": req.json()["task_id"]}
+
+        req = self.session.post_files(self.url, files=files,
+                                      headers={"X-Arbiter": self.name})
         req.raise_for_status()
         verdict = req.json()["verdict"]
         if verdict is None or isinstance(verdict, int):
             return verdict
         raise ValueError(verdict)
+
+    def cancel_artifact(self, av_id, artifact, task=None):
+        if not self.asynchronous or not task or "task_id" not in task:
+            return
+        req = self.session.delete("%s/%s" % (self.tasks_url, task["task_id"]),
+                                  headers={"X-Arbiter": self.name})
+        if req.status_code != 404:
+            req.raise_for_status()
+
+    def health_check(self):
+        if not self.asynchronous:
+            return
+        req = self.session.get(self.status_url)
+        req.raise_for_status()
+        data = req.json()
+        return {
+            "machinestotal": data["workers"],
+            "machinesused": data["busy"],
+        }
@@ -0,0 +1,11 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+from arbiter.backends import AnalysisBackend
+
+class Pull(AnalysisBackend):
+    """Backend that fetches its work through GET /artifacts, and submits
+    verdicts through the API"""
+
+    def submit_artifact(self, av_id, artifact, previous_task=None):
+        return {}
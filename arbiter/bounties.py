@@ -1,23 +1,29 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
+import datetime
 import logging
-import gevent
+import time
 
 from sqlalchemy.exc import IntegrityError
 from sqlalchemy import or_, and_
 
 from arbiter.backends import analysis_backends
+from arbiter.cache import prefetch
 from arbiter.component import Component
 from arbiter.const import JOB_STATUS_NEW, VERDICT_MAYBE
 from arbiter.database import DbSession, DbBounty, DbArtifact, DbArtifactVerdict
 from arbiter.events import event, periodic, dispatch_event
-from arbiter.ipfs import ipfs_json, ipfs_download, IPFSNotFoundError
+from arbiter.ipfs import ipfs_json, IPFSNotFoundError
+from arbiter.metrics import registry
 from arbiter.polyswarm_api import PolySwarmError, PolySwarmNotFound
 from arbiter.utils import pct_agree, vote_show, vote_compare
 
 log = logging.getLogger(__name__)
 
+vote_time = registry.histogram(
+    "arbiter_vote_seconds", "Time to submit a bounty vote", ["result"])
+
 ARBITER_VOTE_WINDOW = 25
 ASSERTION_REVEAL_WINDOW = 25
 
@@ -203,22 +209,29 @@ class BountyComponent(Component):
 
         log.info("%s | %s | Vote on bounty: %s", guid, self.cur_block, vote_show(value))
         soft_fail = False
+        result = "ok"
+        start = time.time()
         try:
             if self.cur_block <= vote_before:
                 self.polyswarm.vote_bounty(guid, value)
             else:
                 log.error("%s | %s | Permanent voting error: expired!", self.cur_block, guid)
+                result = "expired"
         except PolySwarmError as e:
             if e.status >= 500 and self.cur_block < vote_before:
                 log.error("%s | Temporary voting error: %s", guid, e.message or e.reason)
                 # Server booboo, so try again later
                 soft_fail = True
+                result = "temporary_error"
             else:
                 log.error("%s | Permanent voting error: %s", guid, e.message or e.reason)
                 # Side-effect: we won't retry
+                result = "error"
         except IOError as e:
             log.error("%s | Temporary voting error: %s", guid, e)
             soft_fail = True
+            result = "temporary_error"
+        vote_time.observe(time.time() - start, result=result)
 
         s = DbSession()
         bounty = s.query(DbBounty).with_for_update().filter_by(guid=guid).one()
@@ -230,6 +243,7 @@ class BountyComponent(Component):
                 bounty.error_retries += 1
                 if bounty.error_retries >= 3:
                     bounty.status = "aborted"
+                    bounty.finished_at = datetime.datetime.utcnow()
                     log.error("%s | %s | Aborted while voting, too many failures", guid, self.cur_block)
             s.add(bounty)
         else:
@@ -321,12 +335,14 @@ class BountyComponent(Component):
                 bounty.error_retries += 1
                 if bounty.error_retries >= 3:
                     bounty.status = "aborted"
+                    bounty.finished_at = datetime.datetime.utcnow()
                     log.error("%s | %s | Aborted while settling, too many failures", guid, self.cur_block)
             else:
                 if failed:
                     bounty.status = "aborted"
                 else:
                     bounty.status = "finished"
+                bounty.finished_at = datetime.datetime.utcnow()
                 bounty.settled = True
             s.add(bounty)
         s.commit()
@@ -375,6 +391,10 @@ class BountyComponent(Component):
         num_artifacts = len(manifest)
         expiration = int(bounty["expiration"])
 
+        # Current chain parameters, refreshed in the background
+        reveal_window = self.polyswarm.reveal_window
+        vote_window = self.polyswarm.vote_window
+
         s = DbSession()
         b = DbBounty(
             guid=bounty["guid"],
@@ -385,10 +405,10 @@ class BountyComponent(Component):
             error_delay_block=0,
 
             expiration_block=expiration,
-            vote_after=expiration + self.polyswarm.reveal_window + 1,
-            vote_before=expiration + self.polyswarm.vote_window,
-            reveal_block=expiration + self.polyswarm.vote_window + self.polyswarm.reveal_window,
-            settle_block=expiration + self.polyswarm.vote_window + self.polyswarm.reveal_window
+            vote_after=expiration + reveal_window + 1,
+            vote_before=expiration + vote_window,
+            reveal_block=expiration + vote_window + reveal_window,
+            settle_block=expiration + vote_window + reveal_window
         )
 
         if self.manual_mode:
@@ -429,25 +449,12 @@ class BountyComponent(Component):
             s.flush()
         s.commit()
         s.close()
+        dispatch_event("bounty_new", bounty["guid"], num_artifacts)
 
-        artifacts = []
-        for i, artifact in enumerate(manifest):
-            # TODO: this is just the way their API works
-            # TODO: parallel download
-            artifacts.append(gevent.spawn(ipfs_download,
-                                          artifact["hash"],
-                                          "%s/%s" % (bounty["uri"], i)))
-        gevent.joinall(artifacts)
-        for a in artifacts:
-            if a.exception is not None:
-                # TODO: we should abort here
-                log.warning("Downloading artifacts for %s not succesful!",
-                            bounty["guid"])
-                break
-
-        # Start submitting the artifacts
-        for job in job_ids:
-            dispatch_event("verdict_jobs", bounty["guid"], job)
+        # TODO: this is just the way their API works
+        files = [(artifact["hash"], "%s/%s" % (bounty["uri"], i))
+                 for i, artifact in enumerate(manifest)]
+        prefetch(bounty["guid"], files, job_ids)
 
     @event("bounty_artifact_verdict")
     def bounty_artifact_verdict(self, bounty_id):
@@ -475,6 +482,7 @@ class BountyComponent(Component):
                           " at block %s, voting ended on %s!",
                           bounty.guid, self.cur_block, bounty.vote_before)
                 bounty.status = "aborted"
+                bounty.finished_at = datetime.datetime.utcnow()
                 guid = bounty.guid
                 s.add(bounty)
                 s.commit()
@@ -0,0 +1,117 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+"""
+Artifact cache management. Artifacts of new bounties are prefetched by a
+few workers, fed through a bounded queue, before their jobs are
+dispatched. Files stay pinned while any bounty referencing them is
+active, and are removed once the last of those bounties has been
+finished or aborted for longer than the grace period.
+"""
+
+import gevent
+import gevent.queue
+import logging
+
+from arbiter import ipfs
+from arbiter.component import Component
+from arbiter.database import DbSession, DbArtifact
+from arbiter.events import dispatch_event, periodic
+from arbiter.ipfs import ipfs_download_many, ipfs_cached_sha256
+from arbiter.metrics import registry
+from arbiter.store import pinned_artifact_hashes
+
+log = logging.getLogger(__name__)
+
+# Bounties waiting for their artifacts; when full, new bounties wait
+PREFETCH_QUEUE_SIZE = 64
+# Bounties downloaded at the same time
+PREFETCH_WORKERS = 4
+
+prefetch_queued = registry.gauge(
+    "arbiter_prefetch_queued", "Bounties waiting for their artifacts")
+collected_files = registry.counter(
+    "arbiter_cache_collected_files", "Files removed after their bounties "
+    "were finished")
+collected_bytes = registry.counter(
+    "arbiter_cache_collected_bytes", "Bytes removed after their bounties "
+    "were finished")
+
+prefetch_queue = gevent.queue.Queue(PREFETCH_QUEUE_SIZE)
+# Artifacts of bounties that are queued or being downloaded; their jobs are
+# dispatched by the prefetch workers, not retried
+prefetching = set()
+
+def prefetch(guid, files, job_ids):
+    """Queue the (hash, uri) files of a bounty for download, and the jobs
+    of artifacts (in the same order) to dispatch when they are available.
+    Blocks while the queue is full."""
+    prefetching.update(job_ids)
+    try:
+        prefetch_queue.put((guid, files, job_ids))
+    except:
+        prefetching.difference_update(job_ids)
+        raise
+    prefetch_queued.set(prefetch_queue.qsize())
+
+def fetch_bounty_artifacts(guid, files, job_ids):
+    failed = ipfs_download_many(files)
+    if failed:
+        # One more round for just the artifacts that failed
+        failed = ipfs_download_many(failed)
+    if failed:
+        log.warning("%s | %d of %d artifacts could not be downloaded, "
+                    "their jobs are retried later", guid, len(failed),
+                    len(files))
+    failed = set(hash for hash, uri in failed)
+
+    # Hashed while downloading, so they never need to be read again
+    fetched = []
+    hashes = []
+    for job, (hash, uri) in zip(job_ids, files):
+        if hash in failed:
+            continue
+        fetched.append(job)
+        sha256 = ipfs_cached_sha256(hash)
+        if sha256:
+            hashes.append({"id": job, "sha256": sha256})
+    if hashes:
+        s = DbSession()
+        s.bulk_update_mappings(DbArtifact, hashes)
+        s.commit()
+        s.close()
+
+    # Start submitting the artifacts that are available
+    for job in fetched:
+        dispatch_event("verdict_jobs", guid, job)
+
+class CacheComponent(Component):
+    def __init__(self, parent):
+        self.grace = parent.config.artifacts_grace_period
+
+    def run(self):
+        workers = [gevent.spawn(self.prefetch_worker)
+                   for _ in range(PREFETCH_WORKERS)]
+        gevent.joinall(workers)
+
+    def prefetch_worker(self):
+        for guid, files, job_ids in prefetch_queue:
+            prefetch_queued.set(prefetch_queue.qsize())
+            try:
+                fetch_bounty_artifacts(guid, files, job_ids)
+            except:
+                log.exception("%s | Failed to prefetch artifacts", guid)
+            finally:
+                prefetching.difference_update(job_ids)
+
+    @periodic(minutes=15)
+    def collect_garbage(self):
+        if self.grace is None:
+            return
+        store = ipfs.store
+        files, size = store.collect(pinned_artifact_hashes(self.grace))
+        if files:
+            log.info("Removed %d artifacts (%d bytes) of finished bounties",
+                     files, size)
+            collected_files.inc(files)
+            collected_bytes.inc(size)
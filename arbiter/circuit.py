@@ -0,0 +1,54 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half-open"
+
+class CircuitBreaker(object):
+    """Stop sending work to a service after too many consecutive failures.
+
+    * Closed: everything is allowed through
+    * Open: nothing is allowed through until reset_timeout has passed
+    * Half-open: requests are allowed through again; the first failure opens
+      the circuit again, the first success closes it
+    """
+
+    def __init__(self, name, threshold=5, reset_timeout=60, on_change=None):
+        self.name = name
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.on_change = on_change
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+        log.warning("Circuit for %s: %s -> %s", self.name, self.state, state)
+        self.state = state
+        if self.on_change:
+            self.on_change(state)
+
+    def allow(self):
+        if self.state == CIRCUIT_OPEN:
+            if time.time() - self.opened_at < self.reset_timeout:
+                return False
+            self._set_state(CIRCUIT_HALF_OPEN)
+        return True
+
+    def success(self):
+        self.failures = 0
+        self._set_state(CIRCUIT_CLOSED)
+
+    def failure(self):
+        self.failures += 1
+        if self.state == CIRCUIT_HALF_OPEN or self.failures >= self.threshold:
+            self.opened_at = time.time()
+            self._set_state(CIRCUIT_OPEN)
@@ -0,0 +1,187 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+"""
+Streaming compression of stored artifacts. Compressed files carry the
+suffix of their codec, so files written with different settings can be
+read side by side.
+"""
+
+import lzma
+import time
+import zlib
+
+from arbiter.metrics import registry
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_SIZE = 65536
+
+compression_bytes = registry.counter(
+    "arbiter_compression_bytes", "Bytes passed through compression, "
+    "before (in) and after (out)", ["codec", "direction"])
+compression_ratio = registry.gauge(
+    "arbiter_compression_ratio", "Uncompressed over compressed size of "
+    "the artifacts written since startup", ["codec"])
+compression_cpu = registry.counter(
+    "arbiter_compression_cpu_seconds", "CPU time spent compressing and "
+    "decompressing artifacts", ["codec", "op"])
+
+class Codec(object):
+    def __init__(self, name, suffix, compressor, decompressor):
+        self.name = name
+        self.suffix = suffix
+        self.compressor = compressor
+        # Takes the compressed file object, returns one with a read(size)
+        # that never decompresses much more than size bytes at once
+        self.decompressor = decompressor
+
+class BoundedDecompressor(object):
+    """read(size) over a zlib or lzma decompression object, passing size as
+    its max_length, so a well compressed chunk (e.g. all zeroes) never
+    expands into memory at once. Input that did not fit is kept by the
+    object for the next call: zlib returns it as unconsumed_tail, lzma
+    buffers it. Files hold a single stream; unused_data after its end is
+    ignored."""
+
+    def __init__(self, fp, obj):
+        self.fp = fp
+        self.obj = obj
+
+    def read(self, size):
+        while not self.obj.eof:
+            data = getattr(self.obj, "unconsumed_tail", b"")
+            if not data and getattr(self.obj, "needs_input", True):
+                data = self.fp.read(CHUNK_SIZE)
+                if not data:
+                    # Truncated, return what is left
+                    flush = getattr(self.obj, "flush", None)
+                    return flush() if flush is not None else b""
+            out = self.obj.decompress(data, size)
+            if out:
+                return out
+        return b""
+
+CODECS = {
+    # gzip framing, so files can be inspected with zcat
+    "zlib": Codec("zlib", ".gz",
+                  lambda: zlib.compressobj(6, zlib.DEFLATED, 31),
+                  lambda fp: BoundedDecompressor(fp, zlib.decompressobj(31))),
+    "lzma": Codec("lzma", ".xz", lzma.LZMACompressor,
+                  lambda fp: BoundedDecompressor(fp, lzma.LZMADecompressor())),
+}
+if zstandard is not None:
+    CODECS["zstd"] = Codec(
+        "zstd", ".zst",
+        lambda: zstandard.ZstdCompressor(level=3).compressobj(),
+        lambda fp: zstandard.ZstdDecompressor().stream_reader(
+            fp, read_size=CHUNK_SIZE))
+
+def get_codec(name):
+    """The codec called name, or None for no compression"""
+    if not name:
+        return None
+    if name == "zstd" and zstandard is None:
+        raise ValueError("zstd compression requires the zstandard package")
+    if name not in CODECS:
+        raise ValueError("Unknown compression %r, choose from %s" % (
+            name, ", ".join(sorted(CODECS))))
+    return CODECS[name]
+
+def split_suffix(fname):
+    """(name, codec) of a stored file name"""
+    for codec in CODECS.values():
+        if fname.endswith(codec.suffix):
+            return fname[:-len(codec.suffix)], codec
+    return fname, None
+
+class Compressor(object):
+    def __init__(self, codec):
+        self.codec = codec
+        self.obj = codec.compressor()
+        self.cpu = 0
+        self.size_in = 0
+        self.size_out = 0
+
+    def _run(self, fn, *args):
+        start = time.process_time()
+        data = fn(*args)
+        self.cpu += time.process_time() - start
+        self.size_out += len(data)
+        return data
+
+    def compress(self, data):
+        self.size_in += len(data)
+        return self._run(self.obj.compress, data)
+
+    def flush(self):
+        data = self._run(self.obj.flush)
+        name = self.codec.name
+        compression_cpu.inc(self.cpu, codec=name, op="compress")
+        compression_bytes.inc(self.size_in, codec=name, direction="in")
+        compression_bytes.inc(self.size_out, codec=name, direction="out")
+        written = compression_bytes.get(codec=name, direction="out")
+        if written:
+            compression_ratio.set(
+                compression_bytes.get(codec=name, direction="in") / written,
+                codec=name)
+        return data
+
+class DecompressingReader(object):
+    """Read-only file object that decompresses while reading, so a file is
+    never held in memory as a whole unless read() is asked for all of it"""
+
+    def __init__(self, fp, codec):
+        self.fp = fp
+        self.name = fp.name
+        self.codec = codec
+        self.obj = codec.decompressor(fp)
+        self.buffer = bytearray()
+        self.eof = False
+        self.cpu = 0
+
+    def _fill(self, size):
+        start = time.process_time()
+        data = self.obj.read(size)
+        if data:
+            self.buffer += data
+        else:
+            self.eof = True
+        self.cpu += time.process_time() - start
+
+    def read(self, size=-1):
+        while not self.eof and (size is None or size < 0 or
+                                len(self.buffer) < size):
+            if size is None or size < 0:
+                self._fill(CHUNK_SIZE)
+            else:
+                self._fill(max(size - len(self.buffer), 1))
+        if size is None or size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def readable(self):
+        return True
+
+    def close(self):
+        # Reading may be offloaded to a thread, closing is left to the hub
+        if self.cpu:
+            compression_cpu.inc(self.cpu, codec=self.codec.name,
+                                op="decompress")
+            self.cpu = 0
+        self.fp.close()
+
+    @property
+    def closed(self):
+        return self.fp.closed
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, tb):
+        self.close()
@@ -8,6 +8,7 @@ VERDICT_MAYBE = 50
 VERDICT_MALICIOUS = 100
 
 # VerdictJob status
+JOB_STATUS_CANCELLED = -2
 JOB_STATUS_FAILED = -1
 JOB_STATUS_DONE = 0
 JOB_STATUS_NEW = 1
@@ -15,6 +16,7 @@ JOB_STATUS_SUBMITTING = 2
 JOB_STATUS_PENDING = 3
 
 JOB_STATUS_NAMES = {
+    JOB_STATUS_CANCELLED: "cancelled",
     JOB_STATUS_FAILED: "failed",
     JOB_STATUS_DONE: "done",
     JOB_STATUS_NEW: "new",
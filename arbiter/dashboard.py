@@ -1,34 +1,208 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
+import collections
+import copy
+import gevent
+import gevent.event
 import json
 import logging
+import time
 
 from geventwebsocket import WebSocketError
+from six.moves.urllib.parse import parse_qs
 
 from arbiter.backends import analysis_backends
+from arbiter.metrics import registry
 
 log = logging.getLogger(__name__)
 
-ui_broadcast_ws = set()
+# Maximum number of unsent messages per dashboard client
+CLIENT_QUEUE_SIZE = 64
+
+# Sequence numbers are only meaningful within one run of the arbiter
+UI_EPOCH = int(time.time())
+
+# Connected clients, by websocket
+ui_broadcast_ws = {}
+# Last value of each "latest value" kind, sent on connect
 ui_data_list = {}
+ui_seq = [0]
+
+dashboard_messages = registry.counter(
+    "arbiter_dashboard_messages", "Dashboard messages by outcome", ["result"])
 
-def send(ws, kind, data):
+def encode(kind, data, **extra):
     msg = {"msg": kind}
     msg[kind] = data
-    ws.send(json.dumps(msg, separators=(',',':')))
+    msg.update(extra)
+    return json.dumps(msg, separators=(',',':'))
+
+class DashboardState(object):
+    """The last value of a kind, and the change that led to it.
+
+    Every change gets the next sequence number. If both the old and new
+    value are objects, the change is also encoded as a delta of the changed
+    and removed keys, which clients holding the previous version can
+    apply instead of receiving the full value."""
+
+    def __init__(self, kind, data, key, seq, previous=None):
+        self.kind = kind
+        self.data = copy.deepcopy(data)
+        self.key = key
+        self.seq = seq
+        self.full = encode(kind, data, seq=seq)
+        self.base = None
+        self.delta = None
+        if previous is None or not isinstance(data, dict) or \
+                not isinstance(previous.data, dict):
+            return
+
+        old = previous.data
+        changed = dict((k, v) for k, v in data.items()
+                       if k not in old or old[k] != v)
+        removed = [k for k in old if k not in data]
+        self.base = previous.seq
+        self.delta = encode(kind, changed, seq=seq, base=previous.seq,
+                            removed=removed)
+
+class DashboardClient(object):
+    """Outgoing messages of one websocket, written by a single greenlet.
+
+    "Latest value" kinds are queued by name only and the current state is
+    looked up when writing, so a kind is never queued twice. Queued kinds
+    are written in order of their sequence number, so the highest number
+    a client has seen covers every change before it. Clients that opted in
+    to deltas get only the changes since the version they hold. A client
+    that still falls behind by more than the queue size is disconnected;
+    it catches up again when it reconnects."""
+
+    def __init__(self, ws, size=CLIENT_QUEUE_SIZE, delta=False):
+        self.ws = ws
+        self.size = size
+        self.delta = delta
+        self.queue = collections.deque()
+        self.queued = set()
+        # Sequence number of the state held by the client, per kind
+        self.seen = {}
+        self.ready = gevent.event.Event()
+        self.closed = False
+
+    def put(self, kind, msg=None):
+        """Queue an encoded message, or the state of a kind if msg is None"""
+        if self.closed:
+            return
+        if msg is None and kind in self.queued:
+            dashboard_messages.inc(result="coalesced")
+            return
+        if len(self.queue) >= self.size:
+            log.warning("Dashboard client is not keeping up, disconnecting")
+            dashboard_messages.inc(result="disconnected")
+            self.close()
+            return
+        if msg is None:
+            self.queued.add(kind)
+        self.queue.append(msg)
+        self.ready.set()
+
+    def _state_message(self, kind):
+        state = ui_data_list[kind]
+        seen = self.seen.get(kind)
+        if seen == state.seq:
+            return None
+        self.seen[kind] = state.seq
+        if self.delta and state.delta and seen == state.base:
+            dashboard_messages.inc(result="deltas")
+            return state.delta
+        return state.full
+
+    def writer(self):
+        try:
+            while not self.closed:
+                if not self.queue:
+                    self.ready.clear()
+                    self.ready.wait()
+                    continue
+                msg = self.queue.popleft()
+                if msg is None:
+                    kind = min(self.queued,
+                               key=lambda k: ui_data_list[k].seq)
+                    self.queued.discard(kind)
+                    msg = self._state_message(kind)
+                    if msg is None:
+                        continue
+                self.ws.send(msg)
+                dashboard_messages.inc(result="sent")
+        except WebSocketError as e:
+            log.debug("Dashboard client went away: %s", e)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.set()
+        try:
+            self.ws.close()
+        except WebSocketError:
+            pass
+
+def publish(kind, data, remember=True):
+    """Send a message to all connected dashboard clients. With remember, the
+    value is kept as the state of this kind and only sent if it changed."""
+    if not remember:
+        msg = encode(kind, data)
+        for client in list(ui_broadcast_ws.values()):
+            client.put(kind, msg)
+        return
+
+    previous = ui_data_list.get(kind)
+    key = json.dumps(data, sort_keys=True)
+    if previous and previous.key == key:
+        dashboard_messages.inc(result="unchanged")
+        return
+
+    ui_seq[0] += 1
+    ui_data_list[kind] = DashboardState(kind, data, key, ui_seq[0], previous)
+    for client in list(ui_broadcast_ws.values()):
+        client.put(kind)
 
 def dashboard_ws(ctx, ws):
-    for k, v in ui_data_list.items():
-        send(ws, k, v)
+    """Dashboard updates. Clients that pass delta=1 first receive a sync
+    message with the current epoch, and may receive deltas. On reconnect
+    they pass the epoch and the highest seq seen, e.g.
+    ?delta=1&epoch=E&since=N, and only receive the kinds changed since."""
+    query = parse_qs(ws.environ.get("QUERY_STRING", ""))
+    client = DashboardClient(ws, delta=query.get("delta") == ["1"])
+    since = None
+    if client.delta and query.get("epoch") == [str(UI_EPOCH)]:
+        try:
+            since = int(query.get("since", [""])[0])
+        except ValueError:
+            pass
+
+    if client.delta:
+        client.put("sync", encode("sync", {"epoch": UI_EPOCH}))
+    for kind, state in list(ui_data_list.items()):
+        if since is not None and state.seq <= since:
+            client.seen[kind] = state.seq
+        else:
+            client.put(kind)
 
-    ui_broadcast_ws.add(ws)
+    ui_broadcast_ws[ws] = client
+    writer = gevent.spawn(client.writer)
     try:
-        while True:
+        while not client.closed:
             message = ws.receive()
             if message is None:
                 break
             log.debug("ws < %r", message)
+    except WebSocketError:
+        # Closed by the writer
+        pass
     finally:
-        ui_broadcast_ws.discard(ws)
+        ui_broadcast_ws.pop(ws, None)
+        client.close()
+        writer.kill()
     return []
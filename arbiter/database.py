@@ -3,8 +3,9 @@
 
 import datetime
 
-from sqlalchemy import Index, Integer, String, DateTime, Boolean
-from sqlalchemy import create_engine, Column, ForeignKey
+from sqlalchemy import Index, Integer, BigInteger, String, DateTime, Boolean
+from sqlalchemy import Sequence
+from sqlalchemy import create_engine, inspect, text, Column, ForeignKey
 from sqlalchemy.dialects.postgresql import ENUM
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, backref, relationship
@@ -14,8 +15,6 @@ from arbiter.sql import JsonString, UUID
 Base = declarative_base()
 DbSession = sessionmaker()
 
-# TODO: some indexes need to be created where appropriate.
-
 class DbBounty(Base):
     """A bounty with one or more artifacts"""
     __tablename__ = "bounties"
@@ -60,6 +59,9 @@ class DbBounty(Base):
     settle_block = Column(Integer, nullable=False)
     settled = Column(Boolean, nullable=False, default=False)
 
+    # When the bounty was finished or aborted
+    finished_at = Column(DateTime, nullable=True)
+
     artifacts = relationship("DbArtifact",
                              backref=backref("bounty", lazy="noload"))
 
@@ -74,7 +76,8 @@ class DbArtifact(Base):
     id = Column(Integer, primary_key=True)
     bounty_id = Column(Integer,
                        ForeignKey("bounties.id", ondelete="cascade"),
-                       nullable=False)
+                       nullable=False,
+                       index=True)
     hash = Column(String(255))
     name = Column(String(255))
 
@@ -88,6 +91,9 @@ class DbArtifact(Base):
 
     verdict = Column(Integer, nullable=True)
 
+    # Of the downloaded file, hex encoded
+    sha256 = Column(String(64), nullable=True)
+
     verdicts = relationship("DbArtifactVerdict",
                             backref=backref("artifact", lazy="noload"))
 
@@ -111,9 +117,65 @@ class DbArtifactVerdict(Base):
     expires = Column(DateTime)
     meta = Column(JsonString, nullable=True)
 
+    # Position in the work listing of the backend, drawn from work_seq
+    # every time the job becomes pending
+    work_seq = Column(BigInteger, nullable=True)
+
+work_seq = Sequence("artifact_verdicts_work_seq", metadata=Base.metadata)
+
+# Work listing for analysis backends
+Index("ix_artifact_verdicts_work_seq", DbArtifactVerdict.backend,
+      DbArtifactVerdict.status, DbArtifactVerdict.work_seq)
+
+class DbArtifactRate(Base):
+    """Number of artifacts processed per time bucket, at several
+    resolutions, for the dashboard chart"""
+    __tablename__ = "artifact_rates"
+
+    resolution = Column(Integer, primary_key=True)
+    # End of the bucket, as a UNIX timestamp
+    interval = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+def upgrade_schema(engine):
+    """create_all only creates missing tables (and sequences); add the
+    nullable columns and the indexes that were introduced later to existing
+    tables. Other schema changes are never made automatically."""
+    inspector = inspect(engine)
+    tables = inspector.get_table_names()
+    for table in Base.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = set(c["name"] for c in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name in existing or not column.nullable:
+                continue
+            ddl = "ALTER TABLE %s ADD COLUMN %s %s" % (
+                table.name, column.name,
+                column.type.compile(dialect=engine.dialect))
+            with engine.begin() as conn:
+                conn.execute(text(ddl))
+
+        existing = set(i["name"] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                create_index_concurrently(engine, index)
+
+def create_index_concurrently(engine, index):
+    """Build an index without locking out writes to its table. This can't
+    be done in a transaction; if it is interrupted, the invalid index it
+    leaves behind has to be dropped by hand."""
+    options = index.dialect_options["postgresql"]
+    options["concurrently"] = True
+    try:
+        index.create(engine.execution_options(isolation_level="AUTOCOMMIT"))
+    finally:
+        options["concurrently"] = False
+
 def init_database(dburi, cleanup=False):
     engine = create_engine(dburi)
     DbSession.configure(bind=engine)
     if cleanup:
         Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
+    upgrade_schema(engine)
@@ -12,9 +12,13 @@ import socket
 from ws4py.client import geventclient
 
 from arbiter.component import Component
+from arbiter.metrics import registry
 
 log = logging.getLogger(__name__)
 
+event_time = registry.histogram(
+    "arbiter_event_seconds", "Time spent handling events", ["event"])
+
 class Events(Component):
     def __init__(self, parent):
         self.polyswarm = parent.polyswarm
@@ -101,8 +105,12 @@ class EventParallel:
         self.func = None
         self.first = first
 
+    def run(self, args, kwargs):
+        with event_time.time(event=self.event):
+            trap_run(self.func, args, kwargs)
+
     def __call__(self, args, kwargs):
-        gevent.spawn(trap_run, self.func, args, kwargs)
+        gevent.spawn(self.run, args, kwargs)
 
 class EventSerialized:
     def __init__(self, event, first):
@@ -113,7 +121,8 @@ class EventSerialized:
 
     def task(self):
         for args, kwargs in self.pending:
-            trap_run(self.func, args, kwargs)
+            with event_time.time(event=self.event):
+                trap_run(self.func, args, kwargs)
 
     def __call__(self, args, kwargs):
         self.pending.put((args, kwargs))
@@ -0,0 +1,167 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import logging
+import requests
+import uuid
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+
+# Only these are retried automatically; a POST may have had side effects
+IDEMPOTENT_METHODS = frozenset(("GET", "HEAD", "OPTIONS", "PUT", "DELETE"))
+
+CHUNK_SIZE = 65536
+
+def _retry(retries, backoff, methods=IDEMPOTENT_METHODS):
+    methods = frozenset(methods)
+    kwargs = {
+        "total": retries,
+        "backoff_factor": backoff,
+        "status_forcelist": (502, 503, 504),
+        "raise_on_status": False,
+    }
+    try:
+        return Retry(allowed_methods=methods, **kwargs)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=methods, **kwargs)
+
+def _quote(value):
+    # As browsers (and urllib3) escape form field names and file names
+    return value.replace('"', "%22").replace("\r", "%0D") \
+        .replace("\n", "%0A")
+
+class MultipartEncoder(object):
+    """multipart/form-data body that reads the files while it is sent,
+    instead of loading them into memory first. Files are given as
+    {field: (filename, open, length)}, where open() returns a new file
+    object. Every iteration opens the files again, so a resent body never
+    continues from a half-read file; each file is closed once it has been
+    sent, or by close(). Its length lets requests set Content-Length."""
+
+    def __init__(self, data, files, boundary=None):
+        self.boundary = boundary or uuid.uuid4().hex
+        self.content_type = "multipart/form-data; boundary=%s" % self.boundary
+        self.parts = []
+        self.opened = []
+        for name, value in data.items():
+            self.parts.append((self._header(
+                'form-data; name="%s"' % _quote(name)) +
+                str(value).encode("utf8") + b"\r\n", None, 0))
+        for name, (filename, open_file, length) in files.items():
+            self.parts.append((self._header(
+                'form-data; name="%s"; filename="%s"' % (
+                    _quote(name), _quote(filename)),
+                "application/octet-stream"), open_file, length))
+        self.tail = ("--%s--\r\n" % self.boundary).encode("utf8")
+
+    def _header(self, disposition, content_type=None):
+        header = "--%s\r\nContent-Disposition: %s\r\n" % (self.boundary,
+                                                           disposition)
+        if content_type:
+            header += "Content-Type: %s\r\n" % content_type
+        return (header + "\r\n").encode("utf8")
+
+    def __len__(self):
+        return sum(len(head) + length + (2 if open_file else 0)
+                   for head, open_file, length in self.parts) + len(self.tail)
+
+    def __iter__(self):
+        for head, open_file, length in self.parts:
+            yield head
+            if open_file is None:
+                continue
+            fp = open_file()
+            self.opened.append(fp)
+            try:
+                while True:
+                    chunk = fp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                if fp in self.opened:
+                    self.opened.remove(fp)
+                fp.close()
+            yield b"\r\n"
+        yield self.tail
+
+    def close(self):
+        """Close the files of a body that was not sent completely"""
+        while self.opened:
+            self.opened.pop().close()
+
+class PooledSession(requests.Session):
+    """A requests session with a bounded keep-alive connection pool per host,
+    default (connect, read) timeouts, and retries for idempotent requests
+    (or just the given retry_methods)."""
+
+    def __init__(self, pool_size=10, connect_timeout=10, read_timeout=60,
+                 retries=3, backoff=0.5, retry_methods=IDEMPOTENT_METHODS):
+        requests.Session.__init__(self)
+        self.timeout = (connect_timeout, read_timeout)
+        self.adapter = HTTPAdapter(
+            pool_maxsize=pool_size,
+            max_retries=_retry(retries, backoff, retry_methods))
+        self.mount("http://", self.adapter)
+        self.mount("https://", self.adapter)
+        self.num_requests = 0
+        self.num_errors = 0
+
+    @classmethod
+    def from_config(cls, config, **defaults):
+        """Create a session from the optional pool_size, connect_timeout,
+        read_timeout and retries keys of a configuration section."""
+        kwargs = dict(defaults)
+        for k in ("pool_size", "connect_timeout", "read_timeout", "retries"):
+            if config.get(k) is not None:
+                kwargs[k] = config[k]
+        return cls(**kwargs)
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get("timeout") is None:
+            kwargs["timeout"] = self.timeout
+        self.num_requests += 1
+        try:
+            return requests.Session.request(self, method, url, **kwargs)
+        except requests.RequestException:
+            self.num_errors += 1
+            raise
+
+    def post_files(self, url, data=None, files=None, headers=None,
+                   **kwargs):
+        """POST a multipart/form-data body, like post(data=..., files=...)
+        does, but stream the files; see MultipartEncoder"""
+        body = MultipartEncoder(data or {}, files or {})
+        headers = dict(headers or {})
+        headers["Content-Type"] = body.content_type
+        try:
+            return self.post(url, data=body, headers=headers, **kwargs)
+        finally:
+            body.close()
+
+    def stats(self):
+        """Connection pool usage, summed over all hosts"""
+        r = {
+            "requests": self.num_requests,
+            "errors": self.num_errors,
+            "pools": 0,
+            "connections_opened": 0,
+            "connections_in_use": 0,
+            "pool_requests": 0,
+        }
+        pools = self.adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            r["pools"] += 1
+            r["connections_opened"] += pool.num_connections
+            r["pool_requests"] += pool.num_requests
+            if pool.pool is not None:
+                # Free slots hold either an idle connection or None
+                r["connections_in_use"] += pool.pool.maxsize - pool.pool.qsize()
+        return r
@@ -1,27 +1,190 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
-import hashlib
+import collections
+import gevent
+import gevent.event
+import gevent.lock
+import gevent.pool
 import json
 import logging
-import os.path
-import re
+import random
 import requests
+import time
 
-from arbiter.utils import AtomicWrite
+from arbiter.httpclient import PooledSession
+from arbiter.metrics import registry
 
 log = logging.getLogger(__name__)
 
-r_valid_hash = re.compile(r"^[a-zA-Z0-9]+$")
+download_time = registry.histogram(
+    "arbiter_ipfs_download_seconds", "Time to download from IPFS", ["result"])
+download_bytes = registry.counter(
+    "arbiter_ipfs_download_bytes", "Bytes downloaded from IPFS")
+download_retries = registry.counter(
+    "arbiter_ipfs_retries", "IPFS requests retried after an error")
+coalesced_requests = registry.counter(
+    "arbiter_ipfs_coalesced_requests",
+    "IPFS requests that waited for an identical request in flight", ["kind"])
+json_cache_requests = registry.counter(
+    "arbiter_ipfs_json_cache_requests", "Parsed JSON cache lookups",
+    ["result"])
+json_cache_hit_ratio = registry.gauge(
+    "arbiter_ipfs_json_cache_hit_ratio", "Parsed JSON cache hit ratio")
+json_cache_bytes = registry.gauge(
+    "arbiter_ipfs_json_cache_bytes",
+    "Encoded size of the JSON documents in the parsed JSON cache")
+json_cache_entries = registry.gauge(
+    "arbiter_ipfs_json_cache_entries", "Documents in the parsed JSON cache")
+
+CHUNK_SIZE = 65536
+
+# Downloads in flight over all bounties, and for a single bounty
+DOWNLOAD_CONCURRENCY = 16
+BOUNTY_CONCURRENCY = 4
+# Attempts after the first, with exponential backoff (seconds) and jitter
+RETRIES = 3
+RETRY_BACKOFF = 0.5
+# Parsed JSON documents kept in memory, by encoded size; larger documents
+# aren't kept at all
+JSON_CACHE_BYTES = 16 * 1024 * 1024
+JSON_CACHE_MAX_DOCUMENT = 256 * 1024
 
 ipfs_host = None
 ipfs_apikey = None
-cache_path = None
+# Failed requests are retried here rather than by the session, as a
+# download can also fail halfway through the body
+session = PooledSession(pool_size=DOWNLOAD_CONCURRENCY, retries=0)
+download_slots = gevent.lock.BoundedSemaphore(DOWNLOAD_CONCURRENCY)
+settings = {
+    "bounty_concurrency": BOUNTY_CONCURRENCY,
+    "retries": RETRIES,
+    "retry_backoff": RETRY_BACKOFF,
+}
+# ArtifactStore holding the downloaded files
+store = None
 
 class IPFSNotFoundError(Exception):
     pass
 
-def _ipfs_download(hash, uri):
+def configure(conf):
+    """Set up the connection pool and limits from the optional pool_size,
+    connect_timeout, read_timeout, concurrency, bounty_concurrency, retries,
+    retry_backoff and json_cache_bytes keys of the ipfs configuration
+    section"""
+    global session, download_slots, json_cache
+    concurrency = conf.get("concurrency") or DOWNLOAD_CONCURRENCY
+    session = PooledSession.from_config(
+        dict(conf, retries=0), pool_size=concurrency)
+    download_slots = gevent.lock.BoundedSemaphore(concurrency)
+    for k in settings:
+        if conf.get(k) is not None:
+            settings[k] = conf[k]
+    if conf.get("json_cache_bytes") is not None:
+        json_cache = JsonCache(conf["json_cache_bytes"])
+
+def _retryable(e):
+    if isinstance(e, requests.HTTPError):
+        return e.response is not None and e.response.status_code >= 500
+    return isinstance(e, (requests.ConnectionError, requests.Timeout,
+                          requests.exceptions.ChunkedEncodingError))
+
+def _with_retries(fn, *args):
+    """Call fn, retrying server and connection errors"""
+    attempt = 0
+    while True:
+        try:
+            return fn(*args)
+        except Exception as e:
+            if attempt >= settings["retries"] or not _retryable(e):
+                raise
+            delay = settings["retry_backoff"] * 2 ** attempt * \
+                random.uniform(0.5, 1.5)
+            log.info("IPFS request failed (%s), retrying in %.1fs", e, delay)
+            download_retries.inc()
+            attempt += 1
+            gevent.sleep(delay)
+
+class SingleFlight(object):
+    """Lets concurrent calls for the same key share the result (or the
+    exception) of the call that is already in flight"""
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.calls = {}
+
+    def do(self, key, fn, *args):
+        call = self.calls.get(key)
+        if call is not None:
+            coalesced_requests.inc(kind=self.kind)
+            return call.get()
+
+        call = self.calls[key] = gevent.event.AsyncResult()
+        try:
+            value = fn(*args)
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set(value)
+            return value
+        finally:
+            del self.calls[key]
+            if not call.ready():
+                # Killed or timed out; don't pass that on to the others
+                call.set_exception(IOError("Shared %s of %s was interrupted"
+                                           % (self.kind, key)))
+
+class JsonCache(object):
+    """LRU of parsed JSON documents, bounded by their encoded size. IPFS
+    content never changes, so entries don't expire."""
+
+    def __init__(self, max_bytes=JSON_CACHE_BYTES,
+                 max_document=JSON_CACHE_MAX_DOCUMENT):
+        self.max_bytes = max_bytes
+        self.max_document = max_document
+        # key -> (value, size)
+        self.entries = collections.OrderedDict()
+        self.total = 0
+
+    def get(self, key):
+        """(True, value) if the document is cached, else (False, None)"""
+        entry = self.entries.get(key)
+        if entry is None:
+            json_cache_requests.inc(result="miss")
+            self._update_metrics()
+            return False, None
+        self.entries.move_to_end(key)
+        json_cache_requests.inc(result="hit")
+        self._update_metrics()
+        return True, entry[0]
+
+    def put(self, key, value, size):
+        if size > self.max_document or size > self.max_bytes:
+            return
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.total -= old[1]
+        self.entries[key] = value, size
+        self.total += size
+        while self.total > self.max_bytes:
+            _, (_, n) = self.entries.popitem(last=False)
+            self.total -= n
+        self._update_metrics()
+
+    def _update_metrics(self):
+        hits = json_cache_requests.get(result="hit")
+        total = hits + json_cache_requests.get(result="miss")
+        json_cache_hit_ratio.set(hits / total if total else 0)
+        json_cache_bytes.set(self.total)
+        json_cache_entries.set(len(self.entries))
+
+downloads = SingleFlight("download")
+manifests = SingleFlight("manifest")
+json_cache = JsonCache()
+
+def _ipfs_download(hash, uri, fp=None):
+    """Download to fp in chunks, or return the content if fp is None"""
     if uri is None:
         uri = hash
     #if hash != uri:
@@ -32,43 +195,94 @@ def _ipfs_download(hash, uri):
     headers = {
         "Authorization": "Bearer %s" % ipfs_apikey,
     }
-    r = requests.get(
-        "https://%s/artifacts/%s" % (ipfs_host, uri), headers=headers
-    )
-    if r.status_code == 404:
-        log.warning("IPFS URI %r 404", uri)
-        raise IPFSNotFoundError(uri)
-    r.raise_for_status()
-    return r.content
+    download_slots.acquire()
+    start = time.time()
+    result = "error"
+    try:
+        r = session.get(
+            "https://%s/artifacts/%s" % (ipfs_host, uri), headers=headers,
+            stream=True
+        )
+        with r:
+            if r.status_code == 404:
+                log.warning("IPFS URI %r 404", uri)
+                result = "not_found"
+                raise IPFSNotFoundError(uri)
+            r.raise_for_status()
+            if fp is None:
+                content = r.content
+                download_bytes.inc(len(content))
+            else:
+                content = None
+                for chunk in r.iter_content(CHUNK_SIZE):
+                    fp.write(chunk)
+                    download_bytes.inc(len(chunk))
+        result = "ok"
+    finally:
+        download_time.observe(time.time() - start, result=result)
+        download_slots.release()
+    return content
+
+def _ipfs_store(hash, uri):
+    with store.writer(hash) as fp:
+        _ipfs_download(hash, uri, fp)
+    return fp.fname
 
 def ipfs_download(hash, uri=None):
-    if not r_valid_hash.match(hash):
-        raise ValueError("Invalid IPFS hash %r" % hash)
-    path = os.path.join(cache_path, hash)
-    if not os.path.exists(path):
-        content = _ipfs_download(hash, uri)
-        with AtomicWrite(path) as fp:
-            fp.write(content)
+    path = store.get(hash)
+    if path is None:
+        path = downloads.do(hash, _with_retries, _ipfs_store, hash, uri)
     return path
 
+def ipfs_download_many(files, concurrency=None):
+    """Download (hash, uri) pairs, at most concurrency at a time. Returns
+    the pairs that could not be downloaded."""
+    failed = []
+
+    def download(f):
+        try:
+            ipfs_download(*f)
+        except Exception as e:
+            log.warning("Failed to download artifact %s: %s", f[0], e)
+            failed.append(f)
+
+    pool = gevent.pool.Pool(concurrency or settings["bounty_concurrency"])
+    pool.map(download, files)
+    return failed
+
 def ipfs_open(hash, uri=None):
-    return open(ipfs_download(hash, uri), "rb")
+    """File object with the content, decompressed while reading if the
+    store compresses files"""
+    ipfs_download(hash, uri)
+    return store.open(hash)
 
 def ipfs_cached(hash):
-    if not r_valid_hash.match(hash):
-        raise ValueError("Invalid IPFS hash %r" % hash)
-    path = os.path.join(cache_path, hash)
-    if os.path.exists(path):
-        return open(path, "rb")
+    return store.open(hash)
 
 def ipfs_cached_sha256(hash):
-    fp = ipfs_cached(hash)
-    if fp:
-        r = hashlib.sha256(fp.read()).hexdigest()
-        fp.close()
-        return r
+    """SHA-256 of a downloaded file; computed during the download, unless
+    the file predates this run"""
+    return store.sha256(hash)
+
+def ipfs_cached_length(hash):
+    """Size of the content of a downloaded file"""
+    return store.length(hash)
 
 def ipfs_json(hash, uri=None, cache=True):
+    """Parsed JSON document. Small documents are kept in memory and the
+    same object is returned for every call, so it must not be modified.
+    With cache=False, the document isn't stored on disk."""
+    key = uri or hash
+    found, value = json_cache.get(key)
+    if found:
+        return value
+
     if not cache:
-        return json.loads(_ipfs_download(hash, uri))
-    return json.load(open(ipfs_download(hash, uri), "rb"))
+        content = manifests.do((hash, uri), _with_retries, _ipfs_download,
+                               hash, uri)
+    else:
+        with ipfs_open(hash, uri) as fp:
+            content = fp.read()
+    value = json.loads(content)
+    json_cache.put(key, value, len(content))
+    return value
@@ -0,0 +1,192 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+"""
+Metrics registry, exported in the Prometheus text format by the monitor.
+
+Metrics are created once, at module level, through the registry, e.g.:
+
+    submit_time = registry.histogram(
+        "arbiter_backend_submit_seconds", "Artifact submission time",
+        ["backend"])
+    submit_time.observe(0.3, backend="cuckoo")
+"""
+
+import bisect
+import math
+import time
+
+# Seconds; covers local calls up to slow analysis backend uploads
+DEFAULT_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120,
+)
+
+def _escape(v):
+    return str(v).replace("\\", r"\\").replace("\n", r"\n") \
+        .replace('"', r'\"')
+
+def _value(v):
+    if v == math.inf:
+        return "+Inf"
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    return str(v)
+
+def _labels(names, values, extra=None):
+    pairs = ['%s="%s"' % (k, _escape(v)) for k, v in zip(names, values)]
+    if extra:
+        pairs.append('%s="%s"' % extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+class Timer(object):
+    """Context manager observing the time spent in its block"""
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+class Metric(object):
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labels)
+        self.values = {}
+        if not self.labelnames:
+            # Report 0 before the first update
+            self.values[()] = self.initial()
+
+    def initial(self):
+        return 0
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError("%s takes labels %s, got %s" % (
+                self.name, ", ".join(self.labelnames), ", ".join(labels)))
+        return tuple(labels[k] for k in self.labelnames)
+
+    def get(self, **labels):
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, _labels(self.labelnames, key), value
+
+    def exposition(self):
+        lines = [
+            "# HELP %s %s" % (self.name, _escape(self.documentation)),
+            "# TYPE %s %s" % (self.name, self.kind),
+        ]
+        for name, labels, value in self.samples():
+            lines.append("%s%s %s" % (name, labels, _value(value)))
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, n=1, **labels):
+        if n < 0:
+            raise ValueError("Counters can only go up")
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + n
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self._key(labels)] = value
+
+    def inc(self, n=1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + n
+
+    def dec(self, n=1, **labels):
+        self.inc(-n, **labels)
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        if "le" in labels:
+            raise ValueError("The le label is reserved for histograms")
+        self.buckets = tuple(sorted(buckets))
+        Metric.__init__(self, name, documentation, labels)
+
+    def initial(self):
+        # Per bucket counts (not cumulative), then sum and count
+        return [[0] * len(self.buckets), 0, 0]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        h = self.values.get(key)
+        if h is None:
+            h = self.values[key] = self.initial()
+        i = bisect.bisect_left(self.buckets, value)
+        if i < len(self.buckets):
+            h[0][i] += 1
+        h[1] += value
+        h[2] += 1
+
+    def time(self, **labels):
+        return Timer(self, labels)
+
+    def get(self, **labels):
+        """Number of observations"""
+        h = self.values.get(self._key(labels))
+        return h[2] if h else 0
+
+    def samples(self):
+        for key, (counts, total, count) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                yield self.name + "_bucket", _labels(
+                    self.labelnames, key, ("le", _value(float(bound)))
+                ), cumulative
+            yield self.name + "_bucket", _labels(
+                self.labelnames, key, ("le", "+Inf")), count
+            yield self.name + "_sum", _labels(self.labelnames, key), total
+            yield self.name + "_count", _labels(self.labelnames, key), count
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = {}
+
+    def _get_or_create(self, cls, name, documentation, labels, **kwargs):
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = cls(name, documentation, labels,
+                                              **kwargs)
+        elif type(metric) is not cls or \
+                metric.labelnames != tuple(labels):
+            raise ValueError("Metric %s already registered differently" %
+                             name)
+        return metric
+
+    def counter(self, name, documentation, labels=()):
+        return self._get_or_create(Counter, name, documentation, labels)
+
+    def gauge(self, name, documentation, labels=()):
+        return self._get_or_create(Gauge, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, documentation, labels,
+                                   buckets=buckets)
+
+    def exposition(self):
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].exposition())
+        return "\n".join(lines) + "\n"
+
+registry = Registry()
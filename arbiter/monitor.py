@@ -7,59 +7,69 @@ import time
 
 from arbiter.backends import analysis_backends
 from arbiter.component import Component
-from arbiter.dashboard import ui_broadcast_ws, ui_data_list, send
+from arbiter.dashboard import ui_broadcast_ws, publish
 from arbiter.database import DbSession, DbBounty, DbArtifact
 from arbiter.events import event, periodic, periodicx
+from arbiter.metrics import registry
+from arbiter.offload import measure_hub_latency
 
 log = logging.getLogger(__name__)
 
+errors = registry.counter("arbiter_errors", "Errors logged")
+started = registry.gauge("arbiter_started", "Start time of the arbiter")
+polyswarm_block = registry.gauge("polyswarm_block", "Last block seen")
+jobs_submitted = registry.counter(
+    "arbiter_jobs_submitted", "Jobs submitted to analysis backends")
+artifacts_completed = registry.counter(
+    "arbiter_artifacts_completed", "Jobs completed by analysis backends")
+artifact_verdicts = registry.counter(
+    "arbiter_artifact_verdicts", "Final artifact verdicts", ["verdict"])
+votes = registry.counter("arbiter_voted", "Bounties voted on")
+polyswarm_settled = registry.counter(
+    "polyswarm_settled", "Bounties settled by this arbiter")
+backend_http = dict((k, registry.gauge(
+    "arbiter_backend_http_%s" % k,
+    "Analysis backend HTTP session: %s" % k.replace("_", " "),
+    ["backend"])) for k in (
+        "requests", "errors", "pools", "connections_opened",
+        "connections_in_use", "pool_requests"))
+dashboard_clients = registry.gauge(
+    "arbiter_dashboard_clients", "Connected dashboard clients")
+dashboard_queued = registry.gauge(
+    "arbiter_dashboard_queued", "Unsent dashboard messages")
+dashboard_queued_max = registry.gauge(
+    "arbiter_dashboard_queued_max",
+    "Unsent dashboard messages of the slowest client")
+
 def broadcast(kind, data, remember=True):
-    if remember:
-        ui_data_list[kind] = data
-    for c in ui_broadcast_ws:
-        gevent.spawn(send, c, kind, data)
+    publish(kind, data, remember)
 
 class PrometheusMonitor:
-    def __init__(self):
+    """Serves the metrics registry in the Prometheus text format, and counts
+    the errors logged."""
+
+    def __init__(self, registry=registry):
         self.level = logging.ERROR  # Terrible hack
-        self.metrics = {"arbiter_errors": 0,
-                        "arbiter_jobs_submitted": 0,
-                        "arbiter_artifact_malicious": 0,
-                        "arbiter_artifact_safe": 0,
-                        "arbiter_artifact_dontknow": 0,
-                        "arbiter_bad_verdict": 0,
-                        "arbiter_good_verdict": 0,
-                        "arbiter_no_verdict": 0,
-                        "polyswarm_settled": 0,
-                        "arbiter_artifacts_completed": 0}
-        self.errors = 0
+        self.registry = registry
 
     def server(self, bind):
-        self.track("arbiter_started", int(time.time()))
+        started.set(int(time.time()))
         host, port = bind.split(":")
         s = gevent.pywsgi.WSGIServer((host, int(port)), self, log=None)
         s.serve_forever()
 
     def handle(self, record):
         if record.levelno >= logging.ERROR:
-            self.errors += 1
-            self.track("arbiter_errors", self.errors)
-
-    def track(self, key, value):
-        self.metrics[key] = value
-
-    def count(self, key, n=1):
-        self.metrics[key] = self.metrics.get(key, 0) + n
+            errors.inc()
 
     def __call__(self, environ, start_response):
         if environ.get("PATH_INFO") != "/probe":
             start_response("404 Not Found", [])
             return []
-        start_response("200 OK", [("Content-Type", "text/plain")])
-        r = ""
-        for k, v in self.metrics.items():
-            r += "%s %s\n" % (k, v)
-        return [r.encode("utf8")]
+        start_response("200 OK", [
+            ("Content-Type", "text/plain; version=0.0.4; charset=utf-8"),
+        ])
+        return [self.registry.exposition().encode("utf8")]
 
 class MonitorComponent(Component):
     def __init__(self, parent):
@@ -69,6 +79,7 @@ class MonitorComponent(Component):
         self.metrics = PrometheusMonitor()
         logging.getLogger().addHandler(self.metrics)
         gevent.spawn(self.metrics.server, parent.config.monitor_bind)
+        gevent.spawn(measure_hub_latency)
 
         # We keep track of the starting time of polyswarmd such that we can
         # reset (i.e., early exit) the Arbiter if we're in testing mode (i.e.,
@@ -76,10 +87,16 @@ class MonitorComponent(Component):
         self.testing_mode = parent.config.testing_mode
         self.start_time = None
 
+        # Last health check report per analysis backend
+        self.backends = {}
+
+        # Dashboard counters, by name
+        self.counters = {}
+
     @event("block")
     def block(self, block_number):
         broadcast("counter-block", block_number)
-        self.metrics.track("polyswarm_block", block_number)
+        polyswarm_block.set(block_number)
 
     @event("connected")
     def connected(self, data):
@@ -95,24 +112,25 @@ class MonitorComponent(Component):
 
     @event("metrics_simple")
     def metrics_simple(self, key):
-        self.metrics.count(key, 1)
+        registry.counter(key, "Occurrences of %s" % key).inc()
 
     @event("metrics_jobs_submitted")
     def metrics_jobs_submitted(self, num_jobs):
-        self.metrics.count("arbiter_jobs_submitted", num_jobs)
+        jobs_submitted.inc(num_jobs)
 
     @event("metrics_artifact_complete")
     def metrics_artifact_complete(self, num_artifacts):
-        self.metrics.count("arbiter_artifacts_completed", num_artifacts)
+        artifacts_completed.inc(num_artifacts)
 
     @event("metrics_artifact_verdict")
-    def metrics_artifact_complete(self, verdict):
+    def metrics_artifact_verdict(self, verdict):
+        self._count("counter-artifacts-processing", -1)
         if verdict is None:
-            self.metrics.count("arbiter_artifact_dontknow", 1)
+            artifact_verdicts.inc(verdict="dontknow")
         elif verdict == 100:
-            self.metrics.count("arbiter_artifact_malicious", 1)
+            artifact_verdicts.inc(verdict="malicious")
         elif verdict == 0:
-            self.metrics.count("arbiter_artifact_safe", 1)
+            artifact_verdicts.inc(verdict="safe")
 
     @event("bounty_manual")
     def bounty_manual(self, guid):
@@ -122,39 +140,78 @@ class MonitorComponent(Component):
     @event("bounty_voted")
     def bounty_voted(self, guid, value):
         broadcast("bounties-voted", {"guid": guid, "value": value}, False)
-        self.metrics.count("arbiter_voted")
+        votes.inc()
+
+    @event("bounty_new")
+    def bounty_new(self, guid, num_artifacts):
+        self._count("counter-artifacts-processing", num_artifacts)
 
     @event("bounty_settled")
     def bounty_settled(self, guid):
         broadcast("bounties-settled", {"guid": guid}, False)
-        #self.metrics.count("arbiter_settled")
+        self._count("counter-bounties-settled", 1)
 
     @event("polyswarm_bounty_settled")
     def polyswarm_bounty_settled(self, guid):
-        self.metrics.count("polyswarm_settled")
+        polyswarm_settled.inc()
 
     @periodic(minutes=1)
     def nonce_check(self):
         self.polyswarm.nonce_sync()
 
+    @periodic(minutes=1)
+    def http_pool_stats(self):
+        for name, ab in analysis_backends.items():
+            for k, v in ab.session.stats().items():
+                backend_http[k].set(v, backend=name)
+
+    @periodic(seconds=15)
+    def dashboard_stats(self):
+        queued = [len(c.queue) for c in ui_broadcast_ws.values()]
+        dashboard_clients.set(len(queued))
+        dashboard_queued.set(sum(queued))
+        dashboard_queued_max.set(max(queued or [0]))
+
+    def _health_check(self, ab):
+        try:
+            data = ab.health_check()
+        except Exception as e:
+            log.error("Failed to perform health check on %s: %s",
+                      ab.breaker.name, e)
+            ab.breaker.failure()
+            return {"name": ab.name, "error": str(e)}
+
+        ab.breaker.success()
+        report = {"name": ab.name, "error": False}
+        if data:
+            report.update(data)
+        return report
+
+    def _circuit_state(self, name, report):
+        ab = analysis_backends[name]
+        report["circuit"] = ab.breaker.state
+        if ab.fallback:
+            report["fallback_circuit"] = ab.fallback.breaker.state
+
     @periodicx(minutes=5)
     def health_check(self):
         backends = {}
         for name, ab in analysis_backends.items():
-            try:
-                data = ab.health_check()
-            except Exception as e:
-                log.error("Failed to perform health check on %s: %s", name, e)
-                backends[name] = {"name": name, "error": str(e)}
-                continue
-
-            report = {"name": name, "error": False}
-            if data:
-                report.update(data)
-            backends[name] = report
+            backends[name] = self._health_check(ab)
+            if ab.fallback:
+                self._health_check(ab.fallback)
+            self._circuit_state(name, backends[name])
 
+        self.backends = backends
         broadcast("backends", backends)
 
+    @event("backend_circuit")
+    def backend_circuit(self, name, is_fallback, state):
+        if name not in self.backends:
+            return
+        self._circuit_state(name, self.backends[name])
+        broadcast("backends", self.backends)
+
     @event("wallet_balance_info")
     def wallet_balance_info(self, nct, eth):
         # Home chain values
@@ -163,22 +220,37 @@ class MonitorComponent(Component):
                   "eth": eth[1]}
         broadcast("wallet", wallet)
 
-    @periodicx(seconds=30)
-    def counters(self):
-        # TODO: update on trigger
-        counters = []
+    def _counter(self, key, value):
+        """Update a dashboard counter; clients only hear about changes"""
+        self.counters[key] = value
+        broadcast(key, value)
+
+    def _count(self, key, n):
+        self._counter(key, max(0, self.counters.get(key, 0) + n))
+
+    @periodicx(minutes=5)
+    def reconcile_counters(self):
+        """The counters are kept up to date by events. Correct any drift
+        (e.g. bounties settled twice) with the cheap, indexed count of
+        unprocessed artifacts, and seed them on startup."""
         s = DbSession()
         try:
-            c = s.query(DbBounty.id).filter_by(settled=True).count()
-            counters.append(("counter-bounties-settled", c))
+            processing = s.query(DbArtifact.id) \
+                .filter_by(processed=False).count()
+        finally:
+            s.close()
 
-            c = s.query(DbArtifact.id).filter_by(processed=False).count()
-            counters.append(("counter-artifacts-processing", c))
+        self._counter("counter-artifacts-processing", processing)
+        self._counter("counter-backends-running", len(analysis_backends))
+        self._counter("counter-errors", 0)
 
-            counters.append(("counter-backends-running", len(analysis_backends)))
-            counters.append(("counter-errors", 0))
+    @periodicx(hours=1)
+    def reconcile_settled(self):
+        """Counting the settled bounties has to go through most of the
+        table, so it is done rarely"""
+        s = DbSession()
+        try:
+            c = s.query(DbBounty.id).filter_by(settled=True).count()
         finally:
             s.close()
-
-        for k, c in counters:
-            broadcast(k, c)
+        self._counter("counter-bounties-settled", c)
@@ -0,0 +1,72 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+"""
+Runs CPU-bound work (transaction signing, hashing large files) in a small
+pool of native threads, so the gevent hub keeps serving websockets and
+HTTP requests meanwhile. The GIL is handed over between threads at short
+intervals, which bounds how long the hub can be held up.
+
+    result = offload.spawn(sign, tx)  # AsyncResult
+    signed = result.get()             # or offload.run(sign, tx)
+"""
+
+import gevent
+import gevent.threadpool
+import time
+
+from arbiter.metrics import registry
+
+# Threads for offloaded work
+POOL_SIZE = 4
+
+offload_time = registry.histogram(
+    "arbiter_offload_seconds", "Time offloaded tasks took, including the "
+    "wait for a thread", ["task"])
+offload_queued = registry.gauge(
+    "arbiter_offload_queued", "Offloaded tasks waiting for a thread")
+hub_latency = registry.histogram(
+    "arbiter_hub_latency_seconds", "How late the event loop wakes up "
+    "sleeping greenlets", buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                                   0.1, 0.25, 0.5, 1, 2.5, 5))
+
+pool = gevent.threadpool.ThreadPool(POOL_SIZE)
+# Offloaded tasks that have not finished yet
+in_flight = 0
+
+def configure(size):
+    pool.maxsize = size
+
+def spawn(fn, *args, **kwargs):
+    """Run fn in a worker thread; returns an AsyncResult. Metrics are only
+    updated from the hub, when the result comes in, as they aren't safe to
+    update from other threads."""
+    global in_flight
+    start = time.time()
+    result = pool.spawn(fn, *args, **kwargs)
+    in_flight += 1
+    _update_queued()
+    result.rawlink(lambda r: _done(start, fn.__name__))
+    return result
+
+def _done(start, task):
+    global in_flight
+    in_flight -= 1
+    _update_queued()
+    offload_time.observe(time.time() - start, task=task)
+
+def _update_queued():
+    # Every thread takes a task, the rest waits
+    offload_queued.set(max(0, in_flight - pool.maxsize))
+
+def run(fn, *args, **kwargs):
+    """Run fn in a worker thread, and wait for its result"""
+    return spawn(fn, *args, **kwargs).get()
+
+def measure_hub_latency(interval=0.5):
+    """Sleep for interval repeatedly and record the overshoot, which is the
+    time the event loop was kept busy by others"""
+    while True:
+        start = time.time()
+        gevent.sleep(interval)
+        hub_latency.observe(max(0, time.time() - start - interval))
@@ -1,53 +1,54 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
+import gevent
 import logging
+import re
 import requests
 import six
 import time
 
-from gevent.lock import Semaphore
-from gevent.subprocess import Popen, PIPE
+from gevent.lock import BoundedSemaphore, Semaphore
 from web3.auto import w3 as web3
-from urllib.parse import quote
-from json import dumps, loads, JSONDecodeError
+
+from arbiter import offload
+from arbiter.httpclient import PooledSession
+from arbiter.metrics import registry
 
 log = logging.getLogger(__name__)
 
-def _quote(v):
-    if isinstance(v, bytes):
-        v = v.encode("utf8")
-    elif not isinstance(v, str):
-        v = "%s" % v
-    return quote(v)
-
-def request_with_curl(method, url, params, headers, json):
-    if params:
-        url += "?" + "&".join("%s=%s" % (k, _quote(v)) for k, v in params.items())
-    cmd = ["curl", "-s", "--connect-timeout", "3",
-           "--max-time", "30", "-X", method, url]
-    for kv in headers.items():
-        cmd.extend(["-H", "%s: %s" % kv])
-    if json:
-        cmd.extend(["-H", "Content-Type: application/json; charset=utf8"])
-        cmd.extend(["--data-raw", dumps(json)])
-    #print(" ".join(('"' + c + '"') if ' ' in c else c for c in cmd))
-    print(">>", cmd)
-    p = Popen(cmd, stdout=PIPE)
-    buf = b""
-    while True:
-        tmp = p.stdout.read(4096)
-        if tmp == b"":
-            break
-        buf += tmp
-    p.wait()
-    print("<<", buf)
-    if buf == b"":
-        return {"errors": "no data returned (timeout?)", "status":"FAIL"}
-    try:
-        return loads(buf.decode("utf8"))
-    except JSONDecodeError:
-        return {"errors": str(buf), "status":"FAIL"}
+api_time = registry.histogram(
+    "polyswarm_api_seconds", "PolySwarm API call time",
+    ["method", "endpoint", "result"])
+api_errors = registry.counter(
+    "polyswarm_api_errors", "Failed PolySwarm API calls",
+    ["method", "endpoint", "error"])
+api_wait = registry.histogram(
+    "polyswarm_api_wait_seconds",
+    "Time PolySwarm API calls waited for a free slot")
+api_in_flight = registry.gauge(
+    "polyswarm_api_in_flight", "PolySwarm API calls in progress")
+api_cache_requests = registry.counter(
+    "polyswarm_api_cache_requests", "Cached PolySwarm API results used, "
+    "by whether they were fresh, stale (being refreshed) or missing",
+    ["name", "result"])
+
+# PolySwarm API calls in progress at once
+API_CONCURRENCY = 64
+
+# Seconds to keep rarely changing results before refreshing them
+PARAMETERS_TTL = 600
+STATUS_TTL = 10
+STAKING_TTL = 60
+# Seconds before a failed refresh is tried again
+REFRESH_RETRY = 10
+
+r_path_id = re.compile(r"^(0x)?[0-9a-fA-F-]{16,}$")
+
+def _endpoint(path):
+    """API path without GUIDs and addresses, e.g. bounties/:id/vote"""
+    return "/".join(":id" if r_path_id.match(part) else part
+                    for part in path.split("/"))
 
 class PolySwarmError(Exception):
     def __init__(self, status, message, reason=""):
@@ -61,12 +62,94 @@ class PolySwarmError(Exception):
 class PolySwarmNotFound(PolySwarmError):
     pass
 
-class DummyLock:
+class Limiter(object):
+    """Bounds the number of calls in progress (no bound if size is 0), and
+    records how long callers wait for their turn"""
+
+    def __init__(self, size):
+        self.size = size
+        self.semaphore = BoundedSemaphore(size) if size else None
+
     def __enter__(self):
+        if self.semaphore is not None:
+            with api_wait.time():
+                self.semaphore.acquire()
+        api_in_flight.inc()
         return self
 
     def __exit__(self, typ, value, traceback):
-        pass
+        api_in_flight.dec()
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+class CachedCall(object):
+    """The result of an API call, kept for ttl seconds. Once it is older, the
+    old result is still returned while it is refreshed in the background,
+    so only the first call, and the first after invalidate(), waits for the
+    network. With invalidate_on_error, a failed refresh invalidates the old
+    value rather than keeping it."""
+
+    def __init__(self, name, fetch, ttl, on_change=None,
+                 invalidate_on_error=False):
+        self.name = name
+        self.fetch = fetch
+        self.ttl = ttl
+        self.on_change = on_change
+        self.invalidate_on_error = invalidate_on_error
+        self.value = None
+        self.fetched = False
+        self.invalid = False
+        self.expires = 0
+        self.lock = Semaphore()
+        self.refreshing = None
+
+    def get(self):
+        if not self.fetched or self.invalid:
+            api_cache_requests.inc(name=self.name, result="miss")
+            return self.refresh(force=False)
+        if time.time() >= self.expires:
+            api_cache_requests.inc(name=self.name, result="stale")
+            if self.refreshing is None:
+                self.refreshing = gevent.spawn(self._refresh_background)
+        else:
+            api_cache_requests.inc(name=self.name, result="fresh")
+        return self.value
+
+    def refresh(self, force=True):
+        """Fetch the current value now. Without force, a value fetched by a
+        concurrent call while waiting is used instead."""
+        with self.lock:
+            if self.fetched and not self.invalid and not force:
+                return self.value
+            # Invalidated again if that happens while fetching
+            invalid, self.invalid = self.invalid, False
+            try:
+                value = self.fetch()
+            except:
+                self.invalid = self.invalid or invalid
+                raise
+            changed = self.fetched and value != self.value
+            self.value = value
+            self.fetched = True
+            self.expires = time.time() + self.ttl
+        if changed and self.on_change:
+            self.on_change(value)
+        return value
+
+    def _refresh_background(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            log.warning("Failed to refresh %s: %s", self.name, e)
+            if self.invalidate_on_error:
+                self.invalidate()
+            self.expires = time.time() + min(self.ttl, REFRESH_RETRY)
+        finally:
+            self.refreshing = None
+
+    def invalidate(self):
+        """The value is out of date: the next call waits for a new one"""
+        self.invalid = True
 
 class PolySwarmAPI(object):
     def __init__(self, config):
@@ -79,7 +162,8 @@ class PolySwarmAPI(object):
         self.minimum_stake = config.minimum_stake
         self.account_privkey = config.addr_privkey
 
-        a = web3.eth.account.privateKeyToAccount(config.addr_privkey)
+        a = offload.run(web3.eth.account.privateKeyToAccount,
+                        config.addr_privkey)
         self.account = a.address
         if config.addr and self.account != config.addr:
             log.warn("Oops, you didn't configure the correct public key!")
@@ -87,11 +171,36 @@ class PolySwarmAPI(object):
         log.info("Public key: %s", self.account)
         self.base_nonce = {"side": 0, "home": 0}
         self.base_nonce_lock = Semaphore()
-
+        self.configure_http(config.polyswarmd_http)
+
+        self.cached_params = CachedCall(
+            "parameters", lambda: self("get", "bounties/parameters"),
+            PARAMETERS_TTL, self._log_params)
+        # Short lived, and never kept once the host stopped responding
+        self.cached_status = CachedCall(
+            "status", lambda: self("get", "status"), STATUS_TTL,
+            invalidate_on_error=True)
+        self.cached_staking = dict((kind, CachedCall(
+            "staking_" + kind,
+            lambda kind=kind: self.balance("staking/" + kind, chain="home"),
+            STAKING_TTL)) for kind in ("total", "withdrawable"))
+
+    def configure_http(self, conf):
+        """Set up the keep-alive connection pool and concurrency limit from
+        the optional pool_size, connect_timeout, read_timeout, retries and
+        concurrency keys. Only GET requests are retried, as polyswarmd
+        may have acted on any other request that failed. Requests through
+        polyproxy have no read timeout and no concurrency limit by default,
+        as it signs transactions on our behalf."""
         if self.polyproxy:
-            self.lock = DummyLock()
+            defaults = {"read_timeout": None, "concurrency": 0}
         else:
-            self.lock = Semaphore(64)
+            defaults = {"read_timeout": 30, "concurrency": API_CONCURRENCY}
+        concurrency = conf.get("concurrency", defaults["concurrency"])
+        self.session = PooledSession.from_config(
+            conf, pool_size=concurrency or API_CONCURRENCY,
+            read_timeout=defaults["read_timeout"], retry_methods=("GET",))
+        self.lock = Limiter(concurrency)
 
     def wait_online(self, tries=30):
         for _ in range(tries):
@@ -104,7 +213,7 @@ class PolySwarmAPI(object):
         raise IOError("Polyswarm host at %s not online" % self.host)
 
     def status(self):
-        return self("get", "status")
+        return self.cached_status.get()
 
     def set_base_nonce(self):
         with self.base_nonce_lock:
@@ -126,11 +235,22 @@ class PolySwarmAPI(object):
                 log.error("Home nonce forwarded: %s", side)
 
     def set_params(self):
-        params = self("get", "bounties/parameters")
-        self.reveal_window = params["assertion_reveal_window"]
-        log.info("Assertion reveal window: %s", self.reveal_window)
-        self.vote_window = params["arbiter_vote_window"]
-        log.info("Vote window: %s", self.vote_window)
+        """Fetch the bounty parameters, which are refreshed in the
+        background from then on"""
+        self._log_params(self.cached_params.refresh())
+
+    def _log_params(self, params):
+        log.info("Assertion reveal window: %s",
+                 params["assertion_reveal_window"])
+        log.info("Vote window: %s", params["arbiter_vote_window"])
+
+    @property
+    def reveal_window(self):
+        return self.cached_params.get()["assertion_reveal_window"]
+
+    @property
+    def vote_window(self):
+        return self.cached_params.get()["arbiter_vote_window"]
 
     def check_staking_requirements(self):
         staking_balance = int(self.staking_balance_total())
@@ -154,17 +274,21 @@ class PolySwarmAPI(object):
         return self("get", "balances/%s/%s" % (account, kind), params=p)
 
     def staking_deposit(self, amount):
-        return self.req_and_sign(
-            "post", "staking/deposit",
-            {"amount": str(amount)},
-            {"chain": "home"}
-        )
+        try:
+            return self.req_and_sign(
+                "post", "staking/deposit",
+                {"amount": str(amount)},
+                {"chain": "home"}
+            )
+        finally:
+            for cached in self.cached_staking.values():
+                cached.invalidate()
 
     def staking_balance_total(self):
-        return self.balance("staking/total", chain="home")
+        return self.cached_staking["total"].get()
 
     def staking_balance_withdrawable(self):
-        return self.balance("staking/withdrawable", chain="home")
+        return self.cached_staking["withdrawable"].get()
 
     def bounty(self, guid):
         return self("get", "bounties/%s" % guid)
@@ -204,8 +328,7 @@ class PolySwarmAPI(object):
             {"chain": chain}
         )
 
-    def __call__(self, method, path, body=None, params=None, session=None):
-        func = getattr(requests, method)
+    def __call__(self, method, path, body=None, params=None):
         headers = {"Authorization": "Bearer %s" % self.apikey}
         params = params or {}
         params["account"] = self.account
@@ -215,35 +338,51 @@ class PolySwarmAPI(object):
         #if body: log.debug("Payload: %r", body)
 
         addr = "https://%s/%s" % (self.host, path)
-        kwargs = {"timeout": (10, 30)}
         if self.polyproxy:
             addr = "http://%s/%s" % (self.polyproxy, path)
-            kwargs = {}
 
-        resp = func(
-            addr, json=body,
-            params=params, headers=headers,
-            **kwargs
-        )
+        endpoint = _endpoint(path)
+        with self.lock:
+            start = time.time()
+            result = "error"
+            try:
+                resp = self.session.request(
+                    method.upper(), addr, json=body,
+                    params=params, headers=headers
+                )
+                result = str(resp.status_code)
+            except requests.RequestException:
+                api_errors.inc(method=method, endpoint=endpoint,
+                               error="connection")
+                raise
+            finally:
+                api_time.observe(time.time() - start, method=method,
+                                 endpoint=endpoint, result=result)
 
         status_code = resp.status_code
         if status_code == 404:
+            api_errors.inc(method=method, endpoint=endpoint,
+                           error="not_found")
             raise PolySwarmNotFound(resp.status_code, resp.reason)
         try:
             r = resp.json()
         except ValueError:
             # XXX
             log.error("Invalid JSON! Status: %s Text: %s", resp.status_code, resp.text)
+            api_errors.inc(method=method, endpoint=endpoint,
+                           error="invalid_json")
             raise PolySwarmError(resp.status_code, resp.reason)
 
         if r.get("status") != "OK":
             #msg = "%s: %s" % (r.get("status"), r.get("errors"))
             msg = str(r)
+            api_errors.inc(method=method, endpoint=endpoint, error="api")
             raise PolySwarmError(status_code, msg)
 
         elif status_code < 200 or status_code > 299:
             # Error, but not explicit status?
             #log.error("Status: %s Text: %s", status_code, resp.text)
+            api_errors.inc(method=method, endpoint=endpoint, error="status")
             raise PolySwarmError(status_code, "Bad status")
 
         return r.get("result")
@@ -270,11 +409,12 @@ class PolySwarmAPI(object):
                 with self.base_nonce_lock:
                     self.base_nonce[chain] += diff
 
-        for transaction in transactions:
-            s = web3.eth.account.signTransaction(
-                transaction, self.account_privkey
-            )
-            signed.append(bytes(s["rawTransaction"]).hex())
+        # Signing takes long enough to hold up the event loop
+        pending = [offload.spawn(web3.eth.account.signTransaction,
+                                 transaction, self.account_privkey)
+                   for transaction in transactions]
+        for s in pending:
+            signed.append(bytes(s.get()["rawTransaction"]).hex())
 
         r = self(
             "post", "transactions",
@@ -0,0 +1,135 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+"""
+Processed artifact counts, pre-aggregated per time bucket at several
+resolutions, so the dashboard chart doesn't have to group the artifacts
+table. Counts are collected in memory as artifacts are finalized and
+upserted periodically.
+"""
+
+import collections
+import logging
+import time
+
+from sqlalchemy import Integer, cast, func, literal
+from sqlalchemy.dialects.postgresql import insert
+
+from arbiter.database import DbSession, DbArtifact, DbArtifactRate
+from arbiter.utils import interval
+
+log = logging.getLogger(__name__)
+
+# Bucket sizes in seconds, and how long buckets are kept (None: forever)
+RESOLUTIONS = (60, 600, 3600, 86400)
+RETENTION = {
+    60: 2 * 86400,
+    600: 30 * 86400,
+    3600: 400 * 86400,
+    86400: None,
+}
+
+def retained(resolution, start, now=None):
+    """Whether buckets of resolution are still kept from start on"""
+    keep = RETENTION[resolution]
+    if keep is None:
+        return True
+    return interval(start, resolution) >= (now or time.time()) - keep
+
+def choose_resolution(start, end, max_points, now=None):
+    """Finest resolution that has been kept since start, with at most
+    max_points buckets between start and end"""
+    for resolution in RESOLUTIONS:
+        if (end - start) / resolution <= max_points and \
+                retained(resolution, start, now):
+            return resolution
+    return RESOLUTIONS[-1]
+
+class RateRollup(object):
+    def __init__(self):
+        # (resolution, interval) -> count not yet written to the database
+        self.pending = collections.Counter()
+
+    def add(self, t, n=1):
+        for resolution in RESOLUTIONS:
+            self.pending[resolution, interval(t, resolution)] += n
+
+    def flush(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, collections.Counter()
+
+        stmt = insert(DbArtifactRate)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[DbArtifactRate.resolution,
+                            DbArtifactRate.interval],
+            set_={"count": DbArtifactRate.count + stmt.excluded.count})
+        rows = [{"resolution": r, "interval": i, "count": n}
+                for (r, i), n in pending.items()]
+        s = DbSession()
+        try:
+            s.execute(stmt, rows)
+            s.commit()
+        except:
+            # Try again next time
+            self.pending.update(pending)
+            raise
+        finally:
+            s.close()
+
+    def prune(self, now=None):
+        now = now or time.time()
+        s = DbSession()
+        try:
+            for resolution, keep in RETENTION.items():
+                if keep is None:
+                    continue
+                s.query(DbArtifactRate) \
+                    .filter_by(resolution=resolution) \
+                    .filter(DbArtifactRate.interval < now - keep) \
+                    .delete(synchronize_session=False)
+            s.commit()
+        finally:
+            s.close()
+
+    def backfill(self):
+        """Build the rollup from the artifacts table, if it is empty (e.g.
+        after an upgrade)."""
+        s = DbSession()
+        try:
+            if s.query(DbArtifactRate.resolution).first() is not None:
+                return
+            epoch = func.extract("epoch", DbArtifact.processed_at)
+            for resolution in RESOLUTIONS:
+                bucket = cast((func.floor(epoch / resolution) + 1) *
+                              resolution, Integer)
+                rows = s.query(literal(resolution), bucket, func.count(1)) \
+                    .filter(DbArtifact.processed_at.isnot(None)) \
+                    .group_by(bucket)
+                s.execute(insert(DbArtifactRate).from_select(
+                    ["resolution", "interval", "count"], rows.statement))
+            s.commit()
+            log.info("Built artifact rate rollup from the artifacts table")
+        finally:
+            s.close()
+
+    def query(self, resolution, start, end):
+        """[interval, count] for the buckets that overlap start..end, in
+        order. Buckets without artifacts are left out."""
+        s = DbSession()
+        try:
+            rows = s.query(DbArtifactRate.interval, DbArtifactRate.count) \
+                .filter_by(resolution=resolution) \
+                .filter(DbArtifactRate.interval > start) \
+                .filter(DbArtifactRate.interval < end + resolution) \
+                .all()
+        finally:
+            s.close()
+
+        counts = collections.Counter(dict(rows))
+        for (r, i), n in self.pending.items():
+            if r == resolution and start < i < end + resolution:
+                counts[i] += n
+        return [[i, counts[i]] for i in sorted(counts)]
+
+artifact_rates = RateRollup()
@@ -0,0 +1,295 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+"""
+Content-addressed artifact store. Files are kept by IPFS hash in 256
+shard directories, staged in the same directory as their final location,
+and evicted least recently used first when the store exceeds its byte
+budget. Files of artifacts that belong to active bounties are never
+evicted. New files are optionally compressed (see arbiter.compression),
+which is transparent to readers.
+"""
+
+import collections
+import datetime
+import hashlib
+import logging
+import os
+import re
+import time
+
+from arbiter.compression import (
+    get_codec, split_suffix, Compressor, DecompressingReader
+)
+from sqlalchemy import or_
+
+from arbiter.database import DbSession, DbBounty, DbArtifact
+from arbiter import offload
+from arbiter.metrics import registry
+from arbiter.utils import AtomicWrite
+
+log = logging.getLogger(__name__)
+
+r_valid_hash = re.compile(r"^[a-zA-Z0-9]+$")
+
+# Staged files older than this are left over from a crash
+STALE_STAGING = 3600
+
+CHUNK_SIZE = 65536
+
+store_requests = registry.counter(
+    "arbiter_store_requests", "Artifact store lookups", ["result"])
+store_evictions = registry.counter(
+    "arbiter_store_evictions", "Files evicted from the artifact store")
+store_bytes = registry.gauge(
+    "arbiter_store_bytes", "Size of the artifact store")
+store_files = registry.gauge(
+    "arbiter_store_files", "Files in the artifact store")
+
+def pinned_artifact_hashes(grace=0):
+    """IPFS hashes of the artifacts of active bounties, and of bounties
+    that were finished or aborted less than grace seconds ago"""
+    s = DbSession()
+    try:
+        pinned = DbBounty.status == "active"
+        if grace:
+            since = datetime.datetime.utcnow() - \
+                datetime.timedelta(seconds=grace)
+            pinned = or_(pinned, DbBounty.finished_at > since)
+        rows = s.query(DbArtifact.hash) \
+            .join(DbBounty, DbBounty.id == DbArtifact.bounty_id) \
+            .filter(pinned) \
+            .distinct()
+        return set(r.hash for r in rows)
+    finally:
+        s.close()
+
+def active_artifact_hashes():
+    """IPFS hashes of the artifacts of active bounties"""
+    return pinned_artifact_hashes()
+
+def _digest(fp):
+    """(SHA-256, length) of the content; fp is left open"""
+    h = hashlib.sha256()
+    length = 0
+    while True:
+        chunk = fp.read(CHUNK_SIZE)
+        if not chunk:
+            break
+        h.update(chunk)
+        length += len(chunk)
+    return h.hexdigest(), length
+
+class ArtifactStore(object):
+    def __init__(self, root, max_bytes=0, referenced=active_artifact_hashes,
+                 compression=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.referenced = referenced
+        # Codec for new files, None to store them as is
+        self.codec = get_codec(compression)
+        # hash -> [size, sha256 or None, codec, length of the content or
+        # None], least recently used first
+        self.index = collections.OrderedDict()
+        self.total = 0
+
+    def path(self, hash, codec=None):
+        if not r_valid_hash.match(hash):
+            raise ValueError("Invalid IPFS hash %r" % hash)
+        shard = hashlib.sha1(hash.encode("utf8")).hexdigest()[:2]
+        return os.path.join(self.root, shard,
+                            hash + (codec.suffix if codec else ""))
+
+    def _path(self, hash):
+        entry = self.index.get(hash)
+        return self.path(hash, entry[2] if entry else None)
+
+    def get(self, hash):
+        """Path of the file as stored, or None if it isn't stored"""
+        if hash in self.index:
+            path = self._path(hash)
+            if os.path.exists(path):
+                self.index.move_to_end(hash)
+                store_requests.inc(result="hit")
+                return path
+        self._forget(hash)
+        store_requests.inc(result="miss")
+
+    def open(self, hash):
+        """File object with the original content, or None if the file isn't
+        stored"""
+        path = self.get(hash)
+        if path is None:
+            return None
+        codec = self.index[hash][2]
+        if codec is None:
+            return open(path, "rb")
+        return DecompressingReader(open(path, "rb"), codec)
+
+    def writer(self, hash):
+        """Stage a new file; it is stored when the block completes"""
+        return StoreWrite(self, hash)
+
+    def _digest(self, hash):
+        """Index entry with the SHA-256 and length filled in, reading the
+        file only if that hasn't been done; None if it isn't stored"""
+        fp = self.open(hash)
+        if fp is None:
+            return None
+        entry = self.index[hash]
+        with fp:
+            if entry[1] is None or entry[3] is None:
+                entry[1], entry[3] = offload.run(_digest, fp)
+        return entry
+
+    def sha256(self, hash):
+        """SHA-256 of the file, hashing it only if that hasn't been done"""
+        entry = self._digest(hash)
+        return entry[1] if entry else None
+
+    def length(self, hash):
+        """Size of the original (uncompressed) content"""
+        entry = self._digest(hash)
+        return entry[3] if entry else None
+
+    def add(self, hash, sha256=None, codec=None, length=None):
+        """Register a file that has been moved into place"""
+        entry = self.index.get(hash)
+        if entry is not None and entry[2] is not codec:
+            # Stored again with other settings
+            try:
+                os.remove(self.path(hash, entry[2]))
+            except OSError:
+                pass
+        self._forget(hash)
+        size = os.path.getsize(self.path(hash, codec))
+        if codec is None:
+            length = size
+        self.index[hash] = [size, sha256, codec, length]
+        self.total += size
+        self._update_metrics()
+        if self.max_bytes and self.total > self.max_bytes:
+            # Not the file that is about to be used
+            self.evict(exclude=(hash,))
+
+    def _forget(self, hash):
+        entry = self.index.pop(hash, None)
+        if entry is not None:
+            self.total -= entry[0]
+
+    def _update_metrics(self):
+        store_bytes.set(self.total)
+        store_files.set(len(self.index))
+
+    def evict(self, exclude=()):
+        keep = set(exclude)
+        if self.referenced:
+            keep.update(self.referenced())
+        for hash in list(self.index):
+            if self.total <= self.max_bytes:
+                break
+            if hash not in keep and self._remove(hash):
+                store_evictions.inc()
+
+        if self.total > self.max_bytes:
+            log.warning("Artifact store is %s bytes over its budget, all "
+                        "remaining files are in use", self.total -
+                        self.max_bytes)
+        self._update_metrics()
+
+    def collect(self, keep):
+        """Remove all files except those in keep. Returns the number of
+        files and bytes removed."""
+        files = size = 0
+        for hash in list(self.index):
+            if hash in keep:
+                continue
+            entry = self.index[hash]
+            if self._remove(hash):
+                files += 1
+                size += entry[0]
+        self._update_metrics()
+        return files, size
+
+    def _remove(self, hash):
+        try:
+            os.remove(self._path(hash))
+        except OSError as e:
+            log.warning("Failed to remove artifact %s: %s", hash, e)
+            return False
+        self._forget(hash)
+        return True
+
+    def scan(self):
+        """Build the index from the files on disk, moving files from the
+        old flat layout into their shard"""
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if os.path.isfile(path) and r_valid_hash.match(name):
+                os.rename(path, self._prepare(name))
+                entries.append((name, None, os.stat(self.path(name))))
+            elif len(name) == 2 and os.path.isdir(path):
+                for fname in os.listdir(path):
+                    fpath = os.path.join(path, fname)
+                    st = os.stat(fpath)
+                    if fname.startswith(".tmp"):
+                        if now - st.st_mtime > STALE_STAGING:
+                            os.remove(fpath)
+                        continue
+                    hash, codec = split_suffix(fname)
+                    if r_valid_hash.match(hash):
+                        entries.append((hash, codec, st))
+
+        self.index.clear()
+        self.total = 0
+        entries.sort(key=lambda e: max(e[2].st_atime, e[2].st_mtime))
+        for hash, codec, st in entries:
+            if hash in self.index:
+                log.warning("Artifact %s is stored more than once, "
+                            "removing the older copy", hash)
+                os.remove(self._path(hash))
+                self._forget(hash)
+            self.index[hash] = [st.st_size, None, codec,
+                                None if codec else st.st_size]
+            self.total += st.st_size
+        log.info("Artifact store: %d files, %d bytes",
+                 len(self.index), self.total)
+        self._update_metrics()
+        if self.max_bytes and self.total > self.max_bytes:
+            self.evict()
+
+    def _prepare(self, hash, codec=None):
+        path = self.path(hash, codec)
+        shard = os.path.dirname(path)
+        if not os.path.isdir(shard):
+            os.makedirs(shard)
+        return path
+
+class StoreWrite(AtomicWrite):
+    """Hashes (and compresses) the data as it is written"""
+
+    def __init__(self, store, hash):
+        AtomicWrite.__init__(self, store._prepare(hash, store.codec))
+        self.store = store
+        self.hash = hash
+        self.codec = store.codec
+        self.compressor = Compressor(self.codec) if self.codec else None
+        self.digest = hashlib.sha256()
+        self.length = 0
+
+    def write(self, data):
+        self.digest.update(data)
+        self.length += len(data)
+        if self.compressor:
+            data = self.compressor.compress(data)
+        AtomicWrite.write(self, data)
+
+    def __exit__(self, typ, value, tb):
+        if value is None and self.compressor:
+            AtomicWrite.write(self, self.compressor.flush())
+        AtomicWrite.__exit__(self, typ, value, tb)
+        if value is None:
+            self.store.add(self.hash, self.digest.hexdigest(), self.codec,
+                           self.length)
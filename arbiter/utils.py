@@ -1,6 +1,7 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
+import collections
 import hashlib
 import hmac
 import logging
@@ -8,21 +9,33 @@ import os
 import tempfile
 import time
 
+# Tolerated clock difference for API token timestamps (seconds)
+TOKEN_CLOCK_SKEW = 300
+TOKEN_CACHE_TTL = 300
+
 class AtomicWrite:
-    def __init__(self, fname):
+    """Write to a hidden temporary file, and move it into place when done.
+    The file is staged in dir, which defaults to the directory of fname, so
+    the final rename never crosses a filesystem boundary."""
+
+    def __init__(self, fname, dir=None):
         self.fname = fname
+        self.dir = dir or os.path.dirname(os.path.abspath(fname))
         self.tmpfile = None
 
     def write(self, data):
         self.tmpfile.write(data)
 
     def __enter__(self):
-        self.tmpfile = tempfile.NamedTemporaryFile(delete=False)
+        self.tmpfile = tempfile.NamedTemporaryFile(
+            delete=False, dir=self.dir, prefix=".tmp"
+        )
         return self
 
     def __exit__(self, typ, value, tb):
         if not self.tmpfile:
             return
+        self.tmpfile.close()
         if value is not None:
             os.remove(self.tmpfile.name)
         else:
@@ -72,14 +85,25 @@ def generate_token(secret, backend, timestamp=None):
     h.update(text.encode("utf8"))
     return "%s%s" % (text, h.hexdigest())
 
-def validate_token(secret, token):
+def validate_token(secret, token, max_age=None, not_before=None, now=None):
+    """Returns the backend name if the token is valid. Tokens older than
+    max_age seconds or issued before the not_before timestamp (to rotate
+    tokens) are rejected."""
     parts = token.split(".")
     if len(parts) != 3:
         return False
     elif not parts[1].isdigit():
         return False
 
-    # TODO: add minimum token validity time, if needed
+    timestamp = int(parts[1])
+    if now is None:
+        now = time.time()
+    if timestamp > now + TOKEN_CLOCK_SKEW:
+        return False
+    if max_age and timestamp + max_age < now:
+        return False
+    if not_before and timestamp < not_before:
+        return False
 
     text = ".".join(parts[:2]) + "."
     h = hmac.new(secret, digestmod=hashlib.sha256)
@@ -88,6 +112,47 @@ def validate_token(secret, token):
         return parts[0]
     return False
 
+class TokenCache(object):
+    """Bounded cache of validated API tokens, so the HMAC isn't recomputed
+    for every request. Entries are kept for at most TOKEN_CACHE_TTL seconds,
+    and never beyond the validity of the token."""
+
+    def __init__(self, secret, max_age=None, not_before=None, size=256):
+        self.secret = secret
+        self.max_age = max_age
+        self.not_before = not_before
+        self.size = size
+        self.entries = collections.OrderedDict()
+
+    def validate(self, token):
+        now = time.time()
+        entry = self.entries.get(token)
+        if entry is not None:
+            backend, expires = entry
+            if now < expires:
+                self.entries.move_to_end(token)
+                return backend
+            del self.entries[token]
+
+        backend = validate_token(self.secret, token, self.max_age,
+                                 self.not_before, now)
+        if not backend:
+            # Don't let invalid tokens push out the valid ones
+            return backend
+
+        expires = now + TOKEN_CACHE_TTL
+        if self.max_age:
+            expires = min(expires, int(token.split(".")[1]) + self.max_age)
+        self.entries[token] = backend, expires
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+        return backend
+
+def interval(t, step_time=900):
+    """End of the step_time bucket that timestamp t falls in"""
+    t = int(t)
+    return t + step_time - (t % step_time)
+
 GRAYOUT = "\033[38;5;250m"
 ALERT = "\033[38;5;220m"
 RESET = "\033[0m"
@@ -8,35 +8,62 @@ Verdict states:
 * Submitting: being submitted, guards against parallel duplicated submission
 * Pending: currently awaiting response
 * Failed: analysis backend broke
+* Cancelled: verdict was made without it
 * Done: has a verdict
 """
 
 import datetime
 import gevent
+import itertools
 import logging
 import time
 
+from sqlalchemy import func
+
 from arbiter.artifacts import Artifact
 from arbiter.backends import analysis_backends
+from arbiter.cache import prefetching
+from arbiter.circuit import CIRCUIT_OPEN
 from arbiter.component import Component
 from arbiter.const import (
     JOB_STATUS_DONE, JOB_STATUS_NEW, JOB_STATUS_SUBMITTING,
-    JOB_STATUS_PENDING, JOB_STATUS_FAILED, VERDICT_DONTKNOW,
+    JOB_STATUS_PENDING, JOB_STATUS_FAILED, JOB_STATUS_CANCELLED,
+    VERDICT_DONTKNOW,
     VERDICT_SAFE, VERDICT_MAYBE, VERDICT_MALICIOUS
 )
-from arbiter.database import DbSession, DbArtifact, DbArtifactVerdict
-from arbiter.events import periodic, event, dispatch_event
-from arbiter.utils import pct_agree
+from arbiter.database import (
+    DbSession, DbBounty, DbArtifact, DbArtifactVerdict, work_seq
+)
+from arbiter.events import periodic, event, dispatch_event, trap_run
+from arbiter.metrics import registry
+from arbiter.rollup import artifact_rates
+from arbiter.utils import interval, pct_agree
 
 log = logging.getLogger(__name__)
 
-def interval(t, step_time=900):
-    t = int(t)
-    return t + step_time - (t % step_time)
-
-def vote_on_artifact(voters):
+# Early verdicts try 3^n combinations of pending votes
+MAX_EARLY_PENDING = 8
+
+submit_time = registry.histogram(
+    "arbiter_backend_submit_seconds",
+    "Time to submit an artifact to an analysis backend",
+    ["backend", "result"])
+
+def submit_artifact(a, av_id, artifact, previous_task):
+    start = time.time()
+    result = "error"
+    try:
+        r = a.submit_artifact(av_id, artifact, previous_task)
+        result = "ok"
+        return r
+    finally:
+        submit_time.observe(time.time() - start, backend=a.breaker.name,
+                            result=result)
+
+def vote_on_artifact(voters, verbose=True):
     """Weighted voting system. Certain trusted voters can shortcut the voting
     process on malicious samples."""
+    debug = log.debug if verbose else lambda *args: None
     high_confidence_malicious = False
 
     votes = 0
@@ -59,36 +86,88 @@ def vote_on_artifact(voters):
     if high_confidence_malicious:
         # We assume the backends are conservative, so if we trust this backend
         # has found sufficient evidence of malicious behavior, use this verdict
-        log.debug("Voted MALICIOUS because of positive high-confidence voter")
+        debug("Voted MALICIOUS because of positive high-confidence voter")
         return VERDICT_MALICIOUS
 
     if not pct_agree(0.5, total_votes, total_voters):
         # If too many voters abstain, we can't reach a verdict.
-        log.debug("Voted DONTKNOW because there are missing voters (%s/%s)",
-                  total_votes, total_voters)
+        debug("Voted DONTKNOW because there are missing voters (%s/%s)",
+              total_votes, total_voters)
         return VERDICT_DONTKNOW
 
     if pct_agree(0.6666, votes, total_weight):
         # 66.6% or higher
-        log.debug("Voted MALICIOUS because of majority voters (%s/%s)", votes,
-                  total_weight)
+        debug("Voted MALICIOUS because of majority voters (%s/%s)", votes,
+              total_weight)
         return VERDICT_MALICIOUS
 
     if pct_agree(0.6666, total_weight - votes, total_weight):
         # 33.3% or lower
-        log.debug("Voted SAFE because of majority voters (%s/%s)", votes,
-                  total_weight)
+        debug("Voted SAFE because of majority voters (%s/%s)", votes,
+              total_weight)
         return VERDICT_SAFE
 
-    log.debug("Voted DONTKNOW because of voters didn't agree (%s/%s)", votes,
-              total_weight)
+    debug("Voted DONTKNOW because of voters didn't agree (%s/%s)", votes,
+          total_weight)
     return VERDICT_DONTKNOW
 
+def vote_on_artifact_early(voters, pending):
+    """Check if the verdict can still change once the pending voters are in.
+    Returns a (decided, verdict) tuple.
+
+    Given the participating voters, the weighted score is monotonic in every
+    single vote, so it is enough to try the extremes (abstain, safe,
+    malicious) for each of the pending voters."""
+    pending = [name for name in pending if name in analysis_backends]
+    if len(pending) > MAX_EARLY_PENDING:
+        return False, None
+
+    outcomes = set()
+    options = (VERDICT_DONTKNOW, VERDICT_SAFE, VERDICT_MALICIOUS)
+    for votes in itertools.product(options, repeat=len(pending)):
+        v = dict(voters)
+        v.update(zip(pending, votes))
+        outcomes.add(vote_on_artifact(v, False))
+        if len(outcomes) > 1:
+            return False, None
+    return True, outcomes.pop()
+
 class VerdictComponent(Component):
     def __init__(self, parent):
         self.artifact_interval = parent.artifact_interval
         self.expires = parent.config.expires
         self.url = parent.config.url
+        self.vote_deadline = parent.config.vote_deadline_blocks
+        self.cur_block = parent.initial_block
+        # Earliest vote_before the deadline guard may have to act on; 0 if
+        # it has to be looked up
+        self.next_deadline = 0
+
+    def _artifact(self, a):
+        return Artifact(a.id, a.name, a.hash,
+                        "%s/artifact/%s" % (self.url, a.id), sha256=a.sha256)
+
+    def _download(self, artifact):
+        try:
+            artifact.download()
+            return True
+        except Exception as e:
+            log.warning("Holding jobs of artifact #%s, download failed: %s",
+                        artifact.id, e)
+            return False
+
+    def _cancel_jobs(self, jobs):
+        """Tell backends to stop working on (av_id, backend, artifact, task)
+        jobs, in the background."""
+        for av_id, backend, artifact, task in jobs:
+            a = analysis_backends.get(backend)
+            if not a:
+                continue
+            if task and task.get("fallback") and a.fallback:
+                a = a.fallback
+            log.debug("Cancelling job #%s of %s", av_id, backend)
+            gevent.spawn(trap_run, a.cancel_artifact, (av_id, artifact, task),
+                         {})
 
     @periodic(minutes=2)
     def expire_pending(self):
@@ -96,6 +175,7 @@ class VerdictComponent(Component):
         # TODO: preferably replace "arbitrary" timeout window with backend
         # polling
         notify_tasks = set()
+        cancel = []
         now = datetime.datetime.utcnow()
         s = DbSession()
         avs = s.query(DbArtifactVerdict).with_for_update() \
@@ -104,11 +184,82 @@ class VerdictComponent(Component):
         for av in avs:
             log.warning("Job %s expired", av.id)
             av.status = JOB_STATUS_FAILED
-            # TODO: call backend.cancel_artifact
             s.add(av)
             notify_tasks.add(av.artifact_id)
+            cancel.append((av.id, av.backend, av.artifact_id, av.meta))
         s.commit()
+        if cancel:
+            artifacts = {}
+            for a in s.query(DbArtifact).filter(DbArtifact.id.in_(notify_tasks)):
+                artifacts[a.id] = self._artifact(a)
+            cancel = [(av_id, backend, artifacts.get(aid), meta)
+                      for av_id, backend, aid, meta in cancel]
         s.close()
+        self._cancel_jobs(cancel)
+        for aid in notify_tasks:
+            dispatch_event("verdict_update", aid)
+
+    @event("block")
+    def block_updated(self, block_number):
+        if self.cur_block is not None and block_number <= self.cur_block:
+            return
+        self.cur_block = block_number
+        self.vote_deadline_guard()
+
+    @event("bounty_new")
+    def bounty_new(self, guid, num_artifacts):
+        # Its deadline may come before the one we are waiting for
+        self.next_deadline = 0
+
+    def vote_deadline_guard(self):
+        """Force a verdict from the results that are available for artifacts
+        of bounties that are about to close their voting window, so a slow
+        backend doesn't make us miss the vote."""
+        block = self.cur_block
+        if block + self.vote_deadline < self.next_deadline:
+            return
+
+        notify_tasks = set()
+        cancel = []
+        s = DbSession()
+        deadline = s.query(func.min(DbBounty.vote_before)) \
+            .filter(DbBounty.status == "active") \
+            .filter(DbBounty.truth_value.is_(None)) \
+            .filter(DbBounty.truth_manual.is_(False)) \
+            .filter(DbBounty.vote_before > block).scalar()
+        if deadline is None or deadline > block + self.vote_deadline:
+            # Nothing to do until then, or until a new bounty comes in
+            self.next_deadline = deadline or float("inf")
+            s.close()
+            return
+        self.next_deadline = 0
+
+        artifacts = s.query(DbArtifact) \
+            .join(DbBounty, DbBounty.id == DbArtifact.bounty_id) \
+            .filter(DbBounty.status == "active") \
+            .filter(DbBounty.truth_value.is_(None)) \
+            .filter(DbBounty.truth_manual.is_(False)) \
+            .filter(DbBounty.vote_before > block) \
+            .filter(DbBounty.vote_before <= block + self.vote_deadline) \
+            .filter(DbArtifact.processed.is_(False))
+        artifacts = dict((a.id, self._artifact(a)) for a in artifacts)
+        if artifacts:
+            avs = s.query(DbArtifactVerdict).with_for_update() \
+                .filter(DbArtifactVerdict.artifact_id.in_(list(artifacts))) \
+                .filter(DbArtifactVerdict.status > JOB_STATUS_DONE)
+            for av in avs:
+                log.warning("Job %s expired (vote deadline at block %s)",
+                            av.id, block)
+                if av.status == JOB_STATUS_PENDING:
+                    cancel.append((av.id, av.backend,
+                                   artifacts[av.artifact_id], av.meta))
+                av.status = JOB_STATUS_FAILED
+                av.expires = None
+                s.add(av)
+                notify_tasks.add(av.artifact_id)
+            s.commit()
+        s.close()
+        self._cancel_jobs(cancel)
         for aid in notify_tasks:
             dispatch_event("verdict_update", aid)
 
@@ -119,13 +270,14 @@ class VerdictComponent(Component):
         Conditions:
         * Failure was temporary
         * Bounty is not about to expire
+        * Artifact is not being prefetched (dispatched when it is)
         """
         s = DbSession()
-        avs = [a.artifact_id for a in
-               s.query(DbArtifactVerdict.artifact_id) \
-               .filter_by(status=JOB_STATUS_NEW)]
+        avs = set(a.artifact_id for a in
+                  s.query(DbArtifactVerdict.artifact_id) \
+                  .filter_by(status=JOB_STATUS_NEW))
         s.close()
-        for a in avs:
+        for a in sorted(avs - prefetching):
             dispatch_event("verdict_jobs", None, a)
 
     @event("verdict_update_async")
@@ -172,33 +324,69 @@ class VerdictComponent(Component):
 
         verdicts = s.query(DbArtifactVerdict).filter_by(artifact_id=artifact_id)
         bounty_id = artifact.bounty_id
-        incomplete = False
+        cancel = []
 
         verdict_map = {}
+        pending = []
         for verdict in verdicts.all():
             if verdict.status > JOB_STATUS_DONE:
-                incomplete = True
+                pending.append(verdict)
             verdict_map[verdict.backend] = verdict.verdict
 
-        if not incomplete:
+        if not pending:
             log.debug("Verdict for artifact #%s can be made: %r", artifact_id,
                       verdict_map)
-            verdict = vote_on_artifact(verdict_map)
+            decided, verdict = True, vote_on_artifact(verdict_map)
+        else:
+            decided, verdict = vote_on_artifact_early(
+                verdict_map, [av.backend for av in pending]
+            )
+            if decided:
+                log.debug("Verdict for artifact #%s can be made early, "
+                          "%s job(s) left: %r", artifact_id, len(pending),
+                          verdict_map)
+
+        if decided:
             log.debug("Verdict for artifact #%s: %r", artifact_id, verdict)
+            now = time.time()
             artifact.processed = True
             artifact.processed_at = datetime.datetime.utcnow()
-            artifact.processed_at_interval = interval(time.time(), self.artifact_interval)
+            artifact.processed_at_interval = interval(now, self.artifact_interval)
             artifact.verdict = verdict
             s.add(artifact)
+
+            # Redundant jobs; free up the analysis backends. Jobs may complete
+            # in the meantime, so only touch those that are still running.
+            if pending:
+                s.query(DbArtifactVerdict) \
+                    .filter(DbArtifactVerdict.id.in_([av.id for av in pending])) \
+                    .filter(DbArtifactVerdict.status > JOB_STATUS_DONE) \
+                    .update({DbArtifactVerdict.status: JOB_STATUS_CANCELLED,
+                             DbArtifactVerdict.expires: None},
+                            synchronize_session=False)
+            for av in pending:
+                if av.status == JOB_STATUS_PENDING:
+                    cancel.append((av.id, av.backend,
+                                   self._artifact(artifact), av.meta))
             s.commit()
+            artifact_rates.add(now)
             dispatch_event("metrics_artifact_verdict", verdict)
         else:
             log.debug("Verdict for artifact #%s incomplete", artifact_id)
             bounty_id = None
         s.close()
+        self._cancel_jobs(cancel)
         if bounty_id is not None:
             dispatch_event("bounty_artifact_verdict", bounty_id)
 
+    @periodic(seconds=30)
+    def flush_rates(self):
+        artifact_rates.flush()
+
+    @periodic(hours=1)
+    def prune_rates(self):
+        artifact_rates.prune()
+
     @event("verdict_jobs", serialize=False)
     def verdict_jobs(self, bounty_guid, artifact_id):
         """Jobs to submit or otherwise check"""
@@ -207,8 +395,7 @@ class VerdictComponent(Component):
         # Find jobs we need to submit, and mark them
         s = DbSession()
         a = s.query(DbArtifact).filter_by(id=artifact_id).one()
-        artifact = Artifact(a.id, a.name, a.hash,
-                            "%s/artifact/%s" % (self.url, a.id))
+        artifact = self._artifact(a)
         avs = s.query(DbArtifactVerdict).with_for_update() \
             .filter_by(artifact_id=artifact.id, status=JOB_STATUS_NEW)
 
@@ -229,29 +416,56 @@ class VerdictComponent(Component):
         task_ids = {}
         job_status = {}
         exp = datetime.datetime.utcnow() + self.expires
+        next_seq = work_seq.next_value()
         failed = {DbArtifactVerdict.status: JOB_STATUS_FAILED,
                   DbArtifactVerdict.meta: None,
                   DbArtifactVerdict.expires: None}
+        held = {DbArtifactVerdict.status: JOB_STATUS_NEW}
 
         try:
-            for av_id, backend, artifact, previous_task in jobs:
+            # Fetch the artifact first, so an IPFS failure is not held
+            # against the backends; retry_submissions tries again later
+            submit = jobs
+            if jobs and not self._download(jobs[0][2]):
+                for av_id, backend, artifact, previous_task in jobs:
+                    job_status[av_id] = held
+                submit = []
+
+            for av_id, backend, artifact, previous_task in submit:
                 # Just in case a backend is removed
                 a = analysis_backends.get(backend)
-                if a:
-                    log.debug("Submitting job #%s to %s", av_id, backend)
-                    task = gevent.spawn(a.submit_artifact, av_id, artifact, previous_task)
-                    task_ids[id(task)] = av_id
-                    tasks.append(task)
-                else:
+                if not a:
                     log.warning("%r", backend)
+                    continue
+
+                # Backend (and its fallback) is down, retry_submissions will
+                # pick the job up again later
+                a = a.route()
+                if a is None:
+                    log.debug("Holding job #%s for %s", av_id, backend)
+                    job_status[av_id] = held
+                    continue
+
+                log.debug("Submitting job #%s to %s", av_id, a.breaker.name)
+                task = gevent.spawn(submit_artifact, a, av_id, artifact,
+                                    previous_task)
+                task_ids[id(task)] = av_id, a
+                tasks.append(task)
 
             # Collect results
             gevent.joinall(tasks)
             for task in tasks:
-                av_id = task_ids[id(task)]
+                av_id, a = task_ids[id(task)]
                 if task.exception is not None:
-                    job_status[av_id] = failed
-                elif isinstance(task.value, int):
+                    a.breaker.failure()
+                    if a.breaker.state == CIRCUIT_OPEN:
+                        job_status[av_id] = held
+                    else:
+                        job_status[av_id] = failed
+                    continue
+
+                a.breaker.success()
+                if isinstance(task.value, int):
                     job_status[av_id] = {DbArtifactVerdict.status: JOB_STATUS_DONE,
                                          DbArtifactVerdict.verdict: task.value,
                                          DbArtifactVerdict.meta: None,
@@ -264,32 +478,55 @@ class VerdictComponent(Component):
                                          DbArtifactVerdict.meta: task.value,
                                          DbArtifactVerdict.expires: None}
                 else:
+                    if a.is_fallback:
+                        # So the job is cancelled on the right instance
+                        task.value["fallback"] = True
                     job_status[av_id] = {DbArtifactVerdict.status: JOB_STATUS_PENDING,
                                          DbArtifactVerdict.meta: task.value,
-                                         DbArtifactVerdict.expires: exp}
+                                         DbArtifactVerdict.expires: exp,
+                                         DbArtifactVerdict.work_seq: next_seq}
 
         finally:
             # Record results
             s = DbSession()
             reeval = False
+            pending = set()
+            orphaned = {}
             for av_id, backend, artifact, previous_task in jobs:
                 fields = job_status.get(av_id, failed)
                 status = fields[DbArtifactVerdict.status]
+                if status == JOB_STATUS_PENDING:
+                    pending.add(backend)
                 log.debug("Recording job result #%s of %s (r=%s)", av_id,
                           backend, status)
 
                 # The submission process is subject to a race condition where
                 # we may receive the callback before all submissions are
                 # complete, so prevent incorrectly updating items.
-                s.query(DbArtifactVerdict) \
+                updated = s.query(DbArtifactVerdict) \
                     .filter_by(id=av_id, status=JOB_STATUS_SUBMITTING) \
                     .update(fields, synchronize_session=False)
                 if status <= JOB_STATUS_DONE:
                     reeval = True
+                elif not updated and status == JOB_STATUS_PENDING:
+                    orphaned[av_id] = (backend, artifact,
+                                       fields[DbArtifactVerdict.meta])
+
+            # Jobs that were cancelled (or failed) while being submitted
+            # still have a task running on the backend
+            cancel = []
+            if orphaned:
+                stopped = s.query(DbArtifactVerdict.id) \
+                    .filter(DbArtifactVerdict.id.in_(list(orphaned))) \
+                    .filter(DbArtifactVerdict.status < JOB_STATUS_DONE)
+                cancel = [(av_id,) + orphaned[av_id] for av_id, in stopped]
 
             s.commit()
             s.close()
+            self._cancel_jobs(cancel)
 
+            for backend in pending:
+                dispatch_event("backend_work", backend)
             if reeval:
                 dispatch_event("verdict_update", artifact_id)
 
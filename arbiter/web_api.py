@@ -3,8 +3,10 @@
 
 # API used by frontend and analysis backends.
 
-import datetime
 import functools
+import gevent.event
+import hashlib
+import json
 import os.path
 import time
 
@@ -13,19 +15,42 @@ from flask import (
 )
 
 from sqlalchemy import and_, or_, func
-from sqlalchemy.sql import exists
+from sqlalchemy.orm import selectinload
 
 from arbiter.backends import analysis_backends
 from arbiter.component import WSGIComponent
-from arbiter.const import JOB_STATUS_DONE, JOB_STATUS_NAMES
+from arbiter.const import (
+    JOB_STATUS_DONE, JOB_STATUS_SUBMITTING, JOB_STATUS_PENDING,
+    JOB_STATUS_NAMES
+)
 from arbiter.dashboard import dashboard_ws
 from arbiter.database import DbSession, DbBounty, DbArtifact, DbArtifactVerdict
-from arbiter.events import dispatch_event
-from arbiter.utils import validate_token
+from arbiter.events import event, dispatch_event
+from arbiter.rollup import (
+    RESOLUTIONS, RETENTION, artifact_rates, choose_resolution, retained
+)
+from arbiter.utils import TokenCache
 
 app = Flask(__name__)
 dashboard_path = os.path.join(os.path.dirname(__file__), "dashboard")
 
+MAX_LIST_LIMIT = 1000
+MAX_LIST_WAIT = 60
+
+# Artifact chart defaults
+CHART_RANGE = 5 * 86400
+MAX_CHART_POINTS = 1500
+
+# Dashboard listings, by name: (expires, etag, body)
+CACHE_TTL = 2
+response_cache = {}
+
+# Per analysis backend, set when new work is available
+work_available = {}
+
+# Jobs that accept a verdict from their backend
+JOB_STATUS_ACTIVE = (JOB_STATUS_SUBMITTING, JOB_STATUS_PENDING)
+
 class APIComponent(WSGIComponent):
     name = "api"
     ws = {"/kraken/tentacle": dashboard_ws}
@@ -35,9 +60,19 @@ class APIComponent(WSGIComponent):
         self.artifact_interval = parent.artifact_interval
         self.polyswarm = parent.polyswarm
         self.api_secret = parent.config.api_secret
+        self.api_tokens = TokenCache(self.api_secret,
+                                     parent.config.api_token_validity,
+                                     parent.config.api_token_not_before)
         self.dashboard_password = parent.config.dashboard_password
         self.bind = parent.config.bind
 
+    @event("backend_work")
+    def backend_work(self, backend):
+        """Wake up requests waiting for work for this backend"""
+        ev = work_available.pop(backend, None)
+        if ev is not None:
+            ev.set()
+
 def dashboard_auth(f):
     def check_auth(auth):
         # TODO: constant-time compare
@@ -60,7 +95,7 @@ def check_apikey(view):
             abort(401, "The Authorization header is required")
 
         token = api_key[7:]
-        backend = validate_token(app.component.api_secret, token)
+        backend = app.component.api_tokens.validate(token)
         if not backend or not backend in analysis_backends:
             abort(401, "Invalid API key specified")
 
@@ -96,42 +131,48 @@ def missing_time_steps(t, cur, step_time):
 @app.route("/dashboard/charts/artifacts")
 @dashboard_auth
 def artifact_datapoints():
-    unow = datetime.datetime.utcnow()
-    ustart = unow - datetime.timedelta(days=5)
-    start = int(time.mktime(ustart.timetuple()))
-    now = int(time.mktime(unow.timetuple()))
-    data = []
-
-    s = DbSession()
+    """Artifacts processed over time, answered from the rollup. Optional
+    parameters: range (seconds back from now) or start/end (UNIX
+    timestamps), and resolution (bucket size in seconds). Without a
+    resolution the finest one that still covers start, with at most
+    MAX_CHART_POINTS buckets, is used."""
+    now = int(time.time())
     try:
-        step_time = app.component.artifact_interval
-        rs = s.query(DbArtifact.processed_at_interval, func.count(1)) \
-            .filter(DbArtifact.processed_at_interval.isnot(None)) \
-            .filter(DbArtifact.processed_at_interval > start) \
-            .group_by(DbArtifact.processed_at_interval) \
-            .order_by(DbArtifact.processed_at_interval)
-
-        prev = None
-        for r in rs:
-            stamp = r.processed_at_interval
-            for step in missing_time_steps(prev, stamp, step_time):
-                data.append([step, 0])
-            data.append([stamp, r[1]])
-            prev = stamp
-
-        if prev:
-            if (now - prev) > step_time:
-                # We've stopped seeing entries, so end with 0
-                data.append([prev + step_time, 0])
-                data.append([now, 0])
-            #elif data[-1][0] > now:
-            #    # Extrapolate the last entry to prevent a "dip"
-            #    last = data[-1][0]
-            #    boost = (step_time - (last - now)) / float(step_time)
-            #    data[-1][1] = data[-1][1] / boost
+        end = int(request.args.get("end", now))
+        if "start" in request.args:
+            start = int(request.args["start"])
+        else:
+            start = end - int(request.args.get("range", CHART_RANGE))
+        step_time = request.args.get("resolution")
+        step_time = int(step_time) if step_time else None
+    except ValueError:
+        abort(400, "Invalid range or resolution")
+
+    if start >= end:
+        abort(400, "Invalid range or resolution")
+    if step_time is None:
+        step_time = choose_resolution(start, end, MAX_CHART_POINTS, now)
+    elif step_time not in RESOLUTIONS:
+        abort(400, "Resolution must be one of %s" %
+              ", ".join(str(r) for r in RESOLUTIONS))
+    elif (end - start) / step_time > MAX_CHART_POINTS:
+        abort(400, "Too many data points, use a lower resolution")
+    elif not retained(step_time, start, now):
+        abort(400, "Resolution %s is only kept for %s seconds, use a lower "
+              "resolution" % (step_time, RETENTION[step_time]))
 
-    finally:
-        s.close()
+    data = []
+    prev = None
+    for stamp, count in artifact_rates.query(step_time, start, end):
+        for step in missing_time_steps(prev, stamp, step_time):
+            data.append([step, 0])
+        data.append([stamp, count])
+        prev = stamp
+
+    if prev and (end - prev) > step_time:
+        # We've stopped seeing entries, so end with 0
+        data.append([prev + step_time, 0])
+        data.append([end, 0])
 
     if len(data) == 1:
         data.insert(0, [data[0][0] - step_time, 0])
@@ -139,7 +180,8 @@ def artifact_datapoints():
 
     return jsonify({
         "start": data[0][0] if data else start,
-        "end": data[-1][0] if data else now,
+        "end": data[-1][0] if data else end,
+        "resolution": step_time,
         "data": data,
     })
 
@@ -173,6 +215,9 @@ def dashboard_manual_verdict(guid):
     finally:
         s.close()
 
+    # The bounty moves from the manual to the pending listing
+    response_cache.clear()
+
     return jsonify({"status": "OK"})
 
 @app.route("/")
@@ -190,7 +235,9 @@ def dashboard_index():
 def dashboard_files(static_path):
     return send_from_directory(dashboard_path, static_path)
 
-def _gather_bounty_data(b, verbose=True):
+def _gather_bounty_data(b, verbose=True, pending_artifacts=None):
+    """Dashboard representation of a bounty. The artifacts (and their
+    verdicts, if verbose) should have been eager-loaded by the caller."""
     data = {
         "guid": b.guid,
         "author": b.author,
@@ -208,98 +255,167 @@ def _gather_bounty_data(b, verbose=True):
         "revealed": b.revealed,
         "truth_settled": b.settled, # compat
     }
-    pending_artifacts = 0
     if verbose:
         data["assertions"] = b.assertions
     artifacts = []
     for a in b.artifacts:
-        verdicts = {}
-        if verbose:
-            for av in a.verdicts:
-                status = JOB_STATUS_NAMES.get(av.status, av.status)
-                verdicts[av.backend] = {"verdict": av.verdict,
-                                        "status": status,
-                                        "meta": av.meta}
         artifacts.append({
             "name": a.name,
             "verdict": a.verdict,
             "processed": a.processed,
         })
         if verbose:
+            verdicts = {}
+            for av in a.verdicts:
+                status = JOB_STATUS_NAMES.get(av.status, av.status)
+                verdicts[av.backend] = {"verdict": av.verdict,
+                                        "status": status,
+                                        "meta": av.meta}
             artifacts[-1]["verdicts"] = verdicts
             artifacts[-1]["hash"] = a.hash
-        if not a.processed:
-            pending_artifacts += 1
-        data["artifacts"] = artifacts
-    else:
-        for a in b.artifacts:
-            if not a.processed:
-                pending_artifacts += 1
+    data["artifacts"] = artifacts
+    if pending_artifacts is None:
+        pending_artifacts = sum(1 for a in b.artifacts if not a.processed)
     data["pending_artifacts"] = pending_artifacts
     return data
 
+def _list_bounties(*criteria):
+    """Bounty listing in a fixed number of queries: the number of pending
+    artifacts is counted in SQL, and the artifacts are loaded in one go."""
+    s = DbSession()
+    try:
+        pending = s.query(func.count(DbArtifact.id)) \
+            .filter(DbArtifact.bounty_id == DbBounty.id) \
+            .filter(DbArtifact.processed.is_(False)) \
+            .correlate(DbBounty).as_scalar()
+        rows = s.query(DbBounty, pending) \
+            .options(selectinload(DbBounty.artifacts).load_only(
+                DbArtifact.name, DbArtifact.verdict, DbArtifact.processed)) \
+            .filter(*criteria) \
+            .order_by(DbBounty.id)
+        return [_gather_bounty_data(b, False, n) for b, n in rows]
+    finally:
+        s.close()
+
+def _cached_json(key, build):
+    """Serve a JSON document that is rebuilt at most every CACHE_TTL seconds,
+    with ETag validation so unchanged listings aren't sent again."""
+    now = time.time()
+    entry = response_cache.get(key)
+    if entry is None or entry[0] < now:
+        body = json.dumps(build(), separators=(",", ":"))
+        etag = hashlib.sha1(body.encode("utf8")).hexdigest()
+        entry = response_cache[key] = now + CACHE_TTL, etag, body
+
+    _, etag, body = entry
+    if request.if_none_match.contains(etag):
+        r = Response(status=304)
+    else:
+        r = Response(body, mimetype="application/json")
+    r.set_etag(etag)
+    r.headers["Cache-Control"] = "no-cache"
+    return r
+
 @app.route("/dashboard/bounties/<guid>")
 @dashboard_auth
 def dashboard_bounties_guid(guid):
     s = DbSession()
-    b = s.query(DbBounty).filter_by(guid=guid) \
-        .order_by(DbBounty.id).one_or_none()
-    if b is None:
-        return jsonify({"error": "No such bounty"}), 404
-    data = _gather_bounty_data(b)
-    s.close()
+    try:
+        b = s.query(DbBounty).filter_by(guid=guid) \
+            .options(selectinload(DbBounty.artifacts)
+                     .selectinload(DbArtifact.verdicts)) \
+            .order_by(DbBounty.id).one_or_none()
+        if b is None:
+            return jsonify({"error": "No such bounty"}), 404
+        data = _gather_bounty_data(b)
+    finally:
+        s.close()
     return jsonify(data)
 
 @app.route("/dashboard/bounties/pending")
 @dashboard_auth
 def dashboard_bounties_pending():
     # Bounties that are being processed or need to be submitted
-    s = DbSession()
-    bs = s.query(DbBounty).filter_by(status="active") \
-        .filter(or_(DbBounty.truth_manual.is_(False),
-                    DbBounty.truth_value.isnot(None))) \
-        .order_by(DbBounty.id)
-    bounties = [_gather_bounty_data(b, False) for b in bs]
-    s.close()
-    return jsonify(bounties)
+    return _cached_json("pending", lambda: _list_bounties(
+        DbBounty.status == "active",
+        or_(DbBounty.truth_manual.is_(False),
+            DbBounty.truth_value.isnot(None))))
 
 @app.route("/dashboard/bounties/manual")
 @dashboard_auth
 def dashboard_bounties_manual():
     """All not-yet-set bounties that need a manual verdict"""
-    s = DbSession()
-    bs = s.query(DbBounty) \
-        .filter_by(truth_manual=True, voted=False) \
-        .filter(DbBounty.truth_value.is_(None)) \
-        .order_by(DbBounty.id)
-    bounties = [_gather_bounty_data(b, False) for b in bs]
-    s.close()
-    return jsonify(bounties)
+    return _cached_json("manual", lambda: _list_bounties(
+        DbBounty.truth_manual.is_(True),
+        DbBounty.voted.is_(False),
+        DbBounty.truth_value.is_(None)))
 
 # }}}
 
 # Analysis backend API
 # {{{
 
+def _pending_work(backend, cursor, limit):
+    """Returns (artifacts, cursor). Jobs are listed in the order they became
+    pending, so a job that is pending again (e.g. after a restart) comes
+    after the cursor once more."""
+    s = DbSession()
+    try:
+        q = s.query(DbArtifact.id, DbArtifact.hash, DbArtifact.name,
+                    DbArtifactVerdict.work_seq) \
+            .join(DbArtifactVerdict,
+                  DbArtifactVerdict.artifact_id == DbArtifact.id) \
+            .filter(DbArtifactVerdict.backend == backend) \
+            .filter(DbArtifactVerdict.status == JOB_STATUS_PENDING) \
+            .filter(DbArtifactVerdict.work_seq > cursor) \
+            .order_by(DbArtifactVerdict.work_seq).limit(limit)
+        artifacts = []
+        for a in q:
+            artifacts.append({"id": a.id, "hash": a.hash, "name": a.name})
+            cursor = a.work_seq
+        return artifacts, cursor
+    finally:
+        s.close()
+
 @app.route("/artifacts")
 @check_apikey
 def list_artifacts(analysis_backend):
-    s = DbSession()
-    artifacts = []
-
-    q = s.query(DbArtifact).filter(
-        ~exists().where(and_(
-            DbArtifactVerdict.artifact_id == DbArtifact.id,
-            DbArtifactVerdict.backend == analysis_backend.name
-        ))
-    )
-
-    for artifact in q:
-        artifacts.append(artifact.id)
-
-    s.close()
-
-    return jsonify(artifacts)
+    """Artifacts waiting for a verdict of this backend, in pages of at most
+    `limit` items after `cursor`, an opaque value returned by the previous
+    call. With `wait`, an empty result is only returned after waiting up to
+    that many seconds for new work to arrive."""
+    try:
+        cursor = int(request.args.get("cursor", 0))
+        limit = min(int(request.args.get("limit", 100)), MAX_LIST_LIMIT)
+        wait = min(float(request.args.get("wait", 0)), MAX_LIST_WAIT)
+    except ValueError:
+        abort(400, "Invalid cursor, limit or wait")
+    if limit < 1:
+        abort(400, "Invalid cursor, limit or wait")
+
+    name = analysis_backend.name
+    # Get the event before looking, so we can't miss a notification
+    ev = work_available.setdefault(name, gevent.event.Event())
+    artifacts, cursor = _pending_work(name, cursor, limit)
+    if not artifacts and wait > 0:
+        ev.wait(wait)
+        artifacts, cursor = _pending_work(name, cursor, limit)
+
+    return jsonify({"artifacts": artifacts, "cursor": cursor})
+
+def parse_verdict_value(obj):
+    if "verdict_value" not in obj:
+        raise ValueError("Missing verdict_value")
+
+    verdict_value = obj["verdict_value"]
+    if verdict_value is not None:
+        try:
+            verdict_value = int(verdict_value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid verdict value")
+        if verdict_value < 0 or verdict_value > 100:
+            raise ValueError("Invalid verdict value")
+    return verdict_value
 
 @app.route("/artifact/<int:artifact_id>", methods=["POST"])
 @check_apikey
@@ -310,14 +426,10 @@ def action_artifact(analysis_backend, artifact_id):
     if "error" in request.json:
         pass
 
-    if "verdict_value" not in request.json:
-        abort(400, "Missing verdict_value")
-
-    verdict_value = request.json["verdict_value"]
-    if verdict_value is not None:
-        verdict_value = int(verdict_value)
-        if verdict_value < 0 or verdict_value > 100:
-            abort(400, "Invalid verdict value")
+    try:
+        verdict_value = parse_verdict_value(request.json)
+    except ValueError as e:
+        abort(400, str(e))
 
     s = DbSession()
     verdict = s.query(DbArtifactVerdict) \
@@ -333,6 +445,9 @@ def action_artifact(analysis_backend, artifact_id):
     if verdict.status == JOB_STATUS_DONE:
         s.close()
         abort(403, "Verdict for artifact #%s already submitted" % artifact_id)
+    if verdict.status not in JOB_STATUS_ACTIVE:
+        s.close()
+        abort(403, "Job for artifact #%s is no longer active" % artifact_id)
 
     verdict.status = JOB_STATUS_DONE
     verdict.verdict = verdict_value
@@ -345,3 +460,75 @@ def action_artifact(analysis_backend, artifact_id):
     dispatch_event("verdict_update", artifact_id)
 
     return jsonify({"status": "OK"})
+
+@app.route("/artifacts/verdicts", methods=["POST"])
+@check_apikey
+def action_artifacts(analysis_backend):
+    """Submit many verdicts at once, as a list of
+    {artifact_id, verdict_value, meta} objects. All of them are recorded in a
+    single transaction; the response has a status for every item."""
+    if not isinstance(request.json, list):
+        abort(400, "Expected a JSON list of verdicts")
+
+    results = []
+    updates = {}
+    for item in request.json:
+        artifact_id = item.get("artifact_id") if isinstance(item, dict) else None
+        results.append({"artifact_id": artifact_id, "status": "OK"})
+        if not isinstance(artifact_id, int) or isinstance(artifact_id, bool):
+            results[-1].update(status="error", error="Invalid artifact_id")
+            continue
+        if artifact_id in updates:
+            results[-1].update(status="error", error="Duplicate artifact_id")
+            continue
+        try:
+            verdict_value = parse_verdict_value(item)
+        except ValueError as e:
+            results[-1].update(status="error", error=str(e))
+            continue
+        updates[artifact_id] = (results[-1], verdict_value, item.get("meta"))
+
+    completed = []
+    if updates:
+        s = DbSession()
+        try:
+            verdicts = s.query(DbArtifactVerdict.id,
+                               DbArtifactVerdict.artifact_id,
+                               DbArtifactVerdict.status) \
+                .with_for_update().filter(and_(
+                    DbArtifactVerdict.backend == analysis_backend.name,
+                    DbArtifactVerdict.artifact_id.in_(list(updates))
+                ))
+            mappings = []
+            for av_id, artifact_id, status in verdicts:
+                result, verdict_value, meta = updates.pop(artifact_id)
+                if status == JOB_STATUS_DONE:
+                    result.update(status="error", error="Verdict for artifact "
+                                  "#%s already submitted" % artifact_id)
+                    continue
+                if status not in JOB_STATUS_ACTIVE:
+                    result.update(status="error", error="Job for artifact "
+                                  "#%s is no longer active" % artifact_id)
+                    continue
+                fields = {"id": av_id, "status": JOB_STATUS_DONE,
+                          "verdict": verdict_value}
+                if meta is not None:
+                    fields["meta"] = meta
+                mappings.append(fields)
+                completed.append(artifact_id)
+
+            s.bulk_update_mappings(DbArtifactVerdict, mappings)
+            s.commit()
+        finally:
+            s.close()
+
+    for result, _, _ in updates.values():
+        result.update(status="error", error="Artifact #%d not found" %
+                      result["artifact_id"])
+
+    app.logger.debug("Received %s verdict(s) from %s", len(completed),
+                     analysis_backend.name)
+    for artifact_id in completed:
+        dispatch_event("verdict_update", artifact_id)
+
+    return jsonify({"status": "OK", "results": results})
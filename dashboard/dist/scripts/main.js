@@ -40317,7 +40317,7 @@ initializeVerdicts(Application.data['manual-bounties'],Application.data['pending
 _pageSwitcher2.default.findAndBind((0,_jquery2.default)(".page-switcher"));}
 
 },{"./lib/page-switcher":112,"@fengyuanchen/datepicker":1,"chart.js":4,"handlebars":90,"jquery":102,"moment":103,"patternomaly":105}],110:[function(require,module,exports){
-'use strict';Object.defineProperty(exports,"__esModule",{value:true});exports.default=DomStart;var _jquery=require('jquery');var _jquery2=_interopRequireDefault(_jquery);var _svgLoader=require('./lib/svg-loader');var _svgLoader2=_interopRequireDefault(_svgLoader);var _socketHandler=require('./lib/socket-handler');var _socketHandler2=_interopRequireDefault(_socketHandler);function _interopRequireDefault(obj){return obj&&obj.__esModule?obj:{default:obj};}// resolve handler shorthand
+'use strict';Object.defineProperty(exports,"__esModule",{value:true});exports.default=DomStart;var _jquery=require('jquery');var _jquery2=_interopRequireDefault(_jquery);var _svgLoader=require('./lib/svg-loader');var _svgLoader2=_interopRequireDefault(_svgLoader);var _socketHandler=require('./lib/socket-handler');var _socketHandler2=_interopRequireDefault(_socketHandler);var _stateSync=require('./lib/state-sync');var _stateSync2=_interopRequireDefault(_stateSync);function _interopRequireDefault(obj){return obj&&obj.__esModule?obj:{default:obj};}// resolve handler shorthand
 var _resolve=function _resolve(){var _data=arguments.length>0&&arguments[0]!==undefined?arguments[0]:{};return Promise.resolve(_data);};var _reject=function _reject(){var _err=arguments.length>0&&arguments[0]!==undefined?arguments[0]:{};return Promise.reject(_err);};var resolveHash=function resolveHash(key,data){return{key:key,data:data};};// ajax request as a promise
 var request=function request(){var url=arguments.length>0&&arguments[0]!==undefined?arguments[0]:'';var method=arguments.length>1&&arguments[1]!==undefined?arguments[1]:'GET';var label=arguments.length>2&&arguments[2]!==undefined?arguments[2]:'';return new Promise(function(resolve,reject){_jquery2.default.ajax({url:url,success:function success(response){return resolve(resolveHash(label,response));},error:function error(errors){return reject(errors);}});});};var Response={SKIP_SOCKET:window.location.href.indexOf('skip-socket')>-1,MESSAGE_TYPES:['counter-errors','counter-artifacts-processing','counter-backends-running','counter-bounties-settled','wallet','backends'],HOST:window.location.host};var Processes=[];var websocket='ws://'+Response.HOST+'/kraken/tentacle';function bindLoaderAnimation(el){var step=0;setInterval(function(){el.find('i').removeClass('filled').eq(step).addClass('filled');step++;if(step>el.find('i').length-1)step=0;},500);}// DomStart handler - called upon page init
 function DomStart(){//
@@ -40333,9 +40333,9 @@ Processes.push(new Promise(function(resolve,reject){_svgLoader2.default.loadPlac
 Processes.push(request('http://'+Response.HOST+'/dashboard/bounties/manual','GET','manual-bounties'));Processes.push(request('http://'+Response.HOST+'/dashboard/bounties/pending','GET','pending-bounties'));//
 // Connect websocket stream
 //
-if(!Response.SKIP_SOCKET)Processes.push(new Promise(function(resolve,reject){var data={};var needMessages=Response.MESSAGE_TYPES;var processedMessages=[];var allMessagesReceived=function allMessagesReceived(){var ret=true;for(var nmsg in needMessages){if(processedMessages.indexOf(needMessages[nmsg])==-1){ret=false;}}return ret;};Response.stream=(0,_socketHandler2.default)(websocket,{onmessage:function onmessage(response){var r=JSON.parse(response);data[r.msg]=r;processedMessages.push(r.msg);if(allMessagesReceived()){resolve(resolveHash('ws',data));}},onerror:function onerror(){return reject('Websocket returned an error');}});}));return Promise.all(Processes).then(function(results){for(var r in results){Response[results[r].key]=results[r].data;}return _resolve(Response);}).catch(function(err){return _reject({err:err,message:'very faulty'});});}
+if(!Response.SKIP_SOCKET)Processes.push(new Promise(function(resolve,reject){var data={};var needMessages=Response.MESSAGE_TYPES;var processedMessages=[];var allMessagesReceived=function allMessagesReceived(){var ret=true;for(var nmsg in needMessages){if(processedMessages.indexOf(needMessages[nmsg])==-1){ret=false;}}return ret;};var sync=(0,_stateSync2.default)(websocket);Response.stream=(0,_socketHandler2.default)(sync.url,{transform:sync.apply,onmessage:function onmessage(response){var r=response;data[r.msg]=r;processedMessages.push(r.msg);if(allMessagesReceived()){resolve(resolveHash('ws',data));}},onerror:function onerror(){return reject('Websocket returned an error');}});}));return Promise.all(Processes).then(function(results){for(var r in results){Response[results[r].key]=results[r].data;}return _resolve(Response);}).catch(function(err){return _reject({err:err,message:'very faulty'});});}
 
-},{"./lib/socket-handler":113,"./lib/svg-loader":114,"jquery":102}],111:[function(require,module,exports){
+},{"./lib/socket-handler":113,"./lib/state-sync":115,"./lib/svg-loader":114,"jquery":102}],111:[function(require,module,exports){
 'use strict';var _domStart=require('./dom-start');var _domStart2=_interopRequireDefault(_domStart);var _domReady=require('./dom-ready');var _domReady2=_interopRequireDefault(_domReady);var _domLoaded=require('./dom-loaded');var _domLoaded2=_interopRequireDefault(_domLoaded);var _domError=require('./dom-error');var _domError2=_interopRequireDefault(_domError);function _interopRequireDefault(obj){return obj&&obj.__esModule?obj:{default:obj};}/*
   document ready - verifies available 3rd party dependencies
   and executes domReady() function that will initialize the app.
@@ -40388,7 +40388,8 @@ selector.each(function(){var switcher=new PageSwitcher({nav:(0,_jquery2.default)
 },{"jquery":102}],113:[function(require,module,exports){
 'use strict';Object.defineProperty(exports,"__esModule",{value:true});exports.default=stream;/*
   WebSocket library, credits to Ben
- */function stream(url,callbacks,interval,smart_backoff){var had_initial_connection=false;var call=function call(k,a,msg){if(callbacks[k]){var args=msg!==undefined?[msg,callbacks]:[callbacks];args.push.apply(args,a);return callbacks[k].apply(callbacks,args);}};var onopen=function onopen(){console.log('ws: Established:',url);had_initial_connection=true;call('onopen',arguments);};var onclose=function onclose(){console.warn('ws: Disconnected:',url);if(!had_initial_connection&&smart_backoff){setTimeout(connect,30000);}else{setTimeout(connect,interval);}try{call('onclose',arguments);}finally{callbacks.ws=null;}};var onerror=function onerror(){console.warn('ws: Error:',url,arguments);call('onerror',arguments);};var onmessage=function onmessage(e){var msg=e.data;call('onmessage',arguments,msg);};var connect=function connect(){var ws;try{ws=callbacks.ws=new WebSocket(url);ws.binaryType='arraybuffer';}catch(e){console.log('WebSocket error: '+e);return;}ws.onopen=onopen;ws.onclose=onclose;ws.onerror=onerror;ws.onmessage=onmessage;};callbacks.send=function(msg){try{if(callbacks.ws){//console.log('ws: Send:', msg);
+ */function stream(url,callbacks,interval,smart_backoff){var had_initial_connection=false;var call=function call(k,a,msg){if(callbacks[k]){var args=msg!==undefined?[msg,callbacks]:[callbacks];args.push.apply(args,a);return callbacks[k].apply(callbacks,args);}};var onopen=function onopen(){console.log('ws: Established:',url);had_initial_connection=true;call('onopen',arguments);};var onclose=function onclose(){console.warn('ws: Disconnected:',url);if(!had_initial_connection&&smart_backoff){setTimeout(connect,30000);}else{setTimeout(connect,interval);}try{call('onclose',arguments);}finally{callbacks.ws=null;}};var onerror=function onerror(){console.warn('ws: Error:',url,arguments);call('onerror',arguments);};var onmessage=function onmessage(e){var msg=callbacks.transform?callbacks.transform(e.data):e.data;call('onmessage',arguments,msg);};var connect=function connect(){var ws;try{// url may be a function, to pick a new URL on every reconnect
+ws=callbacks.ws=new WebSocket(typeof url==='function'?url():url);ws.binaryType='arraybuffer';}catch(e){console.log('WebSocket error: '+e);return;}ws.onopen=onopen;ws.onclose=onclose;ws.onerror=onerror;ws.onmessage=onmessage;};callbacks.send=function(msg){try{if(callbacks.ws){//console.log('ws: Send:', msg);
 callbacks.ws.send(msg);}}catch(e){console.error('Failed to send:',e);}};callbacks.close=function(){try{if(callbacks.ws){console.log('ws: Close');callbacks.ws.close();}}catch(e){console.error('Close error: '+e);}};connect();return callbacks;};
 
 },{}],114:[function(require,module,exports){
@@ -40472,5 +40473,14 @@ var chainable={loaded:function loaded(fn){chain._success=fn;return chainable;},f
 exports.default=SVGLoader;// export meta properties on the SVGLoader namespace
 exports._defaults=_defaults;
 
-},{"jquery":102}]},{},[111])
+},{"jquery":102}],115:[function(require,module,exports){
+'use strict';Object.defineProperty(exports,"__esModule",{value:true});exports.default=stateSync;/*
+  Versioned dashboard state. Keeps the last value of every message kind,
+  applies the deltas sent by the arbiter and remembers the highest sequence
+  number seen, so a reconnect only receives what changed in the meantime.
+ */function stateSync(_url){var epoch=null;var since=null;var state={};return{url:function url(){var query=['delta=1'];if(epoch!==null&&since!==null)query.push('epoch='+epoch,'since='+since);return _url+'?'+query.join('&');},apply:function apply(message){var msg=typeof message==='string'?JSON.parse(message):message;var kind=msg.msg;// the arbiter restarted, everything will be sent again
+if(kind==='sync'){if(msg.sync.epoch!==epoch){state={};since=null;}epoch=msg.sync.epoch;return msg;}if(msg.seq===undefined)return msg;// a delta holds the changed keys, merge it into the known value
+if(msg.base!==undefined){var value=Object.assign({},state[kind],msg[kind]);var _iteratorNormalCompletion=true;var _didIteratorError=false;var _iteratorError=undefined;try{for(var _iterator=msg.removed[Symbol.iterator](),_step;!(_iteratorNormalCompletion=(_step=_iterator.next()).done);_iteratorNormalCompletion=true){var k=_step.value;delete value[k];}}catch(err){_didIteratorError=true;_iteratorError=err;}finally{try{if(!_iteratorNormalCompletion&&_iterator.return){_iterator.return();}}finally{if(_didIteratorError){throw _iteratorError;}}}msg[kind]=value;}state[kind]=msg[kind];since=since===null?msg.seq:Math.max(since,msg.seq);return msg;}};}
+
+},{}]},{},[111])
 //# sourceMappingURL=main.js.map
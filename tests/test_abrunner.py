@@ -0,0 +1,153 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+# abrunner monkey-patches everything it imports, so it is run as a separate
+# process, with `sh` as the scanner: samples are shell scripts that decide
+# their own exit code.
+
+import contextlib
+import os.path
+import requests
+import socket
+import subprocess
+import sys
+import time
+
+ABRUNNER = os.path.join(os.path.dirname(__file__), "..", "abrunner",
+                        "abrunner")
+STUBD = os.path.join(os.path.dirname(__file__), "..", "abrunner", "stubd")
+
+EICAR = b"X5O!P%@AP[4\\PZX54(P^)7CC)7}$EICAR-STANDARD-ANTIVIRUS-TEST-FILE!$H+H*"
+
+def free_port():
+    s = socket.socket()
+    s.bind(("127.0.0.1", 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def wait_for(fn, timeout=10):
+    end = time.time() + timeout
+    while True:
+        try:
+            r = fn()
+            if r:
+                return r
+        except (requests.ConnectionError, socket.error):
+            pass
+        if time.time() > end:
+            raise AssertionError("Timed out")
+        time.sleep(0.05)
+
+@contextlib.contextmanager
+def abrunner(*argv):
+    port = free_port()
+    p = subprocess.Popen([sys.executable, ABRUNNER, "--bind", "127.0.0.1",
+                          "--port", str(port)] + list(argv))
+    url = "http://127.0.0.1:%d" % port
+    try:
+        wait_for(lambda: requests.get(url + "/status").ok)
+        yield url
+    finally:
+        p.kill()
+        p.wait()
+
+@contextlib.contextmanager
+def stubd(path):
+    p = subprocess.Popen([sys.executable, STUBD, "--bind", path])
+    try:
+        wait_for(lambda: os.path.exists(path))
+        yield p
+    finally:
+        p.kill()
+        p.wait()
+
+def scan(url, content):
+    r = requests.post(url + "/", files={"file": ("sample", content)})
+    assert r.status_code == 200
+    return r.json()["verdict"]
+
+def submit(url, script):
+    r = requests.post(url + "/tasks", files={"file": ("sample", script)})
+    assert r.status_code == 200
+    return r.json()["task_id"]
+
+def task(url, task_id):
+    return requests.get("%s/tasks/%s" % (url, task_id)).json()
+
+def finished(url, task_id):
+    t = task(url, task_id)
+    return t if t["status"] not in ("pending", "running") else None
+
+def test_tasks():
+    with abrunner("--program", "sh", "--workers", "2") as url:
+        clean = submit(url, b"exit 0")
+        infected = submit(url, b"exit 1")
+        broken = submit(url, b"exit 3")
+        assert wait_for(lambda: finished(url, clean))["verdict"] == 0
+        assert wait_for(lambda: finished(url, infected))["verdict"] == 100
+        assert wait_for(lambda: finished(url, broken)) == {
+            "task_id": broken, "status": "done", "verdict": None}
+
+        r = requests.get(url + "/tasks?ids=%s,%s,x,999" % (clean, infected))
+        assert sorted(r.json()["tasks"]) == sorted([str(clean),
+                                                    str(infected)])
+        assert r.json()["tasks"][str(infected)]["verdict"] == 100
+        assert requests.get(url + "/tasks/999").status_code == 404
+        assert requests.post(url + "/tasks").status_code == 400
+
+def test_status_cancel():
+    with abrunner("--program", "sh", "--workers", "1") as url:
+        running = submit(url, b"exec sleep 30")
+        waiting = submit(url, b"exec sleep 30")
+        wait_for(lambda: task(url, running)["status"] == "running")
+        status = requests.get(url + "/status").json()
+        assert status == {"workers": 1, "busy": 1, "pending": 1}
+
+        # Kills the scanner, and the next task gets its turn
+        r = requests.delete("%s/tasks/%s" % (url, running))
+        assert r.json()["status"] == "cancelled"
+        wait_for(lambda: task(url, waiting)["status"] == "running")
+        assert task(url, running)["status"] == "cancelled"
+        assert requests.get(url + "/status").json()["pending"] == 0
+
+        r = requests.delete("%s/tasks/%s" % (url, waiting))
+        assert r.json()["status"] == "cancelled"
+        wait_for(lambda: requests.get(url + "/status").json()["busy"] == 0)
+        assert requests.delete(url + "/tasks/999").status_code == 404
+
+def test_expire_finished_only():
+    with abrunner("--program", "sh", "--workers", "1", "--keep", "1") as url:
+        done = submit(url, b"exit 0")
+        wait_for(lambda: finished(url, done))
+        running = submit(url, b"exec sleep 30")
+        waiting = submit(url, b"exit 1")
+
+        # Over --keep, but only the finished task may go
+        assert requests.get("%s/tasks/%s" % (url, done)).status_code == 404
+        assert task(url, running)["status"] in ("pending", "running")
+        assert task(url, waiting)["status"] == "pending"
+
+        requests.delete("%s/tasks/%s" % (url, running))
+        assert wait_for(lambda: finished(url, waiting))["verdict"] == 100
+
+def test_daemon(tmpdir):
+    sock = str(tmpdir.join("stubd.sock"))
+    with abrunner("--daemon", sock) as url:
+        with stubd(sock):
+            assert scan(url, b"MZ clean") == 0
+            # Spanning two INSTREAM chunks
+            assert scan(url, b"\0" * 65530 + EICAR) == 100
+
+        # Known samples are answered from the cache; others fail
+        assert scan(url, b"MZ clean") == 0
+        assert scan(url, b"\0" * 65530 + EICAR) == 100
+        assert scan(url, b"MZ other") is None
+
+def test_daemon_exit_codes(tmpdir):
+    sock = str(tmpdir.join("stubd.sock"))
+    with stubd(sock):
+        with abrunner("--daemon", sock, "--exit-codes", "0=none,1=70",
+                      "--cache", "0") as url:
+            assert scan(url, b"MZ clean") is None
+            assert scan(url, EICAR) == 70
@@ -4,6 +4,7 @@
 import datetime
 import mock
 import pytest
+import uuid
 
 from arbiter.backends import AnalysisBackend
 from arbiter.bounties import (
@@ -30,8 +31,14 @@ class Config:
     expires = datetime.timedelta(days=5)
     trusted_experts = []
 
+class PolySwarm:
+    reveal_window = 25
+    vote_window = 25
+
 class Parent:
-    polyswarm = Holder()
+    manual_mode = False
+    initial_block = 0
+    polyswarm = PolySwarm()
     config = Config()
 
 def _create_bounty(guid, truth_value=None, settled=False, n=0, assertions=None):
@@ -76,7 +83,7 @@ def _bounty_check_state(b, should_be_set, should_be_settled=None):
             kwargs = {"guid": b}
         b = s.query(DbBounty).filter_by(**kwargs).one()
         is_set = b.truth_value is not None
-        is_settled = b.truth_settled is True
+        is_settled = b.settled is True
     finally:
         s.close()
     if not should_be_set and is_set:
@@ -190,40 +197,69 @@ def test_bounty_settle_attempt(db):
     finally:
         db_clear()
 
-@mock.patch("arbiter.bounties.ipfs_download")
+def _artifact_ids(guid):
+    s = DbSession()
+    try:
+        return [a.id for a in s.query(DbArtifact.id).join(DbBounty)
+                .filter(DbBounty.guid == guid).order_by(DbArtifact.id)]
+    finally:
+        s.close()
+
+@mock.patch("arbiter.bounties.ipfs_json")
+@mock.patch("arbiter.bounties.prefetch")
 @mock.patch("arbiter.bounties.dispatch_event")
-def test_bounty_pre(dispatch_event, ipfs_download):
+def test_bounty_prefetch(dispatch_event, prefetch, ipfs_json, db):
     b = BountyComponent(Parent())
+    bounties.analysis_backends = {
+        "cuckoo": AnalysisBackend("cuckoo", True, 1),
+    }
     bounty = {"resolved": False,
+              "amount": "10000",
+              "author": "0xdeadbeef",
+              "expiration": 222,
               "guid": "88e5f4e6-e5e4-4dc3-88d0-c6a57ae13e1f",
               "uri": "QmcPMpDr1sR4fN28ZKwMbUMeUcoDB7cmYjFpVhpucTv7Rc"}
-    b.bounty_pre(bounty)
-    ipfs_download.assert_called_with(bounty["uri"])
-    assert dispatch_event.called
-
-    dispatch_event.reset_mock()
-    ipfs_download.reset_mock()
-    ipfs_download.side_effect = IPFSNotFoundError()
-    bounty = {"resolved": False,
-              "guid": "0a46a217-0e95-4ae7-a7eb-2e8e351c7f84",
-              "uri": "QmamNsdX41A2xGEMHCL6eDzMzAK9rFdJWuTfxMsb21tBXM"}
-    b.bounty_pre(bounty)
-    ipfs_download.assert_called_with(bounty["uri"])
-    assert not dispatch_event.called
-
-    ipfs_download.reset_mock()
-    ipfs_download.side_effect = IOError()
-    bounty = {"resolved": False,
-              "guid": "4587657d-5bfd-419c-8037-ffeb7f4467b4",
-              "uri": "QmXhULzuSCDVQjJHqURTToqSRz6Y4BkVjJcRVJCHhJxGGX"}
-    b.bounty_pre(bounty)
-    ipfs_download.assert_called_with(bounty["uri"])
-    assert not dispatch_event.called
+    try:
+        ipfs_json.return_value = {"result": [
+            {"hash": "QmA", "name": "a.exe"},
+            {"hash": "QmB", "name": "b.exe"},
+            {"hash": "QmC", "name": "c.exe"},
+        ]}
+        b.bounty_with_manifest(bounty)
+        ipfs_json.assert_called_with(bounty["uri"], cache=False)
+        job_ids = _artifact_ids(bounty["guid"])
+        assert len(job_ids) == 3
+        # Queued for download; jobs are dispatched once the files are in
+        prefetch.assert_called_once_with(bounty["guid"], [
+            ("QmA", bounty["uri"] + "/0"),
+            ("QmB", bounty["uri"] + "/1"),
+            ("QmC", bounty["uri"] + "/2"),
+        ], job_ids)
+        assert dispatch_event.call_args_list == [
+            mock.call("bounty_new", bounty["guid"], 3)]
+
+        # Seen before, nothing is queued again
+        prefetch.reset_mock()
+        b.bounty_with_manifest(bounty)
+        assert not prefetch.called
+
+        # No manifest, no bounty
+        for error in (IPFSNotFoundError(), IOError()):
+            dispatch_event.reset_mock()
+            ipfs_json.side_effect = error
+            bounty = dict(bounty, guid=str(uuid.uuid4()))
+            b.bounty_with_manifest(bounty)
+            ipfs_json.assert_called_with(bounty["uri"], cache=False)
+            _no_such_bounty(bounty["guid"])
+            assert not prefetch.called
+            assert not dispatch_event.called
+    finally:
+        db_clear()
 
 @mock.patch("arbiter.bounties.ipfs_json")
-@mock.patch("arbiter.bounties.ipfs_download")
+@mock.patch("arbiter.bounties.prefetch")
 @mock.patch("arbiter.bounties.dispatch_event")
-def test_bounty_with_manifest(dispatch_event, ipfs_download, ipfs_json):
+def test_bounty_with_manifest(dispatch_event, prefetch, ipfs_json, db):
     b = BountyComponent(Parent())
     bounty = {
         "resolved": True,
@@ -248,13 +284,24 @@ def test_bounty_with_manifest(dispatch_event, ipfs_download, ipfs_json):
         bounty["resolved"] = False
         b.bounty_with_manifest(bounty)
         _no_such_bounty(bounty["guid"])
+        assert not prefetch.called
 
         ipfs_json.return_value =  {"result": [
             {"hash": "Q12312312",
-             "name": "malwr.exe"}
+             "name": "malwr.exe"},
+            {"hash": "Q45645645",
+             "name": "malwr.doc"},
         ]}
         b.bounty_with_manifest(bounty)
         _bounty_check_state(bounty["guid"], False, False)
+        job_ids = _artifact_ids(bounty["guid"])
+        assert len(job_ids) == 2
+        dispatch_event.assert_called_with("bounty_new", bounty["guid"], 2)
+
+        # Artifacts in the order of the manifest, with their jobs
+        prefetch.assert_called_once_with(
+            bounty["guid"], [("Q12312312", "Q1111/0"), ("Q45645645", "Q1111/1")],
+            job_ids)
     finally:
         db_clear()
 
@@ -0,0 +1,127 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import datetime
+import gevent
+import mock
+import pytest
+import uuid
+
+from arbiter.cache import (
+    CacheComponent, collected_bytes, collected_files, fetch_bounty_artifacts,
+    prefetch, prefetch_queued, prefetching
+)
+from arbiter.database import DbSession, DbBounty, DbArtifact
+from arbiter.store import ArtifactStore, pinned_artifact_hashes
+
+from utils import db_init, db_destroy, db_clear
+
+@pytest.fixture(scope="module")
+def db():
+    try:
+        db_init()
+        yield
+    finally:
+        db_destroy()
+
+class Config:
+    artifacts_grace_period = 3600
+
+class Parent:
+    config = Config()
+
+def add_bounty(hashes, status="active", finished=None):
+    s = DbSession()
+    b = DbBounty(guid=str(uuid.uuid4()), amount="62500000000000000",
+                 author="0x0", num_artifacts=len(hashes), status=status,
+                 expiration_block=90, vote_after=90, vote_before=100,
+                 reveal_block=100, settle_block=110)
+    if finished is not None:
+        b.finished_at = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=finished)
+    s.add(b)
+    s.flush()
+    for hash in hashes:
+        s.add(DbArtifact(bounty_id=b.id, hash=hash, name="sample.exe"))
+    s.commit()
+    s.close()
+
+def test_pinned_artifact_hashes(db):
+    add_bounty(["Qa", "Qb"])
+    add_bounty(["Qb", "Qc"], "finished", finished=60)
+    add_bounty(["Qd"], "aborted", finished=7200)
+    add_bounty(["Qe"], "finished", finished=7200)
+    try:
+        assert pinned_artifact_hashes() == set(["Qa", "Qb"])
+        assert pinned_artifact_hashes(3600) == set(["Qa", "Qb", "Qc"])
+        assert pinned_artifact_hashes(86400) == \
+            set(["Qa", "Qb", "Qc", "Qd", "Qe"])
+    finally:
+        db_clear()
+
+def test_collect(tmpdir):
+    store = ArtifactStore(str(tmpdir), referenced=set)
+    for hash in ("Qa", "Qb", "Qc"):
+        with store.writer(hash) as fp:
+            fp.write(b"x" * 100)
+
+    files = collected_files.get()
+    size = collected_bytes.get()
+    c = CacheComponent(Parent())
+    with mock.patch("arbiter.cache.ipfs.store", store), \
+            mock.patch("arbiter.cache.pinned_artifact_hashes",
+                       return_value=set(["Qb"])) as pinned:
+        c.collect_garbage()
+        pinned.assert_called_once_with(3600)
+        assert list(store.index) == ["Qb"]
+        assert collected_files.get() == files + 2
+        assert collected_bytes.get() == size + 200
+
+        # Kept until evicted for space
+        c.grace = None
+        pinned.reset_mock()
+        c.collect_garbage()
+        assert not pinned.called
+
+@mock.patch("arbiter.cache.DbSession")
+@mock.patch("arbiter.cache.dispatch_event")
+@mock.patch("arbiter.cache.ipfs_cached_sha256")
+@mock.patch("arbiter.cache.ipfs_download_many")
+def test_fetch_bounty_artifacts(download_many, cached_sha256, dispatch_event,
+                                DbSession):
+    files = [("Qa", "uri/0"), ("Qb", "uri/1"), ("Qc", "uri/2")]
+    # Qb fails twice, Qc only the first time
+    download_many.side_effect = [files[1:], files[1:2]]
+    cached_sha256.side_effect = lambda hash: "sha256-%s" % hash
+    fetch_bounty_artifacts("guid", files, [1, 2, 3])
+
+    assert download_many.call_args_list == [
+        mock.call(files), mock.call(files[1:])]
+    DbSession.return_value.bulk_update_mappings.assert_called_once_with(
+        DbArtifact, [{"id": 1, "sha256": "sha256-Qa"},
+                     {"id": 3, "sha256": "sha256-Qc"}])
+    assert dispatch_event.call_args_list == [
+        mock.call("verdict_jobs", "guid", 1),
+        mock.call("verdict_jobs", "guid", 3)]
+
+@mock.patch("arbiter.cache.fetch_bounty_artifacts")
+def test_prefetch_worker(fetch):
+    fetch.side_effect = [IOError("IPFS is down"), None]
+    prefetch("guid1", [("Qa", "uri/0")], [1])
+    prefetch("guid2", [("Qb", "uri/0"), ("Qc", "uri/1")], [2, 3])
+    assert prefetching == set([1, 2, 3])
+    assert prefetch_queued.get() == 2
+
+    # A failed bounty does not stop the worker
+    c = CacheComponent(Parent())
+    worker = gevent.spawn(c.prefetch_worker)
+    try:
+        gevent.sleep(0.01)
+        assert fetch.call_args_list == [
+            mock.call("guid1", [("Qa", "uri/0")], [1]),
+            mock.call("guid2", [("Qb", "uri/0"), ("Qc", "uri/1")], [2, 3])]
+        assert not prefetching
+        assert prefetch_queued.get() == 0
+        assert not worker.ready()
+    finally:
+        worker.kill()
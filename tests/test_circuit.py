@@ -0,0 +1,37 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import mock
+
+from arbiter.circuit import (
+    CircuitBreaker, CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN
+)
+
+@mock.patch("arbiter.circuit.time")
+def test_circuit_breaker(time):
+    changes = []
+    time.time.return_value = 1000
+    b = CircuitBreaker("cuckoo", 2, 60, changes.append)
+    assert b.allow()
+
+    b.failure()
+    assert b.state == CIRCUIT_CLOSED
+    b.success()
+    b.failure()
+    assert b.allow()
+    b.failure()
+    assert b.state == CIRCUIT_OPEN
+    assert not b.allow()
+
+    time.time.return_value = 1060
+    assert b.allow()
+    assert b.state == CIRCUIT_HALF_OPEN
+    b.failure()
+    assert b.state == CIRCUIT_OPEN
+
+    time.time.return_value = 1120
+    assert b.allow()
+    b.success()
+    assert b.state == CIRCUIT_CLOSED
+    assert changes == [CIRCUIT_OPEN, CIRCUIT_HALF_OPEN, CIRCUIT_OPEN,
+                       CIRCUIT_HALF_OPEN, CIRCUIT_CLOSED]
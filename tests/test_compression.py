@@ -0,0 +1,69 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import io
+import os
+import pytest
+
+from arbiter.compression import (
+    CHUNK_SIZE, CODECS, compression_cpu, get_codec, split_suffix, Compressor,
+    DecompressingReader
+)
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_roundtrip(name):
+    codec = get_codec(name)
+    data = b"MZ" + b"\0" * 200000 + os.urandom(100)
+    c = Compressor(codec)
+    compressed = c.compress(data[:70000]) + c.compress(data[70000:]) + \
+        c.flush()
+    assert len(compressed) < len(data) / 10
+
+    fp = io.BytesIO(compressed)
+    fp.name = "x"
+    reader = DecompressingReader(fp, codec)
+    assert reader.read(10) == data[:10]
+    assert reader.read() == data[10:]
+    assert reader.read() == b""
+
+    # Reported when closed, rather than from a thread that read the file
+    cpu = compression_cpu.get(codec=name, op="decompress")
+    assert reader.cpu >= 0
+    spent = reader.cpu
+    reader.close()
+    assert compression_cpu.get(codec=name, op="decompress") == cpu + spent
+    assert reader.cpu == 0
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_bounded(name):
+    codec = get_codec(name)
+    size = 64 * 1024 * 1024
+    c = Compressor(codec)
+    compressed = b"".join(c.compress(b"\0" * CHUNK_SIZE)
+                          for _ in range(size // CHUNK_SIZE)) + c.flush()
+
+    # Only what was asked for is decompressed, however well it compressed
+    fp = io.BytesIO(compressed)
+    fp.name = "x"
+    reader = DecompressingReader(fp, codec)
+    total = 0
+    while True:
+        data = reader.read(CHUNK_SIZE)
+        assert len(reader.buffer) == 0
+        if not data:
+            break
+        total += len(data)
+    assert total == size
+
+    # A truncated file ends early
+    fp = io.BytesIO(compressed[:len(compressed) // 2])
+    fp.name = "x"
+    reader = DecompressingReader(fp, codec)
+    assert 0 < len(reader.read()) < size
+
+def test_codecs():
+    assert get_codec("") is None
+    with pytest.raises(ValueError):
+        get_codec("rar")
+    assert split_suffix("QmA.gz") == ("QmA", CODECS["zlib"])
+    assert split_suffix("QmA") == ("QmA", None)
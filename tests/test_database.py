@@ -0,0 +1,34 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import pytest
+
+from sqlalchemy import inspect, text
+
+from arbiter.database import DbSession, upgrade_schema
+
+from utils import db_init, db_destroy
+
+@pytest.fixture(scope="module")
+def db():
+    try:
+        db_init()
+        yield
+    finally:
+        db_destroy()
+
+def test_upgrade_schema(db):
+    engine = DbSession.kw["bind"]
+    # As created by an older version
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_artifact_verdicts_work_seq"))
+        conn.execute(text("ALTER TABLE artifacts DROP COLUMN sha256"))
+
+    upgrade_schema(engine)
+    inspector = inspect(engine)
+    assert "sha256" in [c["name"] for c in inspector.get_columns("artifacts")]
+    assert "ix_artifact_verdicts_work_seq" in [
+        i["name"] for i in inspector.get_indexes("artifact_verdicts")]
+
+    # Nothing left to do
+    upgrade_schema(engine)
@@ -0,0 +1,83 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import io
+import mock
+import pytest
+import requests
+
+from urllib3 import encode_multipart_formdata
+
+from arbiter.httpclient import MultipartEncoder, PooledSession
+
+def test_multipart():
+    data = b"MZ" + b"\0" * 100000
+    opened = []
+
+    def open_file():
+        opened.append(io.BytesIO(data))
+        return opened[-1]
+
+    body = MultipartEncoder(
+        {"custom": "https://arbiter/artifact/1", "options": 'a="b"'},
+        {"file": ('sample "1".exe', open_file, len(data))}, boundary="xyz")
+    assert not opened
+    encoded = b"".join(body)
+    assert len(body) == len(encoded)
+    assert len(opened) == 1 and opened[0].closed
+
+    # Sent again from the start of a new file
+    assert b"".join(body) == encoded
+    assert len(opened) == 2 and opened[1].closed
+
+    # Byte for byte what requests (through urllib3) would send
+    expected, content_type = encode_multipart_formdata([
+        ("custom", "https://arbiter/artifact/1"),
+        ("options", 'a="b"'),
+        ("file", ('sample "1".exe', data, "application/octet-stream")),
+    ], boundary="xyz")
+    assert encoded == expected
+    assert body.content_type == content_type
+
+def test_post_files():
+    s = PooledSession()
+    fp = io.BytesIO(b"MZ")
+    with mock.patch.object(s, "send") as send:
+        s.post_files("http://localhost/tasks", data={"callback": "x"},
+                     files={"file": ("sample.exe", lambda: fp, 2)},
+                     headers={"X-Arbiter": "clamav"})
+    request = send.call_args[0][0]
+    assert request.headers["Content-Type"].startswith(
+        "multipart/form-data; boundary=")
+    assert request.headers["Content-Length"] == str(len(request.body))
+    assert request.headers["X-Arbiter"] == "clamav"
+    assert b"".join(request.body).endswith(b"--\r\n")
+
+def test_post_files_failed():
+    s = PooledSession()
+    fp = io.BytesIO(b"MZ" * 100000)
+
+    def send(request, **kwargs):
+        # The connection breaks halfway through the file
+        body = iter(request.body)
+        next(body)
+        next(body)
+        raise requests.ConnectionError("Connection reset by peer")
+
+    with mock.patch.object(s, "send", side_effect=send):
+        with pytest.raises(requests.ConnectionError):
+            s.post_files("http://localhost/tasks",
+                         files={"file": ("sample.exe", lambda: fp, 200000)})
+    assert fp.closed
+
+def test_retry_methods():
+    retry = PooledSession().adapter.max_retries
+    assert retry.is_retry("PUT", 503)
+    assert not retry.is_retry("POST", 503)
+
+    # e.g. polyswarmd, where only reads are safe to repeat
+    retry = PooledSession.from_config(
+        {"retries": 2}, retry_methods=("GET",)).adapter.max_retries
+    assert retry.total == 2
+    assert retry.is_retry("GET", 503)
+    assert not retry.is_retry("PUT", 503)
@@ -0,0 +1,128 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import gevent
+import hashlib
+import mock
+import os
+import pytest
+
+from arbiter import ipfs
+from arbiter.artifacts import Artifact
+from arbiter.ipfs import (
+    SingleFlight, JsonCache, IPFSNotFoundError, coalesced_requests,
+    json_cache_hit_ratio
+)
+from arbiter.store import ArtifactStore
+
+def response(status_code=200, chunks=()):
+    r = mock.MagicMock(status_code=status_code)
+    r.iter_content.return_value = iter(chunks)
+    return r
+
+def test_singleflight():
+    flight = SingleFlight("test")
+    calls = []
+
+    def fetch(key):
+        calls.append(key)
+        gevent.sleep(0.01)
+        if key == "bad":
+            raise IOError(key)
+        return key.upper()
+
+    jobs = [gevent.spawn(flight.do, key, fetch, key)
+            for key in ("a", "a", "b", "a")]
+    gevent.joinall(jobs)
+    assert [j.value for j in jobs] == ["A", "A", "B", "A"]
+    assert sorted(calls) == ["a", "b"]
+    assert coalesced_requests.get(kind="test") == 2
+    assert not flight.calls
+
+    jobs = [gevent.spawn(flight.do, "bad", fetch, "bad") for _ in range(2)]
+    gevent.joinall(jobs)
+    assert all(isinstance(j.exception, IOError) for j in jobs)
+
+    # Finished calls aren't shared
+    assert flight.do("a", fetch, "a") == "A"
+    assert calls.count("a") == 2
+
+def test_singleflight_interrupted():
+    flight = SingleFlight("test")
+
+    def fetch(delay):
+        gevent.sleep(delay)
+        return "x"
+
+    owner = gevent.spawn(flight.do, "a", fetch, 10)
+    gevent.sleep(0)
+    waiters = [gevent.spawn(flight.do, "a", fetch, 0) for _ in range(2)]
+    gevent.sleep(0)
+    owner.kill()
+    gevent.joinall(waiters, timeout=1)
+    assert all(isinstance(w.exception, IOError) for w in waiters)
+    assert not flight.calls
+
+    def timed_out():
+        with gevent.Timeout(0.01):
+            flight.do("b", fetch, 10)
+
+    owner = gevent.spawn(timed_out)
+    gevent.sleep(0)
+    waiter = gevent.spawn(flight.do, "b", fetch, 0)
+    gevent.joinall([owner, waiter], timeout=1)
+    assert isinstance(owner.exception, gevent.Timeout)
+    assert isinstance(waiter.exception, IOError)
+
+def test_json_cache():
+    cache = JsonCache(max_bytes=100, max_document=60)
+    assert cache.get("a") == (False, None)
+
+    cache.put("a", {"a": 1}, 40)
+    cache.put("b", None, 40)
+    assert cache.get("a") == (True, {"a": 1})
+    assert cache.get("b") == (True, None)
+
+    # Too large to keep
+    cache.put("c", [], 61)
+    assert cache.get("c") == (False, None)
+
+    # a was used least recently
+    cache.put("c", [], 30)
+    assert list(cache.entries) == ["b", "c"]
+    assert cache.total == 70
+    assert json_cache_hit_ratio.get() == 0.5
+
+@mock.patch("arbiter.store.offload")
+@mock.patch("arbiter.ipfs.session")
+def test_download(session, offload, tmpdir):
+    chunks = [b"MZ" * 40000, b"\0" * 70000, b"PE"]
+    data = b"".join(chunks)
+    session.get.return_value = response(chunks=chunks)
+    with mock.patch.object(ipfs, "store", ArtifactStore(str(tmpdir))):
+        path = ipfs.ipfs_download("Qhash", "Qbounty/0")
+        assert session.get.call_args[0][0].endswith("/artifacts/Qbounty/0")
+        assert session.get.call_args[1]["stream"]
+        with open(path, "rb") as fp:
+            assert fp.read() == data
+
+        # Hashed while downloading, never read back
+        sha256 = hashlib.sha256(data).hexdigest()
+        assert ipfs.ipfs_cached_sha256("Qhash") == sha256
+        a = Artifact(1, "sample.exe", "Qhash", "http://localhost/artifact/1")
+        assert a.sha256() == sha256
+        assert not offload.run.called
+
+        # Already stored
+        assert ipfs.ipfs_download("Qhash") == path
+        assert session.get.call_count == 1
+
+@mock.patch("arbiter.ipfs.session")
+def test_download_not_found(session, tmpdir):
+    session.get.return_value = response(404)
+    with mock.patch.object(ipfs, "store", ArtifactStore(str(tmpdir))):
+        with pytest.raises(IPFSNotFoundError):
+            ipfs.ipfs_download("Qhash")
+        assert ipfs.store.get("Qhash") is None
+        # Nothing left behind in the staging area
+        assert not [f for _, _, files in os.walk(str(tmpdir)) for f in files]
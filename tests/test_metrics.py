@@ -0,0 +1,56 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import pytest
+
+from arbiter.metrics import Registry
+
+def test_counter_gauge():
+    r = Registry()
+    c = r.counter("arbiter_votes", "Votes cast", ["result"])
+    c.inc(result="ok")
+    c.inc(2, result="ok")
+    c.inc(result='bad "one"')
+    assert c.get(result="ok") == 3
+    assert r.counter("arbiter_votes", "Votes cast", ["result"]) is c
+
+    with pytest.raises(ValueError):
+        c.inc(-1, result="ok")
+    with pytest.raises(ValueError):
+        c.inc(backend="cuckoo")
+    with pytest.raises(ValueError):
+        r.gauge("arbiter_votes", "Votes cast")
+
+    g = r.gauge("polyswarm_block", "Last block")
+    g.set(10)
+    g.dec(3)
+
+    assert r.exposition() == (
+        "# HELP arbiter_votes Votes cast\n"
+        "# TYPE arbiter_votes counter\n"
+        'arbiter_votes{result="bad \\"one\\""} 1\n'
+        'arbiter_votes{result="ok"} 3\n'
+        "# HELP polyswarm_block Last block\n"
+        "# TYPE polyswarm_block gauge\n"
+        "polyswarm_block 7\n"
+    )
+
+def test_histogram():
+    r = Registry()
+    h = r.histogram("arbiter_submit_seconds", "Submit time", ["backend"],
+                    buckets=(0.1, 1))
+    h.observe(0.05, backend="cuckoo")
+    h.observe(0.5, backend="cuckoo")
+    h.observe(5, backend="cuckoo")
+    with h.time(backend="zer0m0n"):
+        pass
+
+    assert h.get(backend="cuckoo") == 3
+    lines = r.exposition().splitlines()
+    assert "# TYPE arbiter_submit_seconds histogram" in lines
+    assert 'arbiter_submit_seconds_bucket{backend="cuckoo",le="0.1"} 1' in lines
+    assert 'arbiter_submit_seconds_bucket{backend="cuckoo",le="1"} 2' in lines
+    assert 'arbiter_submit_seconds_bucket{backend="cuckoo",le="+Inf"} 3' in lines
+    assert 'arbiter_submit_seconds_sum{backend="cuckoo"} 5.55' in lines
+    assert 'arbiter_submit_seconds_count{backend="cuckoo"} 3' in lines
+    assert 'arbiter_submit_seconds_count{backend="zer0m0n"} 1' in lines
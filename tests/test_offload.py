@@ -0,0 +1,56 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import gevent
+import mock
+import pytest
+import threading
+
+from arbiter import offload
+from arbiter.offload import offload_queued, offload_time
+
+@pytest.fixture
+def pool():
+    offload.configure(1)
+    yield offload.pool
+    offload.configure(offload.POOL_SIZE)
+
+def fails():
+    raise ValueError("bad transaction")
+
+def test_run(pool):
+    hub = threading.get_ident()
+    assert offload.run(threading.get_ident) != hub
+    with pytest.raises(ValueError):
+        offload.run(fails)
+    assert offload.run(max, [1, 3], key=lambda x: -x) == 1
+
+def test_spawn(pool):
+    hub = threading.get_ident()
+    observed = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(10)
+        return "signed"
+
+    count = offload_time.get(task="block")
+    with mock.patch.object(offload_time, "observe",
+                           side_effect=lambda *args, **kwargs:
+                           observed.append(threading.get_ident())):
+        first = offload.spawn(block)
+        second = offload.spawn(block)
+        assert offload_queued.get() == 1
+        assert started.wait(10)
+        release.set()
+        assert first.get(timeout=10) == "signed"
+        assert second.get(timeout=10) == "signed"
+        gevent.sleep(0)
+
+    # Only updated by the hub, once the results are in
+    assert observed == [hub, hub]
+    assert offload_queued.get() == 0
+    assert offload.in_flight == 0
+    assert offload_time.get(task="block") == count
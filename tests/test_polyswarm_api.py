@@ -0,0 +1,91 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import gevent
+import mock
+import pytest
+
+from arbiter.polyswarm_api import CachedCall
+
+@mock.patch("arbiter.polyswarm_api.time")
+def test_cached_call(time):
+    values = [1, 2, IOError("offline"), 3]
+    changes = []
+
+    def fetch():
+        v = values.pop(0)
+        if isinstance(v, Exception):
+            raise v
+        return v
+
+    time.time.return_value = 1000
+    cached = CachedCall("test", fetch, 60, changes.append)
+    assert cached.get() == 1
+    assert cached.get() == 1
+
+    # Stale values are returned while they are refreshed
+    time.time.return_value = 1060
+    assert cached.get() == 1
+    gevent.sleep(0)
+    assert cached.get() == 2
+    assert changes == [2]
+
+    # A failed refresh keeps the old value
+    time.time.return_value = 1120
+    assert cached.get() == 2
+    gevent.sleep(0)
+    assert cached.get() == 2
+    assert cached.expires == 1130
+
+    # Invalidated values are never returned
+    cached.invalidate()
+    assert cached.get() == 3
+    assert changes == [2, 3]
+    assert cached.get() == 3
+    assert not values
+
+@mock.patch("arbiter.polyswarm_api.time")
+def test_cached_call_invalidate(time):
+    values = [1, IOError("offline"), 2]
+
+    def fetch():
+        v = values.pop(0)
+        if isinstance(v, Exception):
+            raise v
+        return v
+
+    time.time.return_value = 1000
+    cached = CachedCall("test", fetch, 60)
+    assert cached.get() == 1
+
+    # Still invalid after a failure, so it is tried again
+    cached.invalidate()
+    with pytest.raises(IOError):
+        cached.get()
+    assert cached.get() == 2
+    assert cached.get() == 2
+    assert not values
+
+@mock.patch("arbiter.polyswarm_api.time")
+def test_cached_call_invalidate_on_error(time):
+    values = [{"online": True}, IOError("offline"), IOError("offline"),
+              {"online": False}]
+
+    def fetch():
+        v = values.pop(0)
+        if isinstance(v, Exception):
+            raise v
+        return v
+
+    time.time.return_value = 1000
+    cached = CachedCall("status", fetch, 10, invalidate_on_error=True)
+    assert cached.get() == {"online": True}
+
+    # Stale one last time; once the refresh failed, callers see the error
+    time.time.return_value = 1010
+    assert cached.get() == {"online": True}
+    gevent.sleep(0)
+    with pytest.raises(IOError):
+        cached.get()
+    assert cached.get() == {"online": False}
+    assert not values
@@ -0,0 +1,96 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import mock
+import pytest
+
+from arbiter.database import DbSession, DbArtifactRate
+from arbiter.rollup import (
+    RESOLUTIONS, RateRollup, choose_resolution, retained
+)
+
+from utils import db_init, db_destroy
+
+DAY = 86400
+NOW = 1000 * DAY
+
+@pytest.fixture(scope="module")
+def db():
+    try:
+        db_init()
+        yield
+    finally:
+        db_destroy()
+
+def test_add():
+    r = RateRollup()
+    r.add(NOW + 59)
+    r.add(NOW + 60, 2)
+    assert r.pending == {
+        (60, NOW + 60): 1, (60, NOW + 120): 2,
+        (600, NOW + 600): 3, (3600, NOW + 3600): 3, (DAY, NOW + DAY): 3,
+    }
+
+@mock.patch("arbiter.rollup.DbSession")
+def test_flush(DbSession):
+    r = RateRollup()
+    r.flush()
+    assert not DbSession.called
+
+    r.add(NOW)
+    s = DbSession.return_value
+    s.commit.side_effect = IOError("database is gone")
+    with pytest.raises(IOError):
+        r.flush()
+    # Kept for the next attempt, along with what came in meanwhile
+    r.add(NOW)
+    assert r.pending[60, NOW + 60] == 2
+    assert len(r.pending) == len(RESOLUTIONS)
+
+    s.commit.side_effect = None
+    s.execute.reset_mock()
+    r.flush()
+    rows = s.execute.call_args[0][1]
+    assert sorted((row["resolution"], row["count"]) for row in rows) == \
+        [(60, 2), (600, 2), (3600, 2), (DAY, 2)]
+    assert not r.pending
+
+def test_retained():
+    assert retained(60, NOW - DAY, NOW)
+    assert retained(60, NOW - 2 * DAY, NOW)
+    assert not retained(60, NOW - 2 * DAY - 61, NOW)
+    assert not retained(600, NOW - 31 * DAY, NOW)
+    assert retained(DAY, 0, NOW)
+
+def test_choose_resolution():
+    # Finest one within the point limit
+    assert choose_resolution(NOW - 3600, NOW, 1500, NOW) == 60
+    assert choose_resolution(NOW - DAY, NOW, 1000, NOW) == 600
+    # Finest one that was not pruned yet
+    assert choose_resolution(NOW - 5 * DAY, NOW - 4 * DAY, 1500, NOW) == 600
+    assert choose_resolution(NOW - 60 * DAY, NOW - 59 * DAY, 1500,
+                             NOW) == 3600
+    assert choose_resolution(0, 3600, 1500, NOW) == DAY
+    # Nothing fits
+    assert choose_resolution(0, NOW, 10, NOW) == DAY
+
+def test_prune_query(db):
+    s = DbSession()
+    for resolution in RESOLUTIONS:
+        for age in (DAY, 3 * DAY, 31 * DAY, 401 * DAY):
+            s.add(DbArtifactRate(resolution=resolution,
+                                 interval=NOW - age, count=1))
+    s.commit()
+    s.close()
+
+    r = RateRollup()
+    r.prune(NOW)
+    assert [i for i, n in r.query(60, 0, NOW)] == [NOW - DAY]
+    assert len(r.query(600, 0, NOW)) == 2
+    assert len(r.query(3600, 0, NOW)) == 3
+    assert len(r.query(DAY, 0, NOW)) == 4
+
+    # Counts that weren't flushed yet are included
+    r.add(NOW - DAY - 30)
+    assert r.query(60, NOW - 2 * DAY, NOW) == [[NOW - DAY, 2]]
+    assert r.query(60, NOW - DAY, NOW) == []
@@ -0,0 +1,122 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import hashlib
+import logging
+import os
+import pytest
+import time
+
+from arbiter.compression import CODECS
+from arbiter.store import ArtifactStore
+
+def put(store, hash, data):
+    with store.writer(hash) as fp:
+        fp.write(data)
+    return store._path(hash)
+
+def test_lru(tmpdir):
+    store = ArtifactStore(str(tmpdir), 300, referenced=set)
+    for hash in ("Qa", "Qb", "Qc"):
+        put(store, hash, b"x" * 100)
+    assert store.total == 300
+
+    # Used most recently, so Qb goes first
+    assert store.get("Qa")
+    put(store, "Qd", b"x" * 100)
+    assert list(store.index) == ["Qc", "Qa", "Qd"]
+    assert not os.path.exists(store.path("Qb"))
+    assert store.get("Qb") is None
+
+    put(store, "Qe", b"x" * 150)
+    assert list(store.index) == ["Qd", "Qe"]
+    assert store.total == 250
+
+def test_pinned(tmpdir):
+    pinned = set(["Qa", "Qb"])
+    store = ArtifactStore(str(tmpdir), 250, referenced=lambda: pinned)
+    for hash in ("Qa", "Qb", "Qc", "Qd"):
+        put(store, hash, b"x" * 100)
+    assert list(store.index) == ["Qa", "Qb", "Qd"]
+
+    # The file just written is never evicted either
+    pinned.add("Qd")
+    put(store, "Qe", b"x" * 100)
+    assert list(store.index) == ["Qa", "Qb", "Qd", "Qe"]
+
+def test_over_budget(tmpdir, caplog):
+    store = ArtifactStore(str(tmpdir), 150, referenced=lambda: ["Qa"])
+    put(store, "Qa", b"x" * 100)
+    with caplog.at_level(logging.WARNING):
+        put(store, "Qb", b"x" * 100)
+    assert list(store.index) == ["Qa", "Qb"]
+    assert "50 bytes over its budget" in caplog.text
+
+def test_scan(tmpdir):
+    root = str(tmpdir)
+    store = ArtifactStore(root, referenced=set)
+    put(store, "Qsharded", b"sharded")
+
+    # Flat layout of older versions, and leftovers of a crash
+    with open(os.path.join(root, "Qflat"), "wb") as fp:
+        fp.write(b"flat")
+    shard = os.path.dirname(store.path("Qsharded"))
+    stale = os.path.join(shard, ".tmpstale")
+    fresh = os.path.join(shard, ".tmpfresh")
+    for path in (stale, fresh):
+        with open(path, "wb") as fp:
+            fp.write(b"partial")
+    old = time.time() - 7200
+    os.utime(stale, (old, old))
+
+    store = ArtifactStore(root, referenced=set)
+    store.scan()
+    assert sorted(store.index) == ["Qflat", "Qsharded"]
+    assert store.total == len(b"flat") + len(b"sharded")
+    assert not os.path.exists(os.path.join(root, "Qflat"))
+    with store.open("Qflat") as fp:
+        assert fp.read() == b"flat"
+    assert not os.path.exists(stale)
+    assert os.path.exists(fresh)
+
+def test_scan_evicts(tmpdir):
+    root = str(tmpdir)
+    store = ArtifactStore(root, referenced=set)
+    put(store, "Qold", b"x" * 100)
+    put(store, "Qnew", b"x" * 100)
+    old = time.time() - 60
+    os.utime(store.path("Qold"), (old, old))
+
+    store = ArtifactStore(root, 150, referenced=set)
+    store.scan()
+    assert list(store.index) == ["Qnew"]
+
+@pytest.mark.parametrize("name", sorted(CODECS))
+def test_compressed(tmpdir, name):
+    root = str(tmpdir)
+    data = b"MZ" + b"\0" * 200000 + b"PE"
+    sha256 = hashlib.sha256(data).hexdigest()
+    store = ArtifactStore(root, referenced=set, compression=name)
+    path = put(store, "Qa", data)
+    assert path.endswith(CODECS[name].suffix)
+    assert store.total == os.path.getsize(path) < len(data)
+    with store.open("Qa") as fp:
+        assert fp.read() == data
+    assert store.sha256("Qa") == sha256
+    assert store.length("Qa") == len(data)
+
+    # Found by its suffix, and hashed when asked for
+    store = ArtifactStore(root, referenced=set)
+    store.scan()
+    assert store.index["Qa"][2] is CODECS[name]
+    with store.open("Qa") as fp:
+        assert fp.read() == data
+    assert store.sha256("Qa") == sha256
+    assert store.length("Qa") == len(data)
+
+    # Stored again without compression; the old copy goes
+    put(store, "Qa", data)
+    assert not os.path.exists(path)
+    assert os.path.exists(store.path("Qa"))
+    assert store.total == len(data)
+    assert store.length("Qa") == len(data)
@@ -1,7 +1,11 @@
 # Copyright (C) 2018 Hatching B.V.
 # This file is licensed under the MIT License, see also LICENSE.
 
-from arbiter.utils import pct_agree
+import mock
+
+from arbiter.utils import (
+    pct_agree, generate_token, validate_token, TokenCache
+)
 
 def test_pct_agree():
     assert not pct_agree(0.6666, 0, 0)
@@ -11,3 +15,37 @@ def test_pct_agree():
 
     assert pct_agree(0.5, 1, 2)
     assert pct_agree(0.5, 2, 4)
+
+def test_validate_token():
+    secret = b"s3cr3t"
+    token = generate_token(secret, "cuckoo", 1000)
+    assert validate_token(secret, token, now=1000) == "cuckoo"
+    assert not validate_token(b"other", token, now=1000)
+    assert not validate_token(secret, token[:-1] + "x", now=1000)
+    assert not validate_token(secret, "cuckoo.abc.def", now=1000)
+
+    assert validate_token(secret, token, max_age=60, now=1060) == "cuckoo"
+    assert not validate_token(secret, token, max_age=60, now=1061)
+    assert not validate_token(secret, token, not_before=1001, now=1060)
+    # Issued in the future
+    assert not validate_token(secret, token, now=500)
+
+@mock.patch("arbiter.utils.time")
+def test_token_cache(time):
+    secret = b"s3cr3t"
+    token = generate_token(secret, "cuckoo", 1000)
+    cache = TokenCache(secret, max_age=60, size=1)
+
+    time.time.return_value = 1000
+    assert cache.validate(token) == "cuckoo"
+    assert not cache.validate("cuckoo.1000.abc")
+    assert list(cache.entries) == [token]
+
+    with mock.patch("arbiter.utils.validate_token") as validate:
+        assert cache.validate(token) == "cuckoo"
+        assert not validate.called
+
+    # Expired along with the token
+    time.time.return_value = 1061
+    assert not cache.validate(token)
+    assert not cache.entries
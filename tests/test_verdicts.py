@@ -14,7 +14,9 @@ from arbiter.const import (
     JOB_STATUS_DONE, JOB_STATUS_NEW, JOB_STATUS_SUBMITTING, JOB_STATUS_PENDING
 )
 from arbiter.database import DbSession, DbBounty, DbArtifact, DbArtifactVerdict
-from arbiter.verdicts import vote_on_artifact, VerdictComponent
+from arbiter.verdicts import (
+    vote_on_artifact, vote_on_artifact_early, VerdictComponent
+)
 
 from utils import db_init, db_destroy, db_clear
 
@@ -27,22 +29,28 @@ def db():
         db_destroy()
 
 class artifact:
-    def __init__(self, with_verdicts={}):
+    def __init__(self, with_verdicts={}, processed=False, **bounty):
         self.with_verdicts = with_verdicts
+        self.processed = processed
+        self.bounty = {"amount": "62500000000000000", "author": "0x0",
+                       "expiration_block": 90, "vote_after": 90,
+                       "vote_before": 1000, "reveal_block": 90,
+                       "settle_block": 1000}
+        self.bounty.update(bounty)
 
     def __enter__(self):
         s = DbSession()
         g = str(uuid.uuid4())
         b = DbBounty(guid=g,
-                     expires=datetime.datetime.utcnow() + datetime.timedelta(days=1),
                      num_artifacts=len(self.with_verdicts),
-                     settle_block=1000)
+                     **self.bounty)
         s.add(b)
         s.flush()
         bid = b.id
         a = DbArtifact(bounty_id=b.id,
                        hash="Q121293810",
-                       name="dummy.exe")
+                       name="dummy.exe",
+                       processed=self.processed)
         s.add(a)
         s.flush()
         aid = a.id
@@ -74,9 +82,11 @@ class Holder:
 class Config:
     expires = datetime.timedelta(days=5)
     url = "http://localhost:59999/"
+    vote_deadline_blocks = 10
 
 class Parent:
     artifact_interval = 900
+    initial_block = None
     polyswarm = Holder()
     config = Config()
 
@@ -118,6 +128,34 @@ def test_vote_hc(caplog):
                              "cape": VERDICT_MALICIOUS,
                              "clamav": VERDICT_MALICIOUS}) is VERDICT_MALICIOUS
 
+def test_vote_early():
+    verdicts.analysis_backends = {
+        "cuckoo": AnalysisBackend("cuckoo", True, 1),
+        "modified": AnalysisBackend("modified", False, 1),
+        "cape": AnalysisBackend("cape", False, 2),
+        "clamav": AnalysisBackend("clamav", False, 1),
+    }
+    # Trusted backend found it to be malicious
+    assert vote_on_artifact_early(
+        {"cuckoo": VERDICT_MALICIOUS},
+        ["modified", "cape", "clamav"]) == (True, VERDICT_MALICIOUS)
+    # Trusted backend could still decide
+    assert vote_on_artifact_early(
+        {"modified": VERDICT_SAFE, "cape": VERDICT_SAFE},
+        ["cuckoo", "clamav"]) == (False, None)
+    assert vote_on_artifact_early(
+        {"cuckoo": VERDICT_SAFE, "modified": VERDICT_SAFE,
+         "cape": VERDICT_SAFE},
+        ["clamav"]) == (True, VERDICT_SAFE)
+    assert vote_on_artifact_early(
+        {"cuckoo": VERDICT_SAFE, "modified": VERDICT_MALICIOUS},
+        ["cape", "clamav"]) == (False, None)
+    # Nothing pending
+    assert vote_on_artifact_early(
+        {"cuckoo": VERDICT_SAFE, "modified": VERDICT_SAFE,
+         "cape": VERDICT_SAFE, "clamav": VERDICT_SAFE},
+        []) == (True, VERDICT_SAFE)
+
 @mock.patch("arbiter.verdicts.dispatch_event")
 def test_expire_verdicts(dispatch_event, db):
     v = VerdictComponent(Parent())
@@ -147,8 +185,111 @@ def test_expire_verdicts(dispatch_event, db):
             s.close()
     db_clear()
 
-def test_retry_submission():
-    pass
+def job_statuses(artifact_id):
+    s = DbSession()
+    try:
+        return dict((av.backend, av.status) for av in
+                    s.query(DbArtifactVerdict).filter_by(
+                        artifact_id=artifact_id))
+    finally:
+        s.close()
+
+@mock.patch("arbiter.verdicts.dispatch_event")
+def test_vote_deadline_guard(dispatch_event, db):
+    v = VerdictComponent(Parent())
+    v._cancel_jobs = mock.MagicMock()
+    verdicts.analysis_backends = {
+        u"cuckoo": AnalysisBackend(u"cuckoo", True, 1),
+        u"zer0m0n": AnalysisBackend(u"zer0m0n", False, 1),
+        u"clamav": AnalysisBackend(u"clamav", False, 1),
+    }
+
+    closing = artifact({u"cuckoo": {"status": JOB_STATUS_PENDING,
+                                    "meta": {"task_id": 1}},
+                        u"zer0m0n": {"status": JOB_STATUS_NEW},
+                        u"clamav": {"status": JOB_STATUS_DONE,
+                                    "verdict": VERDICT_SAFE}},
+                       vote_before=105)
+    with closing as x:
+        v.block_updated(100)
+        assert job_statuses(x["artifact_id"]) == {
+            u"cuckoo": JOB_STATUS_FAILED,
+            u"zer0m0n": JOB_STATUS_FAILED,
+            u"clamav": JOB_STATUS_DONE,
+        }
+        # Only the pending job runs on the backend
+        jobs = v._cancel_jobs.call_args[0][0]
+        assert [(av_id, backend) for av_id, backend, _, _ in jobs] == \
+            [(x["jobs"][0][0], u"cuckoo")]
+        dispatch_event.assert_called_once_with("verdict_update",
+                                               x["artifact_id"])
+    db_clear()
+
+@pytest.mark.parametrize("bounty", [
+    # Outside the window
+    {"vote_before": 200},
+    {"vote_before": 100},
+    {"vote_before": 105, "truth_manual": True},
+    {"vote_before": 105, "processed": True},
+])
+@mock.patch("arbiter.verdicts.dispatch_event")
+def test_vote_deadline_guard_untouched(dispatch_event, db, bounty):
+    v = VerdictComponent(Parent())
+    verdicts.analysis_backends = {
+        u"cuckoo": AnalysisBackend(u"cuckoo", True, 1),
+    }
+
+    with artifact({u"cuckoo": {"status": JOB_STATUS_PENDING}},
+                  **bounty) as x:
+        v.block_updated(100)
+        assert job_statuses(x["artifact_id"]) == {
+            u"cuckoo": JOB_STATUS_PENDING}
+        assert not dispatch_event.called
+    db_clear()
+
+@mock.patch("arbiter.verdicts.dispatch_event")
+def test_vote_deadline_guard_skip(dispatch_event, db):
+    v = VerdictComponent(Parent())
+    verdicts.analysis_backends = {
+        u"cuckoo": AnalysisBackend(u"cuckoo", True, 1),
+    }
+
+    with artifact({u"cuckoo": {"status": JOB_STATUS_PENDING}},
+                  vote_before=150) as x:
+        v.block_updated(100)
+        assert v.next_deadline == 150
+
+        # Nothing to look up until the deadline is within reach
+        with mock.patch("arbiter.verdicts.DbSession") as session:
+            v.block_updated(101)
+            v.block_updated(139)
+            assert not session.called
+
+        # Blocks are only handled once
+        v.block_updated(140)
+        v.block_updated(140)
+        assert job_statuses(x["artifact_id"]) == {
+            u"cuckoo": JOB_STATUS_FAILED}
+        dispatch_event.assert_called_once_with("verdict_update",
+                                               x["artifact_id"])
+
+        # A new bounty may close earlier
+        v.bounty_new(x["guid"], 1)
+        assert v.next_deadline == 0
+    db_clear()
+
+@mock.patch("arbiter.verdicts.prefetching", set([2]))
+@mock.patch("arbiter.verdicts.DbSession")
+@mock.patch("arbiter.verdicts.dispatch_event")
+def test_retry_submission(dispatch_event, DbSession):
+    v = VerdictComponent(Parent())
+    rows = [mock.Mock(artifact_id=i) for i in (3, 1, 2, 1)]
+    DbSession.return_value.query.return_value.filter_by.return_value = rows
+    v.retry_submissions()
+
+    # Once per artifact, and not while its bounty is being prefetched
+    assert dispatch_event.call_args_list == [
+        mock.call("verdict_jobs", None, 1), mock.call("verdict_jobs", None, 3)]
 
 @mock.patch("arbiter.verdicts.dispatch_event")
 def test_verdict_update(dispatch_event, db):
@@ -217,5 +358,45 @@ def test_verdict_job_submit(dispatch_event, db):
             s.close()
     db_clear()
 
+@mock.patch("arbiter.verdicts.DbSession")
+@mock.patch("arbiter.verdicts.dispatch_event")
+def test_verdict_job_submit_download_failed(dispatch_event, DbSession):
+    v = VerdictComponent(Parent())
+    cuckoo = AnalysisBackend(u"cuckoo", True, 1)
+    cuckoo.configure_breaker({"breaker_threshold": 1})
+    cuckoo.submit_artifact = mock.MagicMock()
+    verdicts.analysis_backends = {u"cuckoo": cuckoo}
+
+    artifact = mock.MagicMock(id=1)
+    artifact.download.side_effect = IOError("IPFS is down")
+    v.verdict_job_submit(1, [(10, u"cuckoo", artifact, None)])
+
+    # Held for a retry, without tripping the breaker
+    assert not cuckoo.submit_artifact.called
+    assert cuckoo.breaker.allow()
+    update = DbSession.return_value.query.return_value \
+        .filter_by.return_value.update
+    update.assert_called_once_with({DbArtifactVerdict.status: JOB_STATUS_NEW},
+                                   synchronize_session=False)
+
+@mock.patch("arbiter.verdicts.DbSession")
+@mock.patch("arbiter.verdicts.dispatch_event")
+def test_verdict_job_submit_cancelled(dispatch_event, DbSession):
+    v = VerdictComponent(Parent())
+    v._cancel_jobs = mock.MagicMock()
+    cuckoo = AnalysisBackend(u"cuckoo", True, 1)
+    cuckoo.submit_artifact = mock.MagicMock(return_value={"task_id": 3})
+    verdicts.analysis_backends = {u"cuckoo": cuckoo}
+
+    # The job was cancelled while it was being submitted
+    s = DbSession.return_value
+    s.query.return_value.filter_by.return_value.update.return_value = 0
+    s.query.return_value.filter.return_value.filter.return_value = [(10,)]
+    artifact = mock.MagicMock(id=1)
+    v.verdict_job_submit(1, [(10, u"cuckoo", artifact, None)])
+
+    v._cancel_jobs.assert_called_once_with(
+        [(10, u"cuckoo", artifact, {"task_id": 3})])
+
 def test_reset_pending_jobs():
     pass
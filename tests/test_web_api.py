@@ -0,0 +1,188 @@
+# Copyright (C) 2018 Hatching B.V.
+# This file is licensed under the MIT License, see also LICENSE.
+
+import gevent
+import mock
+import pytest
+import uuid
+
+from arbiter.backends import AnalysisBackend, analysis_backends
+from arbiter.const import (
+    JOB_STATUS_CANCELLED, JOB_STATUS_DONE, JOB_STATUS_NEW,
+    JOB_STATUS_SUBMITTING, JOB_STATUS_PENDING
+)
+from arbiter.database import (
+    DbSession, DbBounty, DbArtifact, DbArtifactVerdict, work_seq
+)
+from arbiter.utils import generate_token, TokenCache
+from arbiter.web_api import app, APIComponent
+
+from utils import db_init, db_destroy, db_clear
+
+SECRET = b"s3cr3t"
+HEADERS = {"Authorization": "Bearer %s" % generate_token(SECRET, "cuckoo")}
+
+class Holder:
+    pass
+
+@pytest.fixture(scope="module")
+def db():
+    try:
+        db_init()
+        yield
+    finally:
+        db_destroy()
+
+def add_jobs(statuses, backend="cuckoo"):
+    """An artifact with a job of every status; returns their IDs"""
+    s = DbSession()
+    b = DbBounty(guid=str(uuid.uuid4()), amount="62500000000000000",
+                 author="0x0", num_artifacts=len(statuses),
+                 expiration_block=90, vote_after=90, vote_before=100,
+                 reveal_block=100, settle_block=110)
+    s.add(b)
+    s.flush()
+    ids = []
+    for status in statuses:
+        a = DbArtifact(bounty_id=b.id, hash="Q%s" % len(ids),
+                       name="sample.exe")
+        s.add(a)
+        s.flush()
+        s.add(DbArtifactVerdict(artifact_id=a.id, backend=backend,
+                                status=status))
+        ids.append(a.id)
+    s.commit()
+    s.close()
+    return ids
+
+def make_pending(artifact_id, backend="cuckoo"):
+    """As verdict_job_submit does"""
+    s = DbSession()
+    s.query(DbArtifactVerdict) \
+        .filter_by(artifact_id=artifact_id, backend=backend) \
+        .update({DbArtifactVerdict.status: JOB_STATUS_PENDING,
+                 DbArtifactVerdict.work_seq: work_seq.next_value()},
+                synchronize_session=False)
+    s.commit()
+    s.close()
+
+def list_artifacts(client, **params):
+    r = client.get("/artifacts", headers=HEADERS, query_string=params)
+    assert r.status_code == 200
+    return [a["id"] for a in r.json["artifacts"]], r.json["cursor"]
+
+@pytest.fixture
+def client():
+    app.component = Holder()
+    app.component.api_tokens = TokenCache(SECRET)
+    backends = {"cuckoo": AnalysisBackend("cuckoo", True, 1)}
+    with mock.patch.dict(analysis_backends, backends):
+        yield app.test_client()
+
+@mock.patch("arbiter.web_api.dispatch_event")
+@mock.patch("arbiter.web_api.DbSession")
+def test_verdicts_bulk(DbSession, dispatch_event, client):
+    s = DbSession.return_value
+    s.query.return_value.with_for_update.return_value.filter.return_value = [
+        (11, 1, JOB_STATUS_PENDING),
+        (12, 2, JOB_STATUS_DONE),
+        (13, 3, JOB_STATUS_SUBMITTING),
+        (14, 4, JOB_STATUS_CANCELLED),
+    ]
+    r = client.post("/artifacts/verdicts", headers=HEADERS, json=[
+        {"artifact_id": 1, "verdict_value": 100, "meta": {"sig": "x"}},
+        {"artifact_id": 2, "verdict_value": 0},
+        {"artifact_id": 3, "verdict_value": None},
+        {"artifact_id": 4, "verdict_value": 0},
+        {"artifact_id": 5, "verdict_value": 0},
+        {"artifact_id": 1, "verdict_value": 0},
+        {"artifact_id": True, "verdict_value": 0},
+        {"artifact_id": "6", "verdict_value": 0},
+        {"artifact_id": 7, "verdict_value": 101},
+        {"artifact_id": 8},
+        "junk",
+    ])
+    assert r.status_code == 200
+    assert [(x["artifact_id"], x["status"], x.get("error"))
+            for x in r.json["results"]] == [
+        (1, "OK", None),
+        (2, "error", "Verdict for artifact #2 already submitted"),
+        (3, "OK", None),
+        (4, "error", "Job for artifact #4 is no longer active"),
+        (5, "error", "Artifact #5 not found"),
+        (1, "error", "Duplicate artifact_id"),
+        (True, "error", "Invalid artifact_id"),
+        ("6", "error", "Invalid artifact_id"),
+        (7, "error", "Invalid verdict value"),
+        (8, "error", "Missing verdict_value"),
+        (None, "error", "Invalid artifact_id"),
+    ]
+
+    # All in one transaction
+    s.bulk_update_mappings.assert_called_once_with(mock.ANY, [
+        {"id": 11, "status": JOB_STATUS_DONE, "verdict": 100,
+         "meta": {"sig": "x"}},
+        {"id": 13, "status": JOB_STATUS_DONE, "verdict": None},
+    ])
+    s.commit.assert_called_once_with()
+    assert dispatch_event.call_args_list == [
+        mock.call("verdict_update", 1), mock.call("verdict_update", 3)]
+
+@mock.patch("arbiter.web_api.DbSession")
+def test_verdicts_bulk_invalid(DbSession, client):
+    r = client.post("/artifacts/verdicts", headers=HEADERS,
+                    json={"artifact_id": 1})
+    assert r.status_code == 400
+    r = client.post("/artifacts/verdicts", json=[])
+    assert r.status_code == 401
+
+    # Nothing valid, nothing to look up
+    r = client.post("/artifacts/verdicts", headers=HEADERS,
+                    json=[{"artifact_id": False, "verdict_value": 0}])
+    assert r.json["results"][0]["status"] == "error"
+    assert not DbSession.called
+
+def test_list_artifacts(client, db):
+    ids = add_jobs([JOB_STATUS_NEW] * 4 + [JOB_STATUS_DONE])
+    add_jobs([JOB_STATUS_PENDING], backend="zer0m0n")
+    for aid in (ids[2], ids[0], ids[1]):
+        make_pending(aid)
+
+    # In the order the jobs became pending
+    page, cursor = list_artifacts(client, limit=2)
+    assert page == [ids[2], ids[0]]
+    page, cursor = list_artifacts(client, limit=2, cursor=cursor)
+    assert page == [ids[1]]
+    assert list_artifacts(client, cursor=cursor) == ([], cursor)
+
+    # Pending again, e.g. after a restart, and a job of an older artifact
+    s = DbSession()
+    s.query(DbArtifactVerdict).filter_by(artifact_id=ids[0]) \
+        .update({DbArtifactVerdict.status: JOB_STATUS_NEW})
+    s.commit()
+    s.close()
+    make_pending(ids[3])
+    make_pending(ids[0])
+    page, cursor = list_artifacts(client, cursor=cursor)
+    assert page == [ids[3], ids[0]]
+
+    for limit in ("0", "-1", "x"):
+        r = client.get("/artifacts", headers=HEADERS,
+                       query_string={"limit": limit})
+        assert r.status_code == 400
+    db_clear()
+
+def test_list_artifacts_wait(client, db):
+    ids = add_jobs([JOB_STATUS_NEW])
+    page, cursor = list_artifacts(client, wait=0.1)
+    assert page == []
+
+    poll = gevent.spawn(list_artifacts, client, wait=10, cursor=cursor)
+    gevent.sleep(0.1)
+    assert not poll.ready()
+
+    make_pending(ids[0])
+    APIComponent.backend_work(None, "cuckoo")
+    page, cursor = poll.get(timeout=1)
+    assert page == ids
+    db_clear()